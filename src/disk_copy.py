@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+
+# Copies a disk image, like a qcow2 template, to a raw target, a zvol, device or file, with qemu-img convert.
+# Only the extents the allocation map of the source has data for are written when the target is known to read as zeroes,
+# with out of order writes of several coroutines, bypassing the page cache of the target where it supports O_DIRECT,
+# the progress is reported as MB/s and ETA and the bytes the allocation map expects to be written or skipped are recorded.
+# With --export it writes a zstd compressed qcow2 instead, like the images qcow2-bootstrapper.sh builds.
+
+from argparse import ArgumentParser
+from errno import ENXIO
+from json import dumps, loads
+from os import O_RDWR, SEEK_DATA, SEEK_HOLE, close, environ, fstat, lseek, rename, unlink
+from os import open as os_open
+from os.path import exists, getsize
+from subprocess import PIPE, CalledProcessError, Popen, run  # nosec
+from sys import stderr
+from time import monotonic, time
+
+try:
+    from os import O_DIRECT
+except ImportError:
+    O_DIRECT = None
+
+MIB = 1048576
+
+
+def allocation_map(source, fmt=None, qemu_img=("qemu-img",), env=None):
+    # the bytes of the source with data and those that read as zeroes, unallocated or zero clusters
+    args = list(qemu_img) + ["map", "--output=json"] + (["-f", fmt] if fmt else []) + [source]
+    extents = loads(run(args, capture_output=True, check=True, env=env).stdout)
+    data = sum(e["length"] for e in extents if e["data"] and not e["zero"])
+    return {"virtual_size": sum(e["length"] for e in extents), "data": data, "zero": sum(e["length"] for e in extents) - data}
+
+
+def data_extents(path):
+    # (offset, length) of the extents of a raw file with data, the holes of a sparse file or of a fstrim are left out
+    extents = []
+
+    with open(path, "rb") as f:
+        end = fstat(f.fileno()).st_size
+        offset = 0
+
+        while offset < end:
+            try:
+                start = lseek(f.fileno(), offset, SEEK_DATA)
+            except OSError as err:
+                if err.errno == ENXIO:
+                    break
+
+                raise
+
+            offset = lseek(f.fileno(), start, SEEK_HOLE)
+            extents.append((start, offset - start))
+
+    return extents
+
+
+def direct_io(target):
+    # tmpfs and some other filesystems refuse O_DIRECT, qemu-img would fail on the first write there
+    if O_DIRECT is None:
+        return False
+
+    try:
+        close(os_open(target, O_RDWR | O_DIRECT))
+        return True
+    except OSError:
+        return False
+
+
+def progress_line(name):
+    def report(percent, rate, eta):
+        line = "\r{}: {:5.1f}% {:8.1f} MB/s ETA {:4.0f}s ".format(name, percent, rate, eta)
+        print(line, end="\n" if percent == 100 else "", file=stderr, flush=True)
+
+    return report
+
+
+def convert(args, size, env=None, progress=None):
+    # runs qemu-img convert -p, size is the bytes it is expected to write, for the MB/s, returns the seconds it took
+    start = monotonic()
+    reported = -1
+
+    # qemu-img -p rewrites a line like "    (12.34/100%)" on its stdout
+    with Popen(args, stdout=PIPE, env=env) as process:
+        output = b""
+
+        while True:
+            chunk = process.stdout.read1(256)
+
+            if not chunk:
+                break
+
+            output = (output + chunk)[-64:]
+            updates = output.replace(b"\r", b"\n").split(b"\n")
+
+            for update in reversed(updates):
+                if update.strip().startswith(b"(") and b"/100%)" in update:
+                    percent = float(update.strip()[1:].split(b"/")[0])
+                    break
+            else:
+                continue
+
+            elapsed = monotonic() - start
+
+            if progress and int(percent) != reported and percent < 100 and elapsed > 0:
+                reported = int(percent)
+                progress(percent, size * percent / 100 / MIB / elapsed, elapsed * (100 - percent) / percent if percent else 0)
+
+        if process.wait():
+            raise CalledProcessError(process.returncode, args)
+
+    return monotonic() - start
+
+
+def copy(source, target, fmt=None, zeroed=False, coroutines=16, qemu_img=("qemu-img",), env=None, progress=None, stats=None):
+    # zeroed tells the target reads as zeroes, like a zvol or sparse file just created, so the zero extents are skipped,
+    # a missing target file is created sparse, progress is called with the percent, MB/s and ETA in seconds,
+    # the summary is returned and appended as a JSON line to stats, its expected bytes and MB/s come from the allocation map,
+    # qemu-img does not report what it wrote
+    extents = allocation_map(source, fmt, qemu_img, env)
+
+    created = not exists(target)
+
+    if created:
+        with open(target, "wb") as f:
+            f.truncate(extents["virtual_size"])
+
+        zeroed = True
+
+    direct = direct_io(target)
+    args = list(qemu_img) + ["convert", "-p", "-n", "-W", "-m", str(coroutines), "-O", "raw"] + (["-f", fmt] if fmt else [])
+    args += (["-t", "none"] if direct else []) + (["--target-is-zero"] if zeroed else []) + [source, target]
+    expected = extents["data"] if zeroed else extents["virtual_size"]
+
+    try:
+        seconds = convert(args, expected, env, progress)
+    except CalledProcessError:
+        if created:
+            unlink(target)
+
+        raise
+
+    summary = {
+        "time": int(time()),
+        "source": source,
+        "format": fmt,
+        "target": target,
+        "virtual_size": extents["virtual_size"],
+        "data": extents["data"],
+        "expected_written": expected,
+        "expected_skipped": extents["virtual_size"] - expected,
+        "seconds": round(seconds, 3),
+        "mb_s": round(expected / MIB / seconds, 1) if seconds else None,
+        "direct": direct,
+        "target_is_zero": zeroed,
+        "coroutines": coroutines,
+    }
+
+    if progress:
+        progress(100, summary["mb_s"] or 0, 0)
+
+    if stats:
+        with open(stats, "a") as f:
+            f.write(dumps(summary) + "\n")
+
+    return summary
+
+
+def export(source, output, fmt=None, coroutines=16, qemu_img=("qemu-img",), env=None, progress=None, stats=None):
+    # a qcow2 compressed with zstd by the coroutines of qemu-img, which compress in a pool of threads and skip the holes,
+    # the summary holds the allocated and compressed sizes and the seconds of each step
+    seconds = {}
+    start = monotonic()
+
+    if fmt == "raw":
+        virtual_size, allocated = getsize(source), sum(length for _, length in data_extents(source))
+    else:
+        extents = allocation_map(source, fmt, qemu_img, env)
+        virtual_size, allocated = extents["virtual_size"], extents["data"]
+
+    seconds["scan"] = monotonic() - start
+    tmp = "{}.tmp".format(output)
+    args = list(qemu_img) + ["convert", "-p", "-W", "-m", str(coroutines), "-c"] + (["-f", fmt] if fmt else [])
+    args += ["-O", "qcow2", "-o", "compression_type=zstd", source, tmp]
+
+    try:
+        seconds["convert"] = convert(args, allocated, env, progress)
+    except CalledProcessError:
+        if exists(tmp):
+            unlink(tmp)
+
+        raise
+
+    rename(tmp, output)
+    size = getsize(output)
+    summary = {
+        "time": int(time()),
+        "source": source,
+        "format": fmt,
+        "target": output,
+        "virtual_size": virtual_size,
+        "allocated": allocated,
+        "size": size,
+        "ratio": round(allocated / size, 2) if size else None,
+        "seconds": {step: round(value, 3) for step, value in seconds.items()},
+        "coroutines": coroutines,
+    }
+
+    if progress:
+        progress(100, allocated / MIB / seconds["convert"] if seconds["convert"] else 0, 0)
+
+    if stats:
+        with open(stats, "a") as f:
+            f.write(dumps(summary) + "\n")
+
+    return summary
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Copy a disk image to a raw zvol, device or file, skipping what reads as zeroes")
+    parser.add_argument("-f", "--format", help="format of the source (default: probed by qemu-img)")
+    parser.add_argument("-e", "--export", action="store_true", help="write a zstd compressed qcow2 to target instead")
+    parser.add_argument("-z", "--zeroed", action="store_true", help="the target already reads as zeroes, like a zvol just created")
+    parser.add_argument("-m", "--coroutines", type=int, default=16, help="parallel qemu-img coroutines (default: 16)")
+    parser.add_argument("-s", "--stats", help="JSON lines file the bytes expected to be written and skipped are appended to")
+    parser.add_argument("-q", "--quiet", action="store_true", help="no progress")
+    parser.add_argument("source")
+    parser.add_argument("target", help="a missing file is created sparse")
+    args = parser.parse_args()
+
+    qemu_img = (environ.get("QEMU_IMG", "qemu-img"),)
+    progress = None if args.quiet else progress_line(args.target)
+
+    if args.export:
+        result = export(args.source, args.target, args.format, args.coroutines, qemu_img, progress=progress, stats=args.stats)
+        print(
+            "{target}: {allocated} of {virtual_size} bytes allocated, {size} compressed, {ratio}:1, scan {scan:.1f}s, convert {convert:.1f}s".format(
+                **result, **result["seconds"]
+            ),
+            file=stderr,
+        )
+    else:
+        result = copy(args.source, args.target, args.format, args.zeroed, args.coroutines, qemu_img, progress=progress, stats=args.stats)
+        print(
+            "{target}: {expected_written} of {virtual_size} bytes to write, {expected_skipped} skipped, in {seconds:.1f}s at {mb_s} MB/s".format(
+                **result
+            ),
+            file=stderr,
+        )
@@ -1,20 +1,173 @@
 #!/usr/bin/env python3
 
+import argparse
+import asyncio
+import base64
+import configparser
+import fcntl
+import gzip
 import hashlib
+import ipaddress
+import json
 import logging
 import os
 import re
+import shlex
 import shutil
+import signal
+import socket
+import struct
 import subprocess
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from functools import lru_cache
+
+# EASY_QEMU_TRACE=json appends the spans of every launch to trace.jsonl in the runtime dir,
+# EASY_QEMU_TRACE=chrome writes them to trace.json in the Chrome trace event format (chrome://tracing, ui.perfetto.dev)
+TRACE = os.environ.get("EASY_QEMU_TRACE")
+TRACE_SPANS = []
+
+# first fd number handed to qemu for the pre-created taps
+TAP_FD_BASE = 10
+
+# comment prefix of the firewall rules, followed by the bridge or tap the rule belongs to
+FIREWALL_COMMENT = "easy-qemu:"
+FIREWALL_IFACE_MATCHER = re.compile(r"(br|tap)-[0-9a-f]{8}")
+
+# runtime dirs of the VMs, /var/run/qemu-<id>
+RUNTIME_MATCHER = re.compile(r"qemu-[0-9a-f]{8}")
+
+# {hdd} options, profiles are named sets of options
+HDD_OPTIONS = ("aio", "cache.direct", "discard", "detect-zeroes", "l2-cache-size")
+HDD_PROFILES = {
+    "fast": {"aio": "io_uring", "cache.direct": "on", "discard": "unmap", "detect-zeroes": "unmap"},
+    "native": {"aio": "native", "cache.direct": "on", "discard": "unmap", "detect-zeroes": "unmap"},
+}
+
+# {mem} options
+MEM_OPTIONS = ("hugepages", "prealloc", "private", "file", "numa", "nodes")
+
+# host cpus owned by the pinned VMs, keyed by their runtime dir
+PIN_TABLE = "/var/run/easy-qemu-pins.json"
+
+# exported metrics, the counters of query-blockstats and of the tap seen from the host: QMP has no netdev counters,
+# they are read from sysfs, and the rx of the tap is the tx of the guest and the other way around
+METRICS_BLOCK = {
+    "rd_bytes": "qemu_block_read_bytes_total",
+    "wr_bytes": "qemu_block_write_bytes_total",
+    "rd_operations": "qemu_block_read_operations_total",
+    "wr_operations": "qemu_block_write_operations_total",
+    "flush_operations": "qemu_block_flush_operations_total",
+    "rd_total_time_ns": "qemu_block_read_time_ns_total",
+    "wr_total_time_ns": "qemu_block_write_time_ns_total",
+}
+METRICS_NET = ("rx_bytes", "tx_bytes", "rx_packets", "tx_packets", "rx_dropped", "tx_dropped")
+
+# the balloon device of {defaults}, its guest stats are polled once {balloon} is given
+BALLOON_QOM_PATH = "/machine/peripheral/balloon0"
+KSM_DIR = "/sys/kernel/mm/ksm"
+
+# seconds given to qemu to exit once asked to quit, before stop or kill give up
+QUIT_TIMEOUT = 10
+
+# marker printed on the serial console by the init of the bench initramfs
+BENCH_READY = "easy-qemu-bench-ready"
+BENCH_INITRAMFS = "/var/run/easy-qemu-bench.cpio.gz"
+
+SIZE_SUFFIXES = {"K": 1024, "M": 1048576, "G": 1073741824, "T": 1099511627776}
+
+# qcow2 v3 header, see docs/interop/qcow2.txt in the qemu sources
+QCOW2_HEADER_LENGTH = 112
+QCOW2_EXT_BACKING_FORMAT = 0xE2792ACA
+QCOW2_INCOMPAT_COMPRESSION = 1 << 3
+QCOW2_INCOMPAT_EXTL2 = 1 << 4
+QCOW2_COMPRESSION_TYPES = {"zlib": 0, "zstd": 1}
+QCOW2_MAX_L1_SIZE = 32 * 1048576
+
+# linux/netlink.h, linux/rtnetlink.h, linux/if_link.h, linux/if_addr.h
+NLMSG_ERROR = 2
+NLM_F_REQUEST = 0x1
+NLM_F_ACK = 0x4
+NLM_F_EXCL = 0x200
+NLM_F_CREATE = 0x400
+RTM_NEWLINK = 16
+RTM_NEWADDR = 20
+IFLA_ADDRESS = 1
+IFLA_IFNAME = 3
+IFLA_MASTER = 10
+IFLA_LINKINFO = 18
+IFLA_INFO_KIND = 1
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+IFF_UP = 0x1
+
+# linux/if_tun.h
+TUNSETIFF = 0x400454CA
+IFF_TAP = 0x0002
+IFF_NO_PI = 0x1000
+IFF_VNET_HDR = 0x4000
+IFF_MULTI_QUEUE = 0x0100
 
 
 def exec(args, *, check=True, **kwargs):
-    result = subprocess.run(args, check=check, **kwargs)
+    with trace_span("exec " + os.path.basename(args[0]), command=" ".join(args)) as span:
+        result = subprocess.run(args, check=check, **kwargs)
+        span["returncode"] = result.returncode
+
     LOG.info("Executed: %s", " ".join(args))
     return result
 
 
+def trace_add(name, start, duration, **args):
+    # start is a time.monotonic() value, the spans with a "runtime" arg belong to that VM only
+    if TRACE:
+        TRACE_SPANS.append({"name": name, "start": start, "duration": duration, "thread": threading.get_native_id(), "args": args})
+
+
+@contextmanager
+def trace_span(name, **args):
+    # the args can be completed within the span, like the exit code of a command
+    start = time.monotonic()
+
+    try:
+        yield args
+    finally:
+        trace_add(name, start, time.monotonic() - start, **args)
+
+
+def trace_launch(name, runtime, started, elapsed):
+    # qemu writes its pidfile before daemonizing, its mtime tells when
+    trace_add("qemu", started, elapsed, runtime=runtime, vm=name)
+
+    try:
+        written = os.stat("{}/process.pid".format(runtime)).st_mtime - time.time() + time.monotonic()
+    except (FileNotFoundError, TypeError):
+        return
+
+    trace_add("pidfile", started, max(0, written - started), runtime=runtime)
+
+
+def trace_write(runtime):
+    offset = time.time() - time.monotonic()
+    spans = [span for span in TRACE_SPANS if span["args"].get("runtime") in (None, runtime)]
+
+    if TRACE == "chrome":
+        events = [
+            {"name": span["name"], "ph": "X", "ts": (span["start"] + offset) * 1e6, "dur": span["duration"] * 1e6, "pid": os.getpid(), "tid": span["thread"], "args": span["args"]}
+            for span in spans
+        ]
+
+        with open("{}/trace.json".format(runtime), "w") as trace_fd:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, trace_fd)
+    else:
+        with open("{}/trace.jsonl".format(runtime), "a") as trace_fd:
+            for span in spans:
+                trace_fd.write(json.dumps(dict(span, start=span["start"] + offset, pid=os.getpid())) + "\n")
+
+
 def getLogger(name, level):
     class IndentFormatter(logging.Formatter):
         def format(self, record):
@@ -44,6 +197,33 @@ def macgen(seed):
     return "02:00:" + ":".join([id[i : i + 2] for i in range(0, len(id), 2)])
 
 
+def macro_agent(env=None):
+    if "agent" in env:
+        return ()
+
+    env["agent"] = "{}/agent.sock".format(env["runtime"])
+    return (
+        "-device",
+        "virtio-serial-pci",
+        "-chardev",
+        "socket,id={{id,char}},path={},server,nowait".format(env["agent"]),
+        "-device",
+        "virtserialport,chardev={id,char,1},name=org.qemu.guest_agent.0",
+    )
+
+
+def macro_balloon(interval=None, env=None):
+    # the guest hands the pages it frees back to the host and deflates the balloon before it runs out of memory,
+    # the guest memory stats driving the balloon command are polled every interval seconds once qemu is running
+    env["balloon"] = 5 if interval is None else int(interval)
+    return qmp_socket(env) + (
+        "-global",
+        "virtio-balloon-pci.free-page-reporting=on",
+        "-global",
+        "virtio-balloon-pci.deflate-on-oom=on",
+    )
+
+
 def macro_br(cidr, env=None):
     if "networks" not in env:
         env["networks"] = {}
@@ -67,7 +247,9 @@ def macro_cpu(cores=None, threads=None, sockets=None, env=None):
     cores = 2 if cores is None else int(cores)
     threads = 1 if threads is None else int(threads)
     sockets = 1 if sockets is None else int(sockets)
-    return "-smp", "{},sockets={},cores={},threads={}".format(cores * threads * sockets, cores, threads, sockets)
+    env["cpus"] = cores * threads * sockets
+    env["topology"] = sockets, cores, threads
+    return "-smp", "{},sockets={},cores={},threads={}".format(cores * threads * sockets, sockets, cores, threads)
 
 
 def macro_defaults(env=None):
@@ -86,7 +268,7 @@ def macro_defaults(env=None):
         "-device",
         "virtio-rng-pci,rng={id,obj,1}",
         "-device",
-        "virtio-balloon-pci",
+        "virtio-balloon-pci,id=balloon0",
         "-pidfile",
         "{}/process.pid".format(env["runtime"]),
         "-daemonize",
@@ -95,26 +277,72 @@ def macro_defaults(env=None):
     )
 
 
-def macro_hdd(file, size_gb=None, snap=None, env=None):
+def macro_hdd(file, size_gb=None, snap=None, *options, env=None):
     if "hdds" not in env:
         env["hdds"] = {}
 
     size_gb = 20 if size_gb is None else int(size_gb)
 
-    if snap == "snap":
-        snap, ext = os.path.splitext(file)
-        snap += "-{}{}".format(idgen(file + env["id"]), ext)
-    else:
-        snap = False
+    if snap not in (None, "snap"):
+        raise ValueError("Invalid hdd snapshot field: {}, use snap or leave it empty, the options follow it like {{hdd,file,size,,fast}}".format(snap))
+
+    snap = hdd_snap(file, env["id"]) if snap == "snap" else False
 
     env["hdds"][file] = (size_gb, snap)
+    opts = {}
 
-    return (
+    for option in options:
+        if option is None:
+            continue
+
+        if option in HDD_PROFILES:
+            opts.update(HDD_PROFILES[option])
+            continue
+
+        key, sep, value = option.partition("=")
+
+        if not sep or key not in HDD_OPTIONS:
+            raise ValueError("Invalid hdd option: {}, use a profile ({}) or one of: {}".format(option, ", ".join(HDD_PROFILES), ", ".join(HDD_OPTIONS)))
+
+        opts[key] = value
+
+    if opts.get("aio") == "native":
+        opts.setdefault("cache.direct", "on")
+
+    if opts.get("detect-zeroes") == "unmap":
+        opts.setdefault("discard", "unmap")
+
+    if "l2-cache-size" not in opts:
+        l2_cache_size = hdd_l2_cache_size(snap if snap and os.path.exists(snap) else file, size_gb)
+
+        if l2_cache_size is not None:
+            opts["l2-cache-size"] = l2_cache_size
+
+    LOG.info("Disk %s: %s", snap if snap else file, ", ".join("{}={}".format(k, v) for k, v in opts.items()))
+    format_opts = [k + "=" + opts[k] for k in ("discard", "detect-zeroes", "l2-cache-size", "cache.direct") if k in opts]
+    file_opts = ["file." + k + "=" + opts[k] for k in ("aio", "cache.direct", "discard") if k in opts]
+
+    args = [
         "-blockdev",
-        "qcow2,node-name={{id,block}},file.driver=file,file.filename={}".format(snap if snap else file),
-        "-device",
-        "virtio-blk-pci,drive={id,block,1},{id,bootindex=,1}",
-    )
+        ",".join(
+            ["qcow2", "node-name={id,block}"] + format_opts + ["file.driver=file", "file.filename={}".format(snap if snap else file)] + file_opts
+        ),
+    ]
+    device = "virtio-blk-pci,drive={{id,block,1}},num-queues={},{{id,bootindex=,1}}".format(vcpus(env))
+    iothread = hdd_iothread(env)
+
+    if iothread is not None:
+        iothread, new = iothread
+        device += ",iothread={}".format(iothread)
+
+        if new:
+            args.extend(["-object", "iothread,id={}".format(iothread)])
+
+    return args + ["-device", device]
+
+
+def macro_snap(file, size_gb=None, env=None):
+    return ("{},{},snap".format(file, "" if size_gb is None else size_gb),)
 
 
 def macro_id(name, inc=None, init=None, env=None):
@@ -125,6 +353,18 @@ def macro_id(name, inc=None, init=None, env=None):
     return ("{}{}".format(name, current),)
 
 
+def macro_iothreads(policy=None, env=None):
+    # "disk" gives every following {hdd} its own iothread, N shares a pool of N iothreads round-robin, "off" disables them
+    if policy is None or policy in ("disk", "off"):
+        env["iothreads_policy"] = policy or "disk"
+    elif int(policy) > 0:
+        env["iothreads_policy"] = int(policy)
+    else:
+        raise ValueError("Invalid iothreads policy: {}".format(policy))
+
+    return ()
+
+
 def macro_mac(env=None):
     if "macs" not in env:
         env["macs"] = {}
@@ -134,14 +374,114 @@ def macro_mac(env=None):
     return (mac,)
 
 
+def macro_mem(size, *options, env=None):
+    # {mem,size[,hugepages[=2M|1G]][,prealloc][,private][,file[=path]][,numa=N][,nodes=0:1]}
+    opts = {}
+
+    for option in options:
+        if option is None:
+            continue
+
+        key, _, value = option.partition("=")
+
+        if key not in MEM_OPTIONS:
+            raise ValueError("Invalid mem option: {}, use one of: {}".format(option, ", ".join(MEM_OPTIONS)))
+
+        opts[key] = value
+
+    total = parse_size(size, 1048576)
+    numa = int(opts.get("numa") or 1)
+    nodes = parse_nodes(opts["nodes"]) if opts.get("nodes") else []
+    cpus = vcpus(env)
+
+    # the vcpus are split between the nodes, their count is only known once {cpu} was expanded
+    if numa > 1 and "cpus" not in env:
+        raise ValueError("{mem,...,numa=N} has to follow {cpu}, the vcpus are split between the nodes")
+
+    if not 1 <= numa <= cpus:
+        raise ValueError("Invalid numa node count: {}, every node needs at least one of the {} vcpus".format(numa, cpus))
+
+    backend = ["share={}".format("off" if "private" in opts else "on")]
+    pagesize = None
+
+    if "hugepages" in opts:
+        pagesize = parse_size(opts["hugepages"], 1) if opts["hugepages"] else hugepages_default()
+
+    if "file" in opts:
+        if opts["file"]:
+            path = opts["file"]
+        else:
+            # the hugetlbfs mount found gives the page size, checked like the one of hugepages=
+            path, pagesize = hugepages_mount(pagesize)
+
+        if path is None:
+            raise ValueError("No hugetlbfs mount found{}".format("" if pagesize is None else " for {}k pages".format(pagesize // 1024)))
+
+        backend_type = "memory-backend-file"
+        backend.append("mem-path={}".format(path))
+    else:
+        backend_type = "memory-backend-memfd"
+
+        if pagesize is not None:
+            backend.extend(["hugetlb=on", "hugetlbsize={}".format(pagesize)])
+
+    if "prealloc" in opts:
+        backend.extend(["prealloc=on", "prealloc-threads={}".format(cpus)])
+
+    args = ["-m", "{}M".format(total // 1048576)]
+    requirements = {}
+    env["host_nodes"] = nodes
+
+    # the nodes get a whole number of pages, or of MiB, the last one the rest
+    align = pagesize or 1048576
+    share = total // numa // align * align
+
+    if share == 0:
+        raise ValueError("The memory of {} is too small for {} nodes of {}k pages".format(size, numa, align // 1024))
+
+    for node in range(numa):
+        node_size = share if node < numa - 1 else total - share * (numa - 1)
+        node_backend = ["{},id=mem{},size={}".format(backend_type, node, node_size)] + backend
+
+        if nodes:
+            host_node = nodes[node % len(nodes)]
+            node_backend.extend(["host-nodes={}".format(host_node), "policy=bind"])
+        else:
+            host_node = None
+
+        if pagesize is not None:
+            if node_size % pagesize:
+                raise ValueError("The memory of node {} is not a multiple of the {}k page size".format(node, pagesize // 1024))
+
+            key = (host_node, pagesize)
+            requirements[key] = requirements.get(key, 0) + node_size // pagesize
+
+        numa_node = "node,nodeid={},memdev=mem{}".format(node, node)
+
+        # a single node gets all the vcpus of qemu
+        if numa > 1:
+            node_cpus = range(node * cpus // numa, (node + 1) * cpus // numa)
+            numa_node += ",cpus={}-{}".format(node_cpus[0], node_cpus[-1])
+
+        args.extend(["-object", ",".join(node_backend), "-numa", numa_node])
+
+    if requirements:
+        env["hugepages"] = [[host_node, pagesize, pages] for (host_node, pagesize), pages in requirements.items()]
+        hugepages_check(env["hugepages"])
+
+    return args
+
+
 def macro_monitor(env=None):
     if "monitor" in env:
         return ()
 
     env["monitor"] = True
     monitor = "{}/monitor.sock".format(env["runtime"])
+    qmp = qmp_socket(env)
     log_hint("You can connect to the qemu monitor using: minicom -D unix#%s", monitor, env=env)
-    return ("-chardev", "socket,id={{id,char}},path={},server,nowait".format(monitor), "-mon", "chardev={id,char,1}")
+    log_hint("You can connect to the qemu QMP socket using: socat - unix:%s", env["qmp"], env=env)
+    return ("-chardev", "socket,id={{id,char}},path={},server,nowait".format(monitor), "-mon", "chardev={id,char,1}") + qmp
 
 
 def macro_net(br, env=None):
@@ -151,15 +491,27 @@ def macro_net(br, env=None):
     seed = env["id"] + br + str(len(env["taps"]))
     tap = "tap-" + idgen(seed)
     mac = macgen(seed)
-    ifup = "/dev/shm/{}-up.sh".format(tap)
-    ifdown = "/dev/shm/{}-down.sh".format(tap)
-    env["taps"][tap] = br, mac, ifup, ifdown
-    return (
-        "-netdev",
-        "tap,id={{id,net}},ifname={},script={},downscript={}".format(tap, ifup, ifdown),
-        "-device",
-        "virtio-net-pci,netdev={id,net,1},mac={mac}",
-    )
+    # one queue per vcpu, every queue is a fd of the same multiqueue tap
+    queues = vcpus(env)
+    fds = [TAP_FD_BASE + env.get("tap_fds", 0) + i for i in range(queues)]
+    env["tap_fds"] = env.get("tap_fds", 0) + queues
+    env["taps"][tap] = br, mac, fds
+    netdev = "tap,id={id,net}," + ("fd={}".format(fds[0]) if queues == 1 else "fds={}".format(":".join(map(str, fds))))
+    device = "virtio-net-pci,netdev={id,net,1},mac={mac}"
+
+    if queues > 1:
+        device += ",mq=on,vectors={}".format(2 * queues + 2)
+
+    if os.access("/dev/vhost-net", os.R_OK | os.W_OK):
+        netdev += ",vhost=on"
+
+    return "-netdev", netdev, "-device", device
+
+
+def macro_pin(env=None):
+    # the host cpus are allocated by the pin prepare step and the threads are pinned once qemu is running
+    env["pin"] = True
+    return qmp_socket(env)
 
 
 def macro_runtime(env=True):
@@ -183,6 +535,13 @@ def macro_serial(env=None):
     )
 
 
+def macro_warm(template, env=None):
+    # the VM resumes the state saved by the template command instead of booting,
+    # its arguments have to describe the same machine as the template
+    env["warm"] = template
+    return qmp_socket(env) + ("-incoming", "defer")
+
+
 def macro_video(driver=None, env=None):
     if "video" in env:
         return ()
@@ -246,190 +605,2097 @@ def macro_video(driver=None, env=None):
         return ("-nographic",)
 
 
-def prepare(env):
-    os.makedirs(env["runtime"], exist_ok=True)
+def hdd_iothread(env):
+    # the iothread of the next disk and whether it is a new one, following the {iothreads} policy
+    policy = env.get("iothreads_policy", "disk")
 
-    if "networks" in env:
-        with open("/proc/net/route", "r") as route_fd:
-            gw = next(line[0] for line in map(str.split, iter(route_fd.readline, "")) if line[1] == "00000000" and line[7] == "00000000")
+    if policy == "off":
+        return None
 
-        for br, net in env["networks"].items():
-            cidr, mac = net
+    if "iothreads" not in env:
+        env["iothreads"] = []
+        env["iothread_disks"] = 0
 
-            try:
-                exec(["brctl", "addbr", br], capture_output=True)
-            except subprocess.CalledProcessError as exc:
-                err = exc.stderr.decode().strip()
+    disk = env["iothread_disks"]
+    env["iothread_disks"] += 1
+    idx = disk if policy == "disk" else disk % policy
 
-                if err.startswith("device {} already exists".format(br)):
-                    continue
+    if idx < len(env["iothreads"]):
+        return env["iothreads"][idx], False
 
-                raise
+    env["iothreads"].append("iothread{}".format(idx))
+    return env["iothreads"][idx], True
 
-            exec(["ip", "addr", "add", cidr, "dev", br])
-            exec(["ip", "link", "set", br, "up", "address", mac])
-            exec(["iptables", "-t", "nat", "-A", "POSTROUTING", "-s", cidr, "-o", gw, "-j", "MASQUERADE"])
-            exec(["iptables", "-A", "FORWARD", "-o", br, "-m", "conntrack", "--ctstate", "ESTABLISHED,RELATED", "-j", "ACCEPT"])
-            # exec(["iptables", "-A", "FORWARD", "-i", gw, "-o", br, "-m", "conntrack", "--ctstate", "ESTABLISHED,RELATED", "-j", "ACCEPT"])
-            exec(["iptables", "-A", "FORWARD", "-i", br, "-j", "ACCEPT"])
 
-    if "taps" in env:
-        with open("/etc/qemu-ifup", "r") as ifup_fd:
-            ifup_orig = ifup_fd.read()
+def hdd_l2_cache_size(file, size_gb):
+    # enough L2 cache to hold the mapping of the whole virtual disk, images that do not exist yet are created
+    # with the size of the macro and the default cluster size
+    if os.path.exists(file):
+        size, cluster_size, extended_l2 = qcow2_info(file)
+    else:
+        size, cluster_size, extended_l2 = size_gb * 1073741824, 65536, False
 
-        with open("/etc/qemu-ifdown", "r") as ifdown_fd:
-            ifdown_orig = ifdown_fd.read()
+    if cluster_size is None:
+        return None
 
-        switch_matcher = re.compile(r"^switch=.*?\n\n", re.M | re.S)
+    l2_cache_size = -(-size // cluster_size) * (16 if extended_l2 else 8)
+    return str(max(-(-l2_cache_size // cluster_size), 2) * cluster_size)
 
-        for tap, tap_info in env["taps"].items():
-            br, mac, ifup, ifdown = tap_info
-            script = ifup_orig.replace('ip link set "$1" up', 'ip link set "$1" up address {}'.format(mac))
-            script = switch_matcher.sub("switch={}\n\n".format(br), script)
-            script = script.replace(
-                "        exit	# exit with status of the previous command",
-                "".join(
-                    [
-                        "        iptables -A FORWARD -i {0} -o {0} -m physdev --physdev-out {1} -j ACCEPT",
-                        "\n        iptables -A FORWARD -i {0} -o {0} -m physdev --physdev-in {1} -j ACCEPT",
-                        "\n        exit",
-                    ]
-                ).format(br, tap),
-            )
 
-            with open(ifup, "w") as ifup_fd:
-                ifup_fd.write(script)
-
-            with open(ifdown, "w") as ifdown_fd:
-                ifdown_fd.write(
-                    "".join(
-                        [
-                            ifdown_orig,
-                            "iptables -D FORWARD -i {0} -o {0} -m physdev --physdev-out {1} -j ACCEPT\n",
-                            "iptables -D FORWARD -i {0} -o {0} -m physdev --physdev-in {1} -j ACCEPT\n",
-                        ]
-                    ).format(br, tap)
-                )
+def hdd_snap(file, vm_id):
+    # the overlay of a VM over the file, next to it
+    snap, ext = os.path.splitext(file)
+    return "{}-{}{}".format(snap, idgen(file + vm_id), ext)
 
-            os.chmod(ifup, 0o700)
-            os.chmod(ifdown, 0o700)
 
-    if "hdds" in env:
-        for file, hdd in env["hdds"].items():
-            size_gb, snap = hdd
+def parse_nodes(value, separator=":"):
+    # "0:2-3" -> [0, 2, 3], the sysfs cpu lists use "," as separator
+    nodes = []
 
-            if not os.path.exists(file):
-                exec(["qemu-img", "create", "-f", "qcow2", file, str(size_gb) + "G"])
+    for part in value.split(separator):
+        first, _, last = part.partition("-")
+        nodes.extend(range(int(first), int(last or first) + 1))
 
-            if snap and not os.path.exists(snap):
-                exec(["qemu-img", "create", "-f", "qcow2", "-b", file, "-F", "qcow2", snap])
+    return nodes
 
 
-def process_arg0(env, arg):
-    prefix = "easy-"
-    executable = os.path.basename(arg)
+def parse_size(value, unit):
+    # "2048" in the given unit, or with a K, M, G or T suffix
+    suffix = value[-1:].upper()
 
-    if executable.startswith(prefix):
-        executable, _ = os.path.splitext(executable[len(prefix) :])
-        return [shutil.which(executable), executable]
-    else:
-        return [arg]
+    if suffix in SIZE_SUFFIXES:
+        return int(float(value[:-1]) * SIZE_SUFFIXES[suffix])
 
+    return int(value) * unit
 
-def process_args(args: list, env):
-    idx = 0
+
+def qcow2_create(file, size=None, backing_file=None, backing_fmt=None, cluster_size=65536, extended_l2=False, compression_type="zlib"):
+    # writes an empty qcow2 v3 image: header and extensions in cluster 0, followed by the refcount table,
+    # the refcount blocks and the L1 table, all L2 tables are unallocated
+    cluster_bits = cluster_size.bit_length() - 1
+
+    if cluster_size != 1 << cluster_bits or not 9 <= cluster_bits <= 21:
+        raise ValueError("Invalid cluster size: {}".format(cluster_size))
+
+    if extended_l2 and cluster_bits < 14:
+        raise ValueError("Extended L2 entries need a cluster size of at least 16k")
+
+    if compression_type not in QCOW2_COMPRESSION_TYPES:
+        raise ValueError("Unsupported compression type: {}".format(compression_type))
+
+    if size is None:
+        if backing_file is None:
+            raise ValueError("The size is required without a backing file")
+
+        size, _, _ = qcow2_info(os.path.join(os.path.dirname(file), backing_file))
+
+    size = -(-size // 512) * 512
+    l1_size = -(-size // (cluster_size * (cluster_size // (16 if extended_l2 else 8))))
+    l1_clusters = -(-l1_size * 8 // cluster_size)
+
+    if l1_size * 8 > QCOW2_MAX_L1_SIZE:
+        raise ValueError("The L1 table of {} entries is too large".format(l1_size))
+    rt_clusters, rb_clusters = 1, 1
 
     while True:
+        total = 1 + rt_clusters + rb_clusters + l1_clusters
+        needed_rb = -(-total // (cluster_size // 2))
+        needed_rt = -(-needed_rb * 8 // cluster_size)
+
+        if (needed_rt, needed_rb) == (rt_clusters, rb_clusters):
+            break
+
+        rt_clusters, rb_clusters = needed_rt, needed_rb
+
+    rt_offset = cluster_size
+    rb_offset = rt_offset + rt_clusters * cluster_size
+    l1_offset = rb_offset + rb_clusters * cluster_size
+
+    extensions = b""
+
+    if backing_fmt is not None:
+        extensions += struct.pack(">II", QCOW2_EXT_BACKING_FORMAT, len(backing_fmt)) + backing_fmt.encode()
+        extensions += b"\0" * (-len(extensions) % 8)
+
+    extensions += struct.pack(">II", 0, 0)
+    backing = b"" if backing_file is None else backing_file.encode()
+
+    if QCOW2_HEADER_LENGTH + len(extensions) + len(backing) > cluster_size:
+        raise ValueError("The header does not fit in a cluster of {} bytes".format(cluster_size))
+
+    incompatible = 0
+
+    if compression_type != "zlib":
+        incompatible |= QCOW2_INCOMPAT_COMPRESSION
+
+    if extended_l2:
+        incompatible |= QCOW2_INCOMPAT_EXTL2
+
+    header = struct.pack(
+        ">4sIQIIQIIQQIIQQQQIIB7x",
+        b"QFI\xfb",
+        3,
+        QCOW2_HEADER_LENGTH + len(extensions) if backing else 0,
+        len(backing),
+        cluster_bits,
+        size,
+        0,
+        l1_size,
+        l1_offset,
+        rt_offset,
+        rt_clusters,
+        0,
+        0,
+        incompatible,
+        0,
+        0,
+        4,
+        QCOW2_HEADER_LENGTH,
+        QCOW2_COMPRESSION_TYPES[compression_type],
+    )
+    refcount_table = struct.pack(">{}Q".format(rb_clusters), *(rb_offset + i * cluster_size for i in range(rb_clusters)))
+    refcount_blocks = struct.pack(">{}H".format(total), *([1] * total))
+
+    with open(file, "xb") as image_fd:
         try:
-            arg = args[idx]
-        except IndexError:
-            return
+            image_fd.write(header + extensions + backing)
+            image_fd.seek(rt_offset)
+            image_fd.write(refcount_table)
+            image_fd.seek(rb_offset)
+            image_fd.write(refcount_blocks)
+            image_fd.truncate(total * cluster_size)
+        except Exception:
+            os.unlink(file)
+            raise
+
+
+def qcow2_image(file, size=None, **options):
+    try:
+        qcow2_create(file, size, **options)
+        LOG.info("Created: %s", file)
+        return
+    except FileExistsError:
+        raise
+    except (OSError, ValueError) as exc:
+        LOG.warning("Cannot create %s, falling back to qemu-img: %s", file, exc)
+
+    args = ["qemu-img", "create", "-f", "qcow2"]
+    create_options = ["{}={}".format(k, v) for k, v in options.items() if k in ("cluster_size", "compression_type")]
+
+    if options.get("extended_l2"):
+        create_options.append("extended_l2=on")
+
+    if create_options:
+        args.extend(["-o", ",".join(create_options)])
+
+    if options.get("backing_file") is not None:
+        args.extend(["-b", options["backing_file"], "-F", options.get("backing_fmt") or "raw"])
+
+    args.append(file)
+
+    if size is not None:
+        args.append(str(size))
+
+    exec(args)
+
+
+def qcow2_info(file):
+    # virtual size, cluster size and extended L2 flag of an image, raw images report their file size and no cluster size
+    with open(file, "rb") as image_fd:
+        header = image_fd.read(80)
+
+    if header[:4] != b"QFI\xfb":
+        return os.path.getsize(file), None, False
+
+    (version,) = struct.unpack_from(">I", header, 4)
+    (cluster_bits,) = struct.unpack_from(">I", header, 20)
+    (size,) = struct.unpack_from(">Q", header, 24)
+    incompatible = struct.unpack_from(">Q", header, 72)[0] if version >= 3 else 0
+    return size, 1 << cluster_bits, bool(incompatible & QCOW2_INCOMPAT_EXTL2)
+
+
+def qmp_socket(env):
+    if "qmp" in env:
+        return ()
+
+    env["qmp"] = "{}/qmp.sock".format(env["runtime"])
+    return ("-chardev", "socket,id={{id,char}},path={},server,nowait".format(env["qmp"]), "-mon", "chardev={id,char,1},mode=control")
+
+
+def vcpus(env):
+    # vcpu count of {cpu}, or the default of {cpu} when it was not given before
+    return env.get("cpus", 2)
+
+
+@lru_cache(maxsize=None)
+def default_gateway():
+    with trace_span("default gateway"), open("/proc/net/route", "r") as route_fd:
+        return next(line[0] for line in map(str.split, iter(route_fd.readline, "")) if line[1] == "00000000" and line[7] == "00000000")
+
+
+def prepare_runtime(runtime):
+    os.makedirs(runtime, exist_ok=True)
+
+
+def netlink(msg_type, flags, payload):
+    with socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE) as sock:
+        sock.bind((0, 0))
+        sock.send(struct.pack("=IHHII", 16 + len(payload), msg_type, flags | NLM_F_REQUEST | NLM_F_ACK, 1, 0) + payload)
+        reply = sock.recv(65536)
+
+    _, reply_type, _, _, _ = struct.unpack_from("=IHHII", reply)
+
+    if reply_type == NLMSG_ERROR:
+        (error,) = struct.unpack_from("=i", reply, 16)
+
+        if error:
+            raise OSError(-error, os.strerror(-error))
+
+
+def netlink_attr(attr_type, data):
+    length = 4 + len(data)
+    return struct.pack("=HH", length, attr_type) + data + b"\0" * (-length % 4)
+
+
+def netlink_link(ifname, flags=0, *attrs, msg_flags=0):
+    ifinfo = struct.pack("=BxHiII", socket.AF_UNSPEC, 0, 0, flags, flags)
+    netlink(RTM_NEWLINK, msg_flags, ifinfo + netlink_attr(IFLA_IFNAME, ifname.encode() + b"\0") + b"".join(attrs))
+
+
+def netlink_addr(ifname, cidr):
+    iface = ipaddress.ip_interface(cidr)
+    family = socket.AF_INET if iface.version == 4 else socket.AF_INET6
+    ifaddr = struct.pack("=BBBBI", family, iface.network.prefixlen, 0, 0, socket.if_nametoindex(ifname))
+    addr = iface.ip.packed
+    netlink(RTM_NEWADDR, NLM_F_CREATE | NLM_F_EXCL, ifaddr + netlink_attr(IFA_LOCAL, addr) + netlink_attr(IFA_ADDRESS, addr))
+
+
+def firewall_apply(changes):
+    # changes are (action, table, rule) tuples, applied atomically per table
+    tables = {}
+
+    for action, table, rule in changes:
+        tables.setdefault(table, []).append("{} {}\n".format(action, " ".join(map(firewall_quote, rule))))
+
+    batch = "".join("*{}\n{}COMMIT\n".format(table, "".join(lines)) for table, lines in tables.items())
+    LOG.debug("Firewall changes:\n%s", batch.strip())
+    exec(["iptables-restore", "--noflush"], input=batch.encode())
+
+
+def firewall_ifaces(rule):
+    # interfaces referenced by a rule, including the one named in an easy-qemu comment
+    ifaces = []
+
+    for option, value in zip(rule, rule[1:]):
+        if option in ("-i", "-o", "--physdev-in", "--physdev-out"):
+            ifaces.append(value)
+        elif option == "--comment" and value.startswith(FIREWALL_COMMENT):
+            ifaces.append(value[len(FIREWALL_COMMENT) :])
+
+    return ifaces
+
+
+def firewall_key(table, rule):
+    # rules are compared without their comment so that rules added by older versions are recognized
+    key = list(rule)
+
+    while "comment" in key:
+        idx = key.index("comment")
+        del key[idx - 1 : idx + 3]
+
+    return table, tuple(key)
+
+
+def firewall_quote(token):
+    return '"{}"'.format(token.replace('"', '\\"')) if re.search(r"[\s\"']", token) else token
+
+
+def firewall_rules_network(br, cidr):
+    comment = ("-m", "comment", "--comment", FIREWALL_COMMENT + br)
+    return [
+        ("nat", ("POSTROUTING", "-s", str(ipaddress.ip_network(cidr, strict=False)), "-o", default_gateway()) + comment + ("-j", "MASQUERADE")),
+        ("filter", ("FORWARD", "-o", br, "-m", "conntrack", "--ctstate", "RELATED,ESTABLISHED") + comment + ("-j", "ACCEPT")),
+        # ("filter", ("FORWARD", "-i", gw, "-o", br, "-m", "conntrack", "--ctstate", "RELATED,ESTABLISHED") + comment + ("-j", "ACCEPT")),
+        ("filter", ("FORWARD", "-i", br) + comment + ("-j", "ACCEPT")),
+    ]
+
+
+def firewall_rules_tap(tap, br):
+    comment = ("-m", "comment", "--comment", FIREWALL_COMMENT + tap)
+    return [
+        ("filter", ("FORWARD", "-i", br, "-o", br, "-m", "physdev", "--physdev-out", tap) + comment + ("-j", "ACCEPT")),
+        ("filter", ("FORWARD", "-i", br, "-o", br, "-m", "physdev", "--physdev-in", tap) + comment + ("-j", "ACCEPT")),
+    ]
+
+
+def firewall_state():
+    rules = []
+    table = None
+
+    for line in exec(["iptables-save"], capture_output=True).stdout.decode().splitlines():
+        if line.startswith("*"):
+            table = line[1:]
+        elif line.startswith("-A "):
+            rules.append((table, tuple(shlex.split(line)[1:])))
+
+    return rules
+
+
+def firewall(rules):
+    # reconciles the ruleset with the desired rules: missing rules are appended, extra copies of a desired rule are deleted
+    current = {}
+
+    for table, rule in firewall_state():
+        current.setdefault(firewall_key(table, rule), []).append(rule)
+
+    changes = []
+
+    for table, rule in dict.fromkeys(rules):
+        existing = current.get(firewall_key(table, rule), [])
+
+        if not existing:
+            changes.append(("-A", table, rule))
+
+        for duplicate in existing[1:]:
+            changes.append(("-D", table, duplicate))
+
+    if not changes:
+        LOG.debug("Firewall is up to date")
+        return
+
+    firewall_apply(changes)
 
-        def handle_output(fn, arg, *macroargs):
-            nonlocal idx
-            newargs = fn(env, arg, *macroargs)
-            if len(newargs) == 0:
-                LOG.debug("Argument: %s -> removed", arg)
-                del args[idx]
-            elif len(newargs) == 1 and newargs[0] == arg:
-                idx += 1
-            else:
-                LOG.debug("Argument: %s -> %s", arg, newargs)
-                args[idx : idx + 1] = newargs
 
-        if idx == 0:
-            handle_output(process_arg0, arg)
-        elif arg == "-name":
-            handle_output(process_name, arg, args[idx + 1])
+def prepare_network(br, cidr, mac):
+    rules = firewall_rules_network(br, cidr)
+
+    try:
+        netlink_link(br, 0, netlink_attr(IFLA_LINKINFO, netlink_attr(IFLA_INFO_KIND, b"bridge")), msg_flags=NLM_F_CREATE | NLM_F_EXCL)
+    except FileExistsError:
+        return {"rules": rules}
+
+    LOG.info("Created bridge %s", br)
+    netlink_addr(br, cidr)
+    netlink_link(br, IFF_UP, netlink_attr(IFLA_ADDRESS, bytes.fromhex(mac.replace(":", ""))))
+    return {"rules": rules}
+
+
+def prepare_tap(tap, br, mac, fds):
+    flags = IFF_TAP | IFF_NO_PI | IFF_VNET_HDR | (IFF_MULTI_QUEUE if len(fds) > 1 else 0)
+    tuns = []
+
+    try:
+        for _ in fds:
+            tuns.append(os.open("/dev/net/tun", os.O_RDWR))
+            fcntl.ioctl(tuns[-1], TUNSETIFF, struct.pack("16sH22x", tap.encode(), flags))
+
+        netlink_link(
+            tap,
+            IFF_UP,
+            netlink_attr(IFLA_ADDRESS, bytes.fromhex(mac.replace(":", ""))),
+            netlink_attr(IFLA_MASTER, struct.pack("=I", socket.if_nametoindex(br))),
+        )
+    except Exception:
+        for tun in tuns:
+            os.close(tun)
+
+        raise
+
+    LOG.info("Created tap %s on %s with %d queues", tap, br, len(tuns))
+    return {"fds": {tap: tuns}, "rules": firewall_rules_tap(tap, br)}
+
+
+def hugepages_check(requirements):
+    # requirements are [host node or None, page size, pages] entries, a None node is checked against the whole host
+    for host_node, pagesize, pages in requirements:
+        if host_node is None:
+            path = "/sys/kernel/mm/hugepages/hugepages-{}kB/free_hugepages".format(pagesize // 1024)
         else:
-            handle_output(process_macro, arg)
+            path = "/sys/devices/system/node/node{}/hugepages/hugepages-{}kB/free_hugepages".format(host_node, pagesize // 1024)
 
+        try:
+            with open(path, "r") as free_fd:
+                free = int(free_fd.read())
+        except FileNotFoundError:
+            free = 0
+
+        if free < pages:
+            raise ValueError(
+                "Not enough free {}k hugepages{}: {} needed, {} free".format(
+                    pagesize // 1024, "" if host_node is None else " on node {}".format(host_node), pages, free
+                )
+            )
 
-def process_macro(env, arg):
-    match = env["matcher"].search(arg)
+        LOG.debug("Hugepages %dk%s: %d needed, %d free", pagesize // 1024, "" if host_node is None else " node {}".format(host_node), pages, free)
 
-    if match is None:
-        return [arg]
 
-    macro = match.group(0)
-    fields = env["unwrapper"](macro)
-    macrofn = env["macros"][fields[0]]
-    macroargs = [None if f == "" else f for f in fields[1:]]
-    newargs = list(macrofn(*macroargs, env=env))
+@lru_cache(maxsize=None)
+def hugepages_default():
+    with open("/proc/meminfo", "r") as meminfo_fd:
+        for line in meminfo_fd:
+            if line.startswith("Hugepagesize:"):
+                return int(line.split()[1]) * 1024
 
-    if len(newargs):
-        LOG.debug("Macro: %s -> %s -> newargs: %s", macro, newargs[0], newargs[1:])
-        newargs[0] = arg[: match.start()] + newargs[0] + arg[match.end() :]
-    else:
-        LOG.debug("Macro: %s -> removed", macro)
+    raise ValueError("Hugepages are not supported by the kernel")
 
-    return newargs
 
+def hugepages_mount(pagesize):
+    # the path and page size of the first hugetlbfs mount with the given page size, or of any size when it is None,
+    # mounts without a pagesize option use the default one
+    with open("/proc/mounts", "r") as mounts_fd:
+        for line in mounts_fd:
+            _, path, fstype, options = line.split()[:4]
 
-def process_name(env, arg, nextarg):
-    env["name"] = nextarg
-    env["id"] = idgen(nextarg)
-    env["runtime"] = "/var/run/qemu-{}".format(env["id"])
-    return [arg]
+            if fstype != "hugetlbfs":
+                continue
 
+            mount_pagesize = next((parse_size(o[9:], 1) for o in options.split(",") if o.startswith("pagesize=")), hugepages_default())
 
-def qemu_command(args):
-    env = {
-        "matcher": re.compile(r"{[^{}]+?}"),
-        "unwrapper": lambda match: match.lstrip("{").rstrip("}").split(","),
-        "macros": {
-            "cpu": macro_cpu,
-            "runtime": macro_runtime,
-            "id": macro_id,
-            "br": macro_br,
-            "hdd": macro_hdd,
-            "mac": macro_mac,
-            "net": macro_net,
-            "cd": macro_cd,
-            "serial": macro_serial,
-            "monitor": macro_monitor,
-            "video": macro_video,
-            "defaults": macro_defaults,
-        },
-    }
+            if pagesize is None or mount_pagesize == pagesize:
+                return path, mount_pagesize
 
-    args = args[:]
-    process_args(args, env)
-    prepare(env)
-    LOG.info("QEMU command: %s", "".join((" \\\n  " if a.startswith("-") else " ") + a for a in args).strip())
+    return None, pagesize
 
-    if "hints" in env:
-        for hint in env["hints"]:
-            log_args, log_kwargs = hint
-            LOG.info(*log_args, **log_kwargs)
 
-    os.execl(*args)
+def prepare_hugepages(name, requirements):
+    hugepages_check(requirements)
 
 
-if __name__ == "__main__":
-    LOG = getLogger(__name__, os.environ.get("LOGLEVEL", "INFO"))
+def host_cores():
+    # {(node, package, core): [cpus]} of the online host cpus, the cpus of a core are its smt siblings
+    with open("/sys/devices/system/cpu/online", "r") as online_fd:
+        online = parse_nodes(online_fd.read().strip(), ",")
+
+    nodes = {}
+
+    if os.path.isdir("/sys/devices/system/node"):
+        for name in os.listdir("/sys/devices/system/node"):
+            if re.fullmatch(r"node\d+", name):
+                with open("/sys/devices/system/node/{}/cpulist".format(name), "r") as cpulist_fd:
+                    cpulist = cpulist_fd.read().strip()
+
+                for cpu in parse_nodes(cpulist, ",") if cpulist else ():
+                    nodes[cpu] = int(name[4:])
+
+    cores = {}
+
+    for cpu in online:
+        topology = "/sys/devices/system/cpu/cpu{}/topology".format(cpu)
+
+        with open(topology + "/physical_package_id", "r") as package_fd, open(topology + "/core_id", "r") as core_fd:
+            key = nodes.get(cpu, 0), int(package_fd.read()), int(core_fd.read())
 
+        cores.setdefault(key, []).append(cpu)
+
+    return {key: sorted(cpus) for key, cpus in sorted(cores.items())}
+
+
+def pid_alive(pid):
     try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+@contextmanager
+def pin_table():
+    # the table is read, cleaned from the entries of the dead processes and written back under an exclusive lock,
+    # an entry is owned by the process allocating it until the pid of the qemu process is recorded
+    with open(PIN_TABLE + ".lock", "a") as lock_fd:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+
+        try:
+            with open(PIN_TABLE, "r") as table_fd:
+                table = json.load(table_fd)
+        except FileNotFoundError:
+            table = {}
+
+        for runtime, entry in list(table.items()):
+            if not pid_alive(entry["pid"]):
+                LOG.debug("Released the host cpus of %s, pid %d is gone", runtime, entry["pid"])
+                del table[runtime]
+
+        yield table
+
+        with open(PIN_TABLE + ".tmp", "w") as table_fd:
+            json.dump(table, table_fd)
+
+        os.replace(PIN_TABLE + ".tmp", PIN_TABLE)
+
+
+def pin_allocate(runtime, topology, host_nodes):
+    # every guest core gets a whole host core, the guest threads are its smt siblings, a guest socket never spans host nodes,
+    # the siblings left over (or else an extra core) run the qemu main loop and the iothreads
+    sockets, cores, threads = topology
+
+    with pin_table() as table:
+        used = {cpu for owner, entry in table.items() if owner != runtime for cpu in entry["cpus"]}
+        free = {}
+
+        for key, cpus in host_cores().items():
+            if used.isdisjoint(cpus) and len(cpus) >= threads:
+                free.setdefault(key[0], []).append(cpus)
+
+        vcpus, housekeeping, reserved = [], [], []
+
+        for socket_id in range(sockets):
+            # the host node the memory of the guest node of the socket is bound to by {mem,...,nodes=} comes first
+            preferred = host_nodes[socket_id % len(host_nodes) :] + host_nodes[: socket_id % len(host_nodes)] if host_nodes else []
+            candidates = [node for node in preferred if len(free.get(node, ())) >= cores]
+            candidates += sorted((node for node in free if len(free[node]) >= cores), key=lambda node: -len(free[node]))
+
+            if not candidates:
+                raise ValueError(
+                    "Not enough free host cores to pin {}: socket {} needs {} cores with {} threads".format(runtime, socket_id, cores, threads)
+                )
+
+            node = candidates[0]
+
+            for cpus in free[node][:cores]:
+                vcpus.extend(cpus[:threads])
+                housekeeping.extend(cpus[threads:])
+                reserved.extend(cpus)
+
+            free[node] = free[node][cores:]
+
+        if not housekeeping:
+            spare = next((cpus for node in sorted(free, key=lambda node: node not in host_nodes) for cpus in free[node]), None)
+
+            if spare is None:
+                LOG.warning("No spare host core for the qemu threads of %s, they share the vcpu cores", runtime)
+                housekeeping = vcpus
+            else:
+                housekeeping = spare
+                reserved.extend(spare)
+
+        table[runtime] = {"pid": os.getpid(), "cpus": reserved}
+
+    LOG.info("Allocated host cpus %s to the vcpus and %s to the qemu threads of %s", vcpus, housekeeping, runtime)
+    return {"vcpus": vcpus, "housekeeping": housekeeping}
+
+
+def prepare_pin(runtime, topology, host_nodes):
+    return {"pins": {runtime: pin_allocate(runtime, topology, host_nodes)}}
+
+
+async def pin_threads(runtime, topology, host_nodes, context=None):
+    pins = context["pins"][runtime]
+
+    with open("{}/process.pid".format(runtime), "r") as pid_fd:
+        pid = int(pid_fd.read())
+
+    reader, writer = await qmp_connect("{}/qmp.sock".format(runtime))
+
+    try:
+        vcpus = await qmp_execute(reader, writer, "query-cpus-fast")
+        iothreads = await qmp_execute(reader, writer, "query-iothreads")
+    finally:
+        writer.close()
+
+    # the main thread first, the threads created from now on inherit its affinity
+    os.sched_setaffinity(pid, pins["housekeeping"])
+
+    for vcpu in vcpus:
+        os.sched_setaffinity(vcpu["thread-id"], [pins["vcpus"][vcpu["cpu-index"]]])
+
+    for iothread in iothreads:
+        os.sched_setaffinity(iothread["thread-id"], pins["housekeeping"])
+
+    with pin_table() as table:
+        if runtime in table:
+            table[runtime]["pid"] = pid
+
+    LOG.info("Pinned %d vcpus and %d iothreads of %s", len(vcpus), len(iothreads), runtime)
+
+
+async def balloon_stats(runtime, interval, context=None):
+    reader, writer = await qmp_connect("{}/qmp.sock".format(runtime))
+
+    try:
+        await qmp_execute(reader, writer, "qom-set", path=BALLOON_QOM_PATH, property="guest-stats-polling-interval", value=interval)
+    finally:
+        writer.close()
+
+    LOG.info("Polling the guest memory stats of %s every %ds", runtime, interval)
+
+
+async def launch_steps(plan, context):
+    # the steps that need the running qemu process
+    async def launch_step(step):
+        with trace_span("launch " + step[0], runtime=step[1]):
+            await LAUNCH_STEPS[step[0]](*step[1:], context=context)
+
+    await asyncio.gather(*(launch_step(step) for step in plan if step[0] in LAUNCH_STEPS))
+
+
+async def qmp_connect(path):
+    reader, writer = await asyncio.open_unix_connection(path)
+    await qmp_read(reader)
+    await qmp_execute(reader, writer, "qmp_capabilities")
+    return reader, writer
+
+
+async def qmp_execute(reader, writer, command, **arguments):
+    writer.write(json.dumps({"execute": command, "arguments": arguments}).encode() + b"\n")
+    await writer.drain()
+    return await qmp_read(reader)
+
+
+async def qmp_read(reader):
+    # the events received while waiting for the reply are skipped
+    while True:
+        line = await reader.readline()
+
+        if not line:
+            raise ConnectionError("QMP connection closed")
+
+        message = json.loads(line)
+
+        if "error" in message:
+            raise RuntimeError("QMP {}: {}".format(message["error"]["class"], message["error"]["desc"]))
+
+        if "return" in message:
+            return message["return"]
+
+        if "QMP" in message:
+            return message["QMP"]
+
+
+async def agent_connect(runtime, timeout=5):
+    # the guest agent has no greeting, guest-sync skips the replies left over from a previous connection
+    reader, writer = await asyncio.open_unix_connection("{}/agent.sock".format(runtime))
+
+    try:
+        sync = int.from_bytes(os.urandom(4), "big") >> 1
+        writer.write(json.dumps({"execute": "guest-sync", "arguments": {"id": sync}}).encode() + b"\n")
+        await writer.drain()
+
+        while True:
+            line = await asyncio.wait_for(reader.readline(), timeout)
+
+            if not line:
+                raise ConnectionError("Guest agent connection closed")
+
+            try:
+                if json.loads(line.strip(b"\xff")).get("return") == sync:
+                    return reader, writer
+            except ValueError:
+                pass
+    except BaseException:
+        writer.close()
+        raise
+
+
+async def agent_exec(runtime, script):
+    # runs a shell script in the guest, returns its exit code and output
+    reader, writer = await agent_connect(runtime)
+
+    try:
+        pid = (await qmp_execute(reader, writer, "guest-exec", path="/bin/sh", arg=["-c", script], **{"capture-output": True}))["pid"]
+
+        while True:
+            status = await qmp_execute(reader, writer, "guest-exec-status", pid=pid)
+
+            if status["exited"]:
+                output = base64.b64decode(status.get("out-data", "")) + base64.b64decode(status.get("err-data", ""))
+                return status.get("exitcode"), output.decode(errors="replace")
+
+            await asyncio.sleep(0.1)
+    finally:
+        writer.close()
+
+
+async def agent_wait(runtime):
+    while True:
+        try:
+            reader, writer = await agent_connect(runtime, 2)
+            writer.close()
+            return
+        except (OSError, ConnectionError, asyncio.TimeoutError):
+            await asyncio.sleep(1)
+
+
+async def serial_wait(runtime, pattern):
+    # the output is kept in a sliding window, the pattern has to match within it
+    reader, writer = await asyncio.open_unix_connection("{}/serial-0.sock".format(runtime))
+    matcher = re.compile(pattern.encode())
+    window = b""
+
+    try:
+        while not matcher.search(window):
+            chunk = await reader.read(4096)
+
+            if not chunk:
+                raise ConnectionError("Serial connection closed")
+
+            window = (window + chunk)[-65536:]
+    finally:
+        writer.close()
+
+
+async def migrate_wait(reader, writer):
+    while True:
+        status = (await qmp_execute(reader, writer, "query-migrate")).get("status")
+
+        if status == "completed":
+            return
+
+        if status in ("failed", "cancelled"):
+            raise RuntimeError("Migration {}".format(status))
+
+        await asyncio.sleep(0.05)
+
+
+def prepare_warm(runtime, state, name, macs):
+    if not os.path.exists(state):
+        raise ValueError("No saved state {}, create it with the template command".format(state))
+
+
+async def warm_resume(runtime, state, name, macs, context=None):
+    started = time.monotonic()
+    reader, writer = await qmp_connect("{}/qmp.sock".format(runtime))
+
+    try:
+        await qmp_execute(reader, writer, "migrate-incoming", uri="exec:cat {}".format(shlex.quote(state)))
+
+        status = (await qmp_execute(reader, writer, "query-status"))["status"]
+
+        while status == "inmigrate":
+            await asyncio.sleep(0.05)
+            status = (await qmp_execute(reader, writer, "query-status"))["status"]
+
+        if status != "running":
+            await qmp_execute(reader, writer, "cont")
+    finally:
+        writer.close()
+
+    LOG.info("Resumed %s from %s in %.3fs", name, state, time.monotonic() - started)
+
+    if not os.path.exists("{}/agent.sock".format(runtime)):
+        LOG.warning("%s has no {agent}, it keeps the hostname, machine-id and MACs of its template", name)
+        return
+
+    # the guest resumes with the identity of the template, the virtio-net MACs included as they are part of the saved state
+    script = [
+        "hostnamectl set-hostname {0} 2>/dev/null || hostname {0}".format(shlex.quote(name)),
+        "rm -f /etc/machine-id && (systemd-machine-id-setup >/dev/null 2>&1 || dbus-uuidgen > /etc/machine-id)",
+    ]
+
+    for old, new in macs:
+        script.append(
+            'for dev in /sys/class/net/*; do if [ "$(cat $dev/address)" = {} ]; then ip link set dev "${{dev##*/}}" address {}; fi; done'.format(old, new)
+        )
+
+    reader, writer = await agent_connect(runtime)
+
+    try:
+        await qmp_execute(reader, writer, "guest-set-time", time=time.time_ns())
+    finally:
+        writer.close()
+
+    exitcode, output = await agent_exec(runtime, "\n".join(script))
+
+    if exitcode:
+        LOG.warning("Failed to regenerate the identity of %s: %s", name, output.strip())
+    else:
+        LOG.info("Regenerated the identity of %s in %.3fs", name, time.monotonic() - started)
+
+
+async def template_save(runtime, state, ready, timeout):
+    started = time.monotonic()
+    await asyncio.wait_for(agent_wait(runtime) if ready is None else serial_wait(runtime, ready), timeout)
+    LOG.info("Template ready in %.3fs", time.monotonic() - started)
+    reader, writer = await qmp_connect("{}/qmp.sock".format(runtime))
+
+    try:
+        await qmp_execute(reader, writer, "stop")
+        await qmp_execute(reader, writer, "migrate", uri="exec:cat > {}".format(shlex.quote(state + ".tmp")))
+        await migrate_wait(reader, writer)
+        await qmp_execute(reader, writer, "quit")
+    finally:
+        writer.close()
+
+    os.replace(state + ".tmp", state)
+    LOG.info("Saved the state of the template to %s in %.3fs", state, time.monotonic() - started)
+
+
+def warm_state(overlay):
+    # the saved state of a template, next to its overlay
+    return os.path.splitext(overlay)[0] + ".state"
+
+
+def runtime_dirs():
+    # the runtime dirs of the VMs, running or not
+    return sorted("/var/run/" + name for name in os.listdir("/var/run") if RUNTIME_MATCHER.fullmatch(name))
+
+
+def runtime_info(runtime):
+    # the name, arguments and taps of a VM from its cached expansion
+    try:
+        with open(runtime + "/expansion.json", "r") as cache_fd:
+            expansion = json.load(cache_fd)
+    except (FileNotFoundError, ValueError):
+        return {"name": os.path.basename(runtime), "args": None, "taps": [], "balloon": False}
+
+    args = expansion["args"]
+    name = args[args.index("-name") + 1] if "-name" in args else os.path.basename(runtime)
+    taps = [step[1] for step in expansion["plan"] if step[0] == "tap"]
+    return {"name": name, "args": args, "taps": taps, "balloon": any(step[0] == "balloon" for step in expansion["plan"])}
+
+
+def prepare_hdd(file, size_gb):
+    if not os.path.exists(file):
+        qcow2_image(file, size_gb * 1073741824)
+
+
+def prepare_snap(snap, file, fresh=False):
+    if fresh and os.path.exists(snap):
+        os.remove(snap)
+
+    if not os.path.exists(snap):
+        # a relative backing file is resolved from the directory of the overlay
+        backing_file = file if os.path.isabs(file) else os.path.relpath(file, os.path.dirname(snap) or ".")
+        qcow2_image(snap, backing_file=backing_file, backing_fmt="qcow2")
+
+
+def prepare_plan(env):
+    plan = [("runtime", env["runtime"])]
+
+    if "hugepages" in env:
+        plan.append(("hugepages", env["name"], env["hugepages"]))
+
+    if "networks" in env:
+        for br, net in env["networks"].items():
+            cidr, mac = net
+            plan.append(("network", br, cidr, mac))
+
+    if "taps" in env:
+        for tap, tap_info in env["taps"].items():
+            br, mac, fds = tap_info
+            plan.append(("tap", tap, br, mac, fds))
+
+    if "balloon" in env:
+        plan.append(("balloon", env["runtime"], env["balloon"]))
+
+    if "pin" in env:
+        plan.append(("pin", env["runtime"], env.get("topology", (1, vcpus(env), 1)), env.get("host_nodes", [])))
+
+    if "hdds" in env:
+        for file, hdd in env["hdds"].items():
+            size_gb, snap = hdd
+            plan.append(("hdd", file, size_gb))
+
+            if snap and "warm" in env:
+                # the disks of a clone start over from the overlays of the template, as they were when its state was saved
+                plan.append(("snap", snap, hdd_snap(file, idgen(env["warm"])), True))
+            elif snap:
+                plan.append(("snap", snap, file))
+
+    if "warm" in env:
+        template_id = idgen(env["warm"])
+        snaps = [file for file, hdd in env.get("hdds", {}).items() if hdd[1]]
+
+        if not snaps:
+            raise ValueError("{warm} needs a {hdd,...,snap} disk, the overlay of the template is the base of the clones")
+
+        macs = [(macgen(template_id + str(idx)), mac) for idx, mac in enumerate(env.get("macs", {}))]
+        plan.append(("warm", env["runtime"], warm_state(hdd_snap(snaps[0], template_id)), env["name"], macs))
+
+    return plan
+
+
+def prepare(plan, workers=None):
+    # steps sharing the same name and target (a bridge, a tap, an image file) are executed only once,
+    # steps of the same stage are independent of each other and run concurrently,
+    # the "fds", "rules" and "pins" returned by the steps are collected in the context,
+    # steps with nothing to prepare only run once qemu is up, see launch_steps
+    steps = {}
+
+    for step in plan:
+        if step[0] in PREPARE_STEPS:
+            steps.setdefault(tuple(step[:2]), step)
+
+    stages = {}
+
+    for step in steps.values():
+        stage, _ = PREPARE_STEPS[step[0]]
+        stages.setdefault(stage, []).append(step)
+
+    context = {"fds": {}, "rules": [], "pins": {}}
+
+    def prepare_step(step):
+        with trace_span("prepare " + step[0], target=str(step[1])):
+            return PREPARE_STEPS[step[0]][1](*step[1:])
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for stage in sorted(stages):
+            futures = {pool.submit(prepare_step, step): step for step in stages[stage]}
+            done, _ = wait(futures)
+
+            for future in done:
+                if future.exception() is not None:
+                    LOG.error("Prepare step %s failed: %s", " ".join(map(str, futures[future])), future.exception())
+
+            for future in done:
+                result = future.result()
+
+                if result:
+                    context["fds"].update(result.get("fds", {}))
+                    context["rules"].extend(result.get("rules", []))
+                    context["pins"].update(result.get("pins", {}))
+
+    if context["rules"]:
+        with trace_span("firewall", rules=len(context["rules"])):
+            firewall(context["rules"])
+
+    return context
+
+
+def prepare_fds(plan, context):
+    return {target: fd for step in plan if step[0] == "tap" for target, fd in zip(step[4], context["fds"][step[1]])}
+
+
+def remap_fds(fds):
+    # move every fd above the highest target first, so that a dup2 never clobbers a fd that is still to be moved
+    high = max(fds, default=2) + 1
+    moved = {target: fcntl.fcntl(fd, fcntl.F_DUPFD, high) for target, fd in fds.items()}
+
+    for target, fd in moved.items():
+        os.dup2(fd, target)
+        os.close(fd)
+
+
+def process_arg0(env, arg):
+    prefix = "easy-"
+    executable = os.path.basename(arg)
+
+    if executable.startswith(prefix):
+        executable, _ = os.path.splitext(executable[len(prefix) :])
+        return [shutil.which(executable), executable]
+    else:
+        return [arg]
+
+
+def process_args(args: list, env):
+    newargs = process_arg0(env, args[0])
+
+    for idx, arg in enumerate(args[1:], 1):
+        if arg == "-name" and idx + 1 < len(args):
+            process_name(env, arg, args[idx + 1])
+
+        expanded = process_nodes(process_parse(arg), env)
+
+        if len(expanded) == 0:
+            LOG.debug("Argument: %s -> removed", arg)
+        elif len(expanded) > 1 or expanded[0] != arg:
+            LOG.debug("Argument: %s -> %s", arg, expanded)
+
+        newargs.extend(expanded)
+
+    return newargs
+
+
+def process_macro(macro, env):
+    # nested macros are expanded first, their arguments joined with "," become fields of the enclosing macro
+    fields = "".join(node if isinstance(node, str) else ",".join(process_nodes((node,), env)) for node in macro).split(",")
+
+    if fields[0] not in env["macros"]:
+        raise ValueError("Unknown macro: {{{}}}".format(",".join(fields)))
+
+    macrofn = env["macros"][fields[0]]
+    macroargs = [None if f == "" else f for f in fields[1:]]
+
+    with trace_span("macro " + fields[0], runtime=env.get("runtime")):
+        newargs = list(macrofn(*macroargs, env=env))
+
+    if len(newargs):
+        LOG.debug("Macro: {%s} -> %s -> newargs: %s", ",".join(fields), newargs[0], newargs[1:])
+    else:
+        LOG.debug("Macro: {%s} -> removed", ",".join(fields))
+
+    return newargs
+
+
+def process_name(env, arg, nextarg):
+    env["name"] = nextarg
+    env["id"] = idgen(nextarg)
+    env["runtime"] = "/var/run/qemu-{}".format(env["id"])
+    return [arg]
+
+
+def process_nodes(nodes, env):
+    # expands the leftmost macro, the text around it is attached to its first output and the remaining outputs become
+    # arguments of their own, every output is parsed once and expanded in turn
+    for idx, node in enumerate(nodes):
+        if not isinstance(node, str):
+            break
+    else:
+        return ["".join(nodes)]
+
+    outputs = process_macro(node, env)
+
+    if len(outputs) == 0:
+        return []
+
+    newargs = process_nodes(("".join(nodes[:idx]),) + process_parse(outputs[0]) + nodes[idx + 1 :], env)
+
+    for output in outputs[1:]:
+        newargs.extend(process_nodes(process_parse(output), env))
+
+    return newargs
+
+
+@lru_cache(maxsize=None)
+def process_parse(arg):
+    # parses an argument into a tuple of literal strings and macros, a macro is a tuple of the nodes between its braces,
+    # empty "{}" and unbalanced braces are literal text
+    stack = [[]]
+
+    for token in re.split(r"([{}])", arg):
+        if token == "{":
+            stack.append([])
+        elif token == "}" and len(stack) > 1:
+            body = stack.pop()
+            stack[-1].append(tuple(body) if body else "{}")
+        elif token:
+            stack[-1].append(token)
+
+    while len(stack) > 1:
+        body = stack.pop()
+        stack[-1].extend(["{"] + body)
+
+    nodes = []
+
+    for node in stack[0]:
+        if isinstance(node, str) and nodes and isinstance(nodes[-1], str):
+            nodes[-1] += node
+        else:
+            nodes.append(node)
+
+    return tuple(nodes)
+
+
+def qemu_cache(args):
+    # the cache lives in the runtime dir, it is keyed on the arguments and on this script, so that changed macros expand again
+    try:
+        name = args[args.index("-name") + 1]
+    except (ValueError, IndexError):
+        return None, None
+
+    with open(__file__, "rb") as script_fd:
+        key = hashlib.sha256(json.dumps(args).encode() + script_fd.read()).hexdigest()
+
+    return "/var/run/qemu-{}/expansion.json".format(idgen(name)), key
+
+
+def qemu_expand(args):
+    env = {
+        "macros": {
+            "agent": macro_agent,
+            "balloon": macro_balloon,
+            "cpu": macro_cpu,
+            "runtime": macro_runtime,
+            "id": macro_id,
+            "iothreads": macro_iothreads,
+            "br": macro_br,
+            "hdd": macro_hdd,
+            "snap": macro_snap,
+            "mac": macro_mac,
+            "mem": macro_mem,
+            "net": macro_net,
+            "warm": macro_warm,
+            "pin": macro_pin,
+            "cd": macro_cd,
+            "serial": macro_serial,
+            "monitor": macro_monitor,
+            "video": macro_video,
+            "defaults": macro_defaults,
+        },
+    }
+
+    args = process_args(args, env)
+    return args, env
+
+
+def qemu_expansion(args, cache=True):
+    start = time.monotonic()
+    cache_file, key = qemu_cache(args) if cache else (None, None)
+
+    if cache_file is not None and os.path.exists(cache_file):
+        with open(cache_file, "r") as cache_fd:
+            expansion = json.load(cache_fd)
+
+        if expansion["key"] == key:
+            LOG.debug("Using cached expansion %s", cache_file)
+            trace_add("expand", start, time.monotonic() - start, runtime=os.path.dirname(cache_file), cached=True)
+            return expansion
+
+    args, env = qemu_expand(args)
+    expansion = {"key": key, "args": args, "plan": prepare_plan(env), "hints": env.get("hints", [])}
+    trace_add("expand", start, time.monotonic() - start, runtime=env.get("runtime"), cached=False)
+
+    if cache_file is not None:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+
+        with open(cache_file + ".tmp", "w") as cache_fd:
+            json.dump(expansion, cache_fd)
+
+        os.replace(cache_file + ".tmp", cache_file)
+
+    return expansion
+
+
+def qemu_print(expansion):
+    args = expansion["args"]
+    print("".join((" \\\n  " if a.startswith("-") else " ") + shlex.quote(a) for a in [args[1]] + args[2:]).strip())
+
+    for step in expansion["plan"]:
+        print("# {}".format(" ".join(map(str, step))))
+
+
+def qemu_command(args):
+    expansion = qemu_expansion(args)
+    args = expansion["args"]
+    plan = expansion["plan"]
+    context = prepare(plan)
+    fds = prepare_fds(plan, context)
+    LOG.info("QEMU command: %s", "".join((" \\\n  " if a.startswith("-") else " ") + a for a in args).strip())
+
+    for hint in expansion["hints"]:
+        log_args, log_kwargs = hint
+        LOG.info(*log_args, **log_kwargs)
+
+    runtime = next((step[1] for step in plan if step[0] == "runtime"), None)
+
+    # the time to the pidfile is only known when this process outlives the exec of qemu
+    if not any(step[0] in LAUNCH_STEPS for step in plan) and not (TRACE and runtime):
+        remap_fds(fds)
+        os.execl(*args)
+
+    # qemu daemonizes once the machine is created, the vcpu and iothreads exist when it returns
+    started = time.monotonic()
+    trace_launch(args[1], runtime, started, launch_wait(args[1], started, launch_spawn(args, fds)))
+
+    for fd in fds.values():
+        os.close(fd)
+
+    asyncio.run(launch_steps(plan, context))
+
+    if TRACE and runtime:
+        trace_write(runtime)
+
+
+async def metrics_vm(runtime, info, connections):
+    if runtime not in connections:
+        connections[runtime] = await qmp_connect("{}/qmp.sock".format(runtime))
+
+    reader, writer = connections[runtime]
+    labels = {"vm": info["name"]}
+    samples = [("qemu_up", labels, 1)]
+
+    for block in await qmp_execute(reader, writer, "query-blockstats"):
+        device = dict(labels, device=block.get("qdev") or block.get("device") or block.get("node-name"))
+        samples.extend((metric, device, block["stats"][key]) for key, metric in METRICS_BLOCK.items() if key in block["stats"])
+
+    # no balloon device, or a qemu without query-stats
+    try:
+        balloon = await qmp_execute(reader, writer, "query-balloon")
+        samples.append(("qemu_balloon_actual_bytes", labels, balloon["actual"]))
+    except RuntimeError:
+        pass
+
+    for target in ("vm", "vcpu"):
+        try:
+            providers = await qmp_execute(reader, writer, "query-stats", target=target)
+        except RuntimeError:
+            break
+
+        for provider in providers:
+            stat_labels = dict(labels, provider=provider["provider"])
+
+            if "qom-path" in provider:
+                stat_labels["path"] = provider["qom-path"]
+
+            # the histograms are left out
+            for stat in provider["stats"]:
+                if type(stat["value"]) is int:
+                    samples.append(("qemu_{}_{}".format(target, re.sub(r"\W", "_", stat["name"])), stat_labels, stat["value"]))
+
+    # named from the side of the tap, qemu_tap_rx_bytes_total counts the bytes sent by the guest
+    for tap in info["taps"]:
+        for counter in METRICS_NET:
+            try:
+                with open("/sys/class/net/{}/statistics/{}".format(tap, counter), "r") as counter_fd:
+                    samples.append(("qemu_tap_{}_total".format(counter), dict(labels, tap=tap), int(counter_fd.read())))
+            except FileNotFoundError:
+                break
+
+    return samples
+
+
+async def metrics_collect(runtime, connections, timeout):
+    info = runtime_info(runtime)
+
+    try:
+        return info, await asyncio.wait_for(metrics_vm(runtime, info, connections), timeout)
+    except Exception as exc:
+        LOG.debug("Failed to collect the metrics of %s: %s", info["name"], exc)
+
+        # a command may still be in flight, the connection starts over on the next poll
+        if runtime in connections:
+            connections.pop(runtime)[1].close()
+
+        return info, [("qemu_up", {"vm": info["name"]}, 0)]
+
+
+def metrics_render(samples):
+    # the samples of a metric have to be grouped in the prometheus text format
+    lines = []
+
+    for name, labels, value in sorted(samples, key=lambda sample: sample[0]):
+        label_text = ",".join('{}="{}"'.format(key, str(label).replace("\\", "\\\\").replace('"', '\\"')) for key, label in sorted(labels.items()))
+        lines.append("{}{{{}}} {}".format(name, label_text, value))
+
+    return "\n".join(lines) + "\n"
+
+
+async def metrics_serve(reader, writer, state):
+    try:
+        await reader.readuntil(b"\r\n\r\n")
+        body = state["text"].encode()
+        writer.write(b"HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: %d\r\n\r\n" % len(body) + body)
+        await writer.drain()
+    except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+        pass
+    finally:
+        writer.close()
+
+
+async def metrics_loop(opts):
+    # one connection per VM, kept between the polls, all the VMs are polled concurrently from a single thread
+    connections = {}
+    state = {"text": ""}
+
+    if opts.listen:
+        host, _, port = opts.listen.rpartition(":")
+        await asyncio.start_server(lambda reader, writer: metrics_serve(reader, writer, state), host or None, int(port))
+        LOG.info("Serving the metrics on http://%s/metrics", opts.listen)
+
+    while True:
+        started = time.monotonic()
+        runtimes = [runtime for runtime in runtime_dirs() if os.path.exists("{}/qmp.sock".format(runtime))]
+
+        for runtime in set(connections) - set(runtimes):
+            connections.pop(runtime)[1].close()
+
+        results = await asyncio.gather(*(metrics_collect(runtime, connections, opts.interval) for runtime in runtimes))
+
+        if opts.listen:
+            state["text"] = metrics_render([sample for _, samples in results for sample in samples])
+        else:
+            now = time.time()
+
+            for info, samples in results:
+                metrics = [{"name": name, "labels": labels, "value": value} for name, labels, value in samples]
+                print(json.dumps({"time": now, "vm": info["name"], "metrics": metrics}), flush=True)
+
+            if opts.once:
+                return
+
+        LOG.debug("Collected the metrics of %d VMs in %.3fs", len(runtimes), time.monotonic() - started)
+        await asyncio.sleep(max(0, opts.interval - (time.monotonic() - started)))
+
+
+def metrics_command(argv):
+    parser = argparse.ArgumentParser(prog="{} metrics".format(os.path.basename(sys.argv[0])), description="Export the metrics of the running VMs")
+    parser.add_argument("-i", "--interval", type=float, default=15, help="seconds between the polls (default: %(default)s)")
+    parser.add_argument("-l", "--listen", help="serve the prometheus text format on [host]:port instead of printing JSON lines")
+    parser.add_argument("-1", "--once", action="store_true", help="print the JSON lines once and exit")
+    opts = parser.parse_args(argv)
+    asyncio.run(metrics_loop(opts))
+    return 0
+
+
+def balloon_pressure():
+    # the share of the last 10s some tasks of the host were stalled on memory, in percent
+    with open("/proc/pressure/memory", "r") as psi_fd:
+        for line in psi_fd:
+            kind, *fields = line.split()
+
+            if kind == "some":
+                return float(dict(field.split("=") for field in fields)["avg10"])
+
+    return 0.0
+
+
+def balloon_stat(stats, name):
+    # the stats the guest has not reported (yet) read as 2^64 - 1
+    value = stats.get(name, -1)
+    return None if value < 0 or value >= 1 << 63 else value
+
+
+def balloon_rss(runtime):
+    pid = runtime_pid(runtime)
+
+    try:
+        with open("/proc/{}/status".format(pid), "r") as status_fd:
+            return next(int(line.split()[1]) * 1024 for line in status_fd if line.startswith("VmRSS:"))
+    except (FileNotFoundError, StopIteration):
+        return None
+
+
+async def balloon_vm(runtime, connections):
+    if runtime not in connections:
+        connections[runtime] = await qmp_connect("{}/qmp.sock".format(runtime))
+
+    reader, writer = connections[runtime]
+    guest = await qmp_execute(reader, writer, "qom-get", path=BALLOON_QOM_PATH, property="guest-stats")
+    return {
+        "memory": (await qmp_execute(reader, writer, "query-memory-size-summary"))["base-memory"],
+        "actual": (await qmp_execute(reader, writer, "query-balloon"))["actual"],
+        "available": balloon_stat(guest["stats"], "stat-available-memory"),
+        "rss": balloon_rss(runtime),
+    }
+
+
+def balloon_target(vm, pressure, opts):
+    # under host pressure every guest gives half the memory it has available above the reserve, a guest short of memory
+    # gets it back at once, without pressure the balloons deflate a step of the memory per poll, never below the floor
+    memory, actual, available = vm["memory"], vm["actual"], vm["available"]
+    reserve = opts.reserve * 1048576
+    step = memory * opts.step // 100
+
+    if available is None:
+        # no stats from the guest, nothing tells what it could give
+        target = memory if pressure <= opts.low else actual
+    elif available < reserve:
+        target = actual + max(reserve - available, step)
+    elif pressure >= opts.high:
+        target = actual - (available - reserve) // 2
+    elif pressure <= opts.low:
+        target = actual + step
+    else:
+        target = actual
+
+    return min(memory, max(memory * opts.floor // 100, target))
+
+
+def ksm_read():
+    values = {}
+
+    for name in ("run", "pages_to_scan", "sleep_millisecs", "pages_shared", "pages_sharing"):
+        with open("{}/{}".format(KSM_DIR, name), "r") as ksm_fd:
+            values[name] = int(ksm_fd.read())
+
+    return values
+
+
+def ksm_write(**settings):
+    for name, value in settings.items():
+        with open("{}/{}".format(KSM_DIR, name), "w") as ksm_fd:
+            ksm_fd.write(str(value))
+
+
+async def balloon_collect(runtime, connections, timeout):
+    info = runtime_info(runtime)
+
+    try:
+        return info, await asyncio.wait_for(balloon_vm(runtime, connections), timeout)
+    except Exception as exc:
+        LOG.debug("Failed to read the memory of %s: %s", info["name"], exc)
+
+        if runtime in connections:
+            connections.pop(runtime)[1].close()
+
+        return info, None
+
+
+async def balloon_loop(opts):
+    # the VMs of {balloon}, polled concurrently like the metrics, their balloons follow the memory pressure of the host
+    connections = {}
+    reported = 0
+
+    if opts.ksm:
+        ksm_write(run=1, pages_to_scan=opts.ksm_pages, sleep_millisecs=opts.ksm_sleep)
+        LOG.info("KSM scans %d pages every %dms", opts.ksm_pages, opts.ksm_sleep)
+
+    while True:
+        started = time.monotonic()
+        pressure = balloon_pressure()
+        runtimes = [runtime for runtime in runtime_dirs() if os.path.exists("{}/qmp.sock".format(runtime)) and runtime_info(runtime)["balloon"]]
+
+        for runtime in set(connections) - set(runtimes):
+            connections.pop(runtime)[1].close()
+
+        collected = await asyncio.gather(*(balloon_collect(runtime, connections, opts.interval) for runtime in runtimes))
+        results = [(runtime, info, vm) for runtime, (info, vm) in zip(runtimes, collected) if vm]
+
+        for runtime, info, vm in results:
+            target = balloon_target(vm, pressure, opts)
+
+            # the balloon moves a page at a time, small corrections are not worth waking the guest for
+            if abs(target - vm["actual"]) < max(vm["memory"] // 100, 1048576):
+                continue
+
+            LOG.info(
+                "Balloon of %s: %d MiB -> %d MiB of %d MiB, %s MiB available in the guest, memory pressure %.1f%%",
+                info["name"],
+                vm["actual"] // 1048576,
+                target // 1048576,
+                vm["memory"] // 1048576,
+                "?" if vm["available"] is None else vm["available"] // 1048576,
+                pressure,
+            )
+
+            if not opts.dry_run:
+                try:
+                    await asyncio.wait_for(qmp_execute(*connections[runtime], "balloon", value=target), opts.interval)
+                except Exception as exc:
+                    LOG.warning("Failed to resize the balloon of %s: %s", info["name"], exc)
+                    connections.pop(runtime)[1].close()
+
+        if opts.ksm:
+            # ksmd scans harder while the host is short of memory
+            pages = opts.ksm_pages * (10 if pressure >= opts.high else 1)
+
+            if ksm_read()["pages_to_scan"] != pages:
+                ksm_write(pages_to_scan=pages)
+
+        if opts.once or time.monotonic() - reported >= opts.report:
+            reported = time.monotonic()
+            ksm = ksm_read() if os.path.exists(KSM_DIR) else {"run": 0, "pages_sharing": 0}
+            LOG.info(
+                "Memory pressure %.1f%%, %d VMs: %.1f GiB held by the balloons, %.1f GiB not resident, %.1f GiB shared by KSM%s",
+                pressure,
+                len(results),
+                sum(vm["memory"] - vm["actual"] for _, _, vm in results) / 1073741824,
+                sum(max(0, vm["memory"] - vm["rss"]) for _, _, vm in results if vm["rss"] is not None) / 1073741824,
+                ksm["pages_sharing"] * os.sysconf("SC_PAGE_SIZE") / 1073741824,
+                "" if ksm["run"] == 1 else " (KSM is off)",
+            )
+
+        if opts.once:
+            return
+
+        await asyncio.sleep(max(0, opts.interval - (time.monotonic() - started)))
+
+
+def balloon_command(argv):
+    parser = argparse.ArgumentParser(
+        prog="{} balloon".format(os.path.basename(sys.argv[0])),
+        description="Drive the balloons of the {balloon} VMs by the memory pressure of the host and tune KSM",
+    )
+    parser.add_argument("-i", "--interval", type=float, default=5, help="seconds between the polls (default: %(default)s)")
+    parser.add_argument("--high", type=float, default=10, help="memory pressure some avg10 %% that inflates the balloons (default: %(default)s)")
+    parser.add_argument("--low", type=float, default=1, help="memory pressure some avg10 %% below which they deflate (default: %(default)s)")
+    parser.add_argument("--reserve", type=int, default=256, help="MiB left available in every guest (default: %(default)s)")
+    parser.add_argument("--floor", type=int, default=25, help="%% of its memory a guest always keeps (default: %(default)s)")
+    parser.add_argument("--step", type=int, default=10, help="%% of its memory a balloon deflates per poll (default: %(default)s)")
+    parser.add_argument("--ksm", action="store_true", help="run KSM with the following settings, scanning 10 times more under pressure")
+    parser.add_argument("--ksm-pages", type=int, default=100, help="pages KSM scans per wake up (default: %(default)s)")
+    parser.add_argument("--ksm-sleep", type=int, default=200, help="milliseconds KSM sleeps between the scans (default: %(default)s)")
+    parser.add_argument("-r", "--report", type=float, default=60, help="seconds between the reports of the reclaimed memory (default: %(default)s)")
+    parser.add_argument("-n", "--dry-run", action="store_true", help="only log the balloon changes")
+    parser.add_argument("-1", "--once", action="store_true", help="poll once and exit")
+    opts = parser.parse_args(argv)
+    asyncio.run(balloon_loop(opts))
+    return 0
+
+
+def print_command(argv):
+    qemu_print(qemu_expansion([sys.argv[0]] + argv, cache=False))
+    return 0
+
+
+def fleet_manifest(manifest, arg0):
+    # every section is a VM named after the section, its "args" are the easy-qemu arguments after "-name",
+    # shared arguments can be placed in the DEFAULT section and referenced with ${...},
+    # "count = N" launches N copies of the section named <section>-1 ... <section>-N
+    parser = configparser.ConfigParser(interpolation=configparser.ExtendedInterpolation())
+
+    with open(manifest, "r") as manifest_fd:
+        parser.read_file(manifest_fd)
+
+    vms = []
+
+    for section in parser.sections():
+        args = shlex.split(parser.get(section, "args"))
+        count = parser.getint(section, "count", fallback=None)
+        names = [section] if count is None else ["{}-{}".format(section, i) for i in range(1, count + 1)]
+
+        for name in names:
+            vms.append((name, [arg0, "-name", name] + args))
+
+    return vms
+
+
+def launch_spawn(args, fds):
+    return subprocess.Popen(
+        args[1:],
+        executable=args[0],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        close_fds=False,
+        preexec_fn=lambda: remap_fds(fds),
+    )
+
+
+def launch_wait(name, started, proc):
+    output, _ = proc.communicate()
+    elapsed = time.monotonic() - started
+
+    if proc.returncode != 0:
+        raise RuntimeError("{} exited with {}: {}".format(name, proc.returncode, output.decode().strip()))
+
+    return elapsed
+
+
+def launch(vms, workers=None):
+    # vms are (name, args, plan), returns the number of VMs that failed to start,
+    # the hugepages of every VM are checked by its own prepare step, they are needed all at once
+    hugepages = {}
+    plan = [step for _, _, vm_plan in vms for step in vm_plan]
+
+    for step in plan:
+        if step[0] == "hugepages":
+            for host_node, pagesize, pages in step[2]:
+                hugepages[host_node, pagesize] = hugepages.get((host_node, pagesize), 0) + pages
+
+    hugepages_check([[host_node, pagesize, pages] for (host_node, pagesize), pages in hugepages.items()])
+
+    prepare_start = time.monotonic()
+    context = prepare(plan, workers)
+    LOG.info("Prepared %d VMs in %.3fs", len(vms), time.monotonic() - prepare_start)
+
+    # the processes are spawned from this thread only, remap_fds runs between fork and exec
+    # and that is only safe while no other thread is running
+    procs = []
+
+    for name, args, vm_plan in vms:
+        fds = prepare_fds(vm_plan, context)
+        procs.append((name, time.monotonic(), launch_spawn(args, fds)))
+
+    for fds in context["fds"].values():
+        for fd in fds:
+            os.close(fd)
+
+    failed = 0
+    started_plan = []
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [(name, pool.submit(launch_wait, name, started, proc)) for name, started, proc in procs]
+
+        for (name, future), (_, _, vm_plan), (_, started, _) in zip(futures, vms, procs):
+            try:
+                elapsed = future.result()
+                LOG.info("Started %s in %.3fs", name, elapsed)
+                trace_launch(name, next((step[1] for step in vm_plan if step[0] == "runtime"), None), started, elapsed)
+                started_plan.extend(vm_plan)
+            except Exception as exc:
+                failed += 1
+                LOG.error("Failed %s: %s", name, exc)
+
+    asyncio.run(launch_steps(started_plan, context))
+
+    if TRACE:
+        for step in plan:
+            if step[0] == "runtime":
+                trace_write(step[1])
+
+    return failed
+
+
+def fleet_command(argv):
+    parser = argparse.ArgumentParser(prog="{} fleet".format(os.path.basename(sys.argv[0])), description="Launch every VM of a manifest")
+    parser.add_argument("-p", "--print", action="store_true", help="print the expanded commands without launching")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="size of the worker pool (default: %(default)s)")
+    parser.add_argument("manifest", help="INI file with one section per VM")
+    opts = parser.parse_args(argv)
+
+    start = time.monotonic()
+    vms = []
+
+    for name, args in fleet_manifest(opts.manifest, sys.argv[0]):
+        expansion = qemu_expansion(args, cache=not opts.print)
+        vms.append((name, expansion["args"], expansion["plan"]))
+
+        if opts.print:
+            print("# {}".format(name))
+            qemu_print(expansion)
+
+        for hint in expansion["hints"]:
+            log_args, log_kwargs = hint
+            LOG.debug(*log_args, **log_kwargs)
+
+    LOG.info("Expanded %d VMs in %.3fs", len(vms), time.monotonic() - start)
+
+    if opts.print:
+        return 0
+
+    failed = launch(vms, opts.workers)
+    LOG.info("Started %d of %d VMs in %.3fs", len(vms) - failed, len(vms), time.monotonic() - start)
+    return 1 if failed else 0
+
+
+def runtime_pid(runtime):
+    # the pid of a running qemu, which holds a lock on its pidfile, a stale pidfile or a reused pid are not running
+    try:
+        with open("{}/process.pid".format(runtime), "r") as pid_fd:
+            try:
+                fcntl.lockf(pid_fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except OSError:
+                return int(pid_fd.read())
+    except (FileNotFoundError, ValueError):
+        pass
+
+    return None
+
+
+def lifecycle_vms(names):
+    # the VMs of the runtime dirs selected by name or id, all of them without names
+    vms = []
+
+    for runtime in runtime_dirs():
+        info = dict(runtime_info(runtime), runtime=runtime, id=os.path.basename(runtime)[5:])
+
+        if not names or info["name"] in names or info["id"] in names:
+            info["pid"] = runtime_pid(runtime)
+            vms.append(info)
+
+    unknown = set(names) - {vm["name"] for vm in vms} - {vm["id"] for vm in vms}
+
+    if unknown:
+        raise ValueError("Unknown VMs: {}".format(", ".join(sorted(unknown))))
+
+    return vms
+
+
+async def lifecycle_qmp(vm, command):
+    reader, writer = await asyncio.wait_for(qmp_connect("{}/qmp.sock".format(vm["runtime"])), QUIT_TIMEOUT)
+
+    try:
+        return await asyncio.wait_for(qmp_execute(reader, writer, command), QUIT_TIMEOUT)
+    finally:
+        writer.close()
+
+
+async def lifecycle_status(vm):
+    if vm["pid"] is None:
+        return "stopped"
+
+    try:
+        return (await lifecycle_qmp(vm, "query-status"))["status"]
+    except (OSError, ConnectionError, RuntimeError, asyncio.TimeoutError):
+        return "running"
+
+
+async def lifecycle_wait(vm, timeout):
+    # qemu has no way to notify the exit to anything but its parent, the pidfile lock is polled
+    deadline = time.monotonic() + timeout
+
+    while runtime_pid(vm["runtime"]) is not None:
+        if time.monotonic() > deadline:
+            return False
+
+        await asyncio.sleep(0.2)
+
+    return True
+
+
+async def lifecycle_stop(vm, timeout, graceful=True):
+    started = time.monotonic()
+
+    if vm["pid"] is None:
+        return 0
+
+    if graceful:
+        try:
+            await lifecycle_qmp(vm, "system_powerdown")
+
+            if await lifecycle_wait(vm, timeout):
+                LOG.info("Powered down %s in %.3fs", vm["name"], time.monotonic() - started)
+                return 0
+
+            LOG.warning("%s did not power down in %ds", vm["name"], timeout)
+        except (OSError, ConnectionError, RuntimeError, asyncio.TimeoutError) as exc:
+            LOG.warning("Failed to power down %s: %s", vm["name"], exc)
+
+    try:
+        await lifecycle_qmp(vm, "quit")
+    except (OSError, ConnectionError, RuntimeError, asyncio.TimeoutError):
+        os.kill(vm["pid"], signal.SIGTERM)
+
+    if not await lifecycle_wait(vm, QUIT_TIMEOUT):
+        LOG.error("%s (pid %d) is still running", vm["name"], vm["pid"])
+        return 1
+
+    LOG.info("Stopped %s in %.3fs", vm["name"], time.monotonic() - started)
+    return 0
+
+
+def lifecycle_parser(command, description):
+    parser = argparse.ArgumentParser(prog="{} {}".format(os.path.basename(sys.argv[0]), command), description=description)
+    parser.add_argument("names", nargs="*", help="names or ids of the VMs (default: all)")
+    return parser
+
+
+def ps_command(argv):
+    opts = lifecycle_parser("ps", "List the VMs").parse_args(argv)
+    vms = lifecycle_vms(opts.names)
+
+    async def statuses():
+        return await asyncio.gather(*(lifecycle_status(vm) for vm in vms))
+
+    print("{:<30} {:<8} {:>8} {}".format("NAME", "ID", "PID", "STATUS"))
+
+    for vm, status in zip(vms, asyncio.run(statuses())):
+        print("{:<30} {:<8} {:>8} {}".format(vm["name"], vm["id"], vm["pid"] or "-", status))
+
+    return 0
+
+
+def stop_command(argv, command="stop", graceful=True):
+    parser = lifecycle_parser(command, "Power down the VMs, then quit the ones still running" if graceful else "Quit the VMs")
+
+    if graceful:
+        parser.add_argument("-t", "--timeout", type=float, default=60, help="seconds to wait for the power down (default: %(default)s)")
+
+    opts = parser.parse_args(argv)
+    vms = lifecycle_vms(opts.names)
+
+    async def stop():
+        return await asyncio.gather(*(lifecycle_stop(vm, opts.timeout if graceful else 0, graceful) for vm in vms))
+
+    return 1 if any(asyncio.run(stop())) else 0
+
+
+def kill_command(argv):
+    return stop_command(argv, "kill", graceful=False)
+
+
+def restart_command(argv):
+    parser = lifecycle_parser("restart", "Stop the VMs and start them again from their cached expansion")
+    parser.add_argument("-t", "--timeout", type=float, default=60, help="seconds to wait for the power down (default: %(default)s)")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="size of the worker pool (default: %(default)s)")
+    opts = parser.parse_args(argv)
+    vms = lifecycle_vms(opts.names)
+
+    for vm in vms:
+        if vm["args"] is None:
+            raise ValueError("No cached expansion for {} in {}".format(vm["name"], vm["runtime"]))
+
+    async def stop():
+        return await asyncio.gather(*(lifecycle_stop(vm, opts.timeout) for vm in vms))
+
+    if any(asyncio.run(stop())):
+        return 1
+
+    plans = []
+
+    for vm in vms:
+        with open("{}/expansion.json".format(vm["runtime"]), "r") as cache_fd:
+            plans.append((vm["name"], vm["args"], json.load(cache_fd)["plan"]))
+
+    return 1 if launch(plans, opts.workers) else 0
+
+
+def wait_command(argv):
+    parser = lifecycle_parser("wait", "Wait for the VMs to exit")
+    parser.add_argument("-t", "--timeout", type=float, default=None, help="seconds to wait (default: forever)")
+    opts = parser.parse_args(argv)
+    vms = lifecycle_vms(opts.names)
+
+    async def wait_all():
+        return await asyncio.gather(*(lifecycle_wait(vm, float("inf") if opts.timeout is None else opts.timeout) for vm in vms))
+
+    return 0 if all(asyncio.run(wait_all())) else 1
+
+
+def template_command(argv):
+    parser = argparse.ArgumentParser(
+        prog="{} template".format(os.path.basename(sys.argv[0])),
+        description="Boot a template VM and save its state for the VMs started with {warm,<template name>}",
+    )
+    parser.add_argument("-r", "--ready", help="regex of the serial output telling the template is ready (default: the guest agent answers)")
+    parser.add_argument("-t", "--timeout", type=float, default=300, help="seconds to wait for the template to be ready (default: %(default)s)")
+    parser.add_argument("args", nargs=argparse.REMAINDER, help="-- followed by the easy-qemu arguments of the template")
+    opts = parser.parse_args(argv)
+
+    expansion = qemu_expansion([sys.argv[0]] + opts.args[opts.args[:1] == ["--"] :])
+    args = expansion["args"]
+    runtime = next((step[1] for step in expansion["plan"] if step[0] == "runtime"), None)
+    # the template boots from fresh overlays, the clones of its previous state have to be stopped
+    plan = [tuple(step[:3]) + (True,) if step[0] == "snap" else step for step in expansion["plan"]]
+    snaps = [step[1] for step in plan if step[0] == "snap"]
+
+    if runtime is None or not snaps:
+        raise ValueError("The template needs a -name and a {hdd,...,snap} disk")
+
+    if launch([(args[args.index("-name") + 1], args, plan)]):
+        return 1
+
+    asyncio.run(template_save(runtime, warm_state(snaps[0]), opts.ready, opts.timeout))
+    return 0
+
+
+def cpio_newc(entries):
+    # entries are (name, mode, data, rdev), the archive format of the initramfs, see Documentation/driver-api/early-userspace
+    archive = b""
+
+    for ino, (name, mode, data, rdev) in enumerate(entries + [("TRAILER!!!", 0, b"", (0, 0))], 1):
+        name = name.encode() + b"\0"
+        fields = (ino, mode, 0, 0, 1, 0, len(data), 0, 0, rdev[0], rdev[1], len(name), 0)
+        header = b"070701" + b"".join(b"%08X" % field for field in fields)
+        archive += header + name + b"\0" * (-(len(header) + len(name)) % 4) + data + b"\0" * (-len(data) % 4)
+
+    return archive
+
+
+def elf_static(path):
+    # a static binary has no PT_INTERP program header, 64-bit little endian only
+    with open(path, "rb") as elf_fd:
+        elf = elf_fd.read(65536)
+
+    if elf[:5] != b"\x7fELF\x02":
+        return False
+
+    (phoff,) = struct.unpack_from("<Q", elf, 32)
+    phentsize, phnum = struct.unpack_from("<HH", elf, 54)
+    return all(struct.unpack_from("<I", elf, phoff + i * phentsize)[0] != 3 for i in range(phnum))
+
+
+def bench_initramfs(busybox):
+    # a busybox initramfs whose init prints the ready marker and powers off
+    if busybox is None or not elf_static(busybox):
+        raise ValueError("The bench initramfs needs a static busybox, pass it with --busybox")
+
+    with open(busybox, "rb") as busybox_fd:
+        binary = busybox_fd.read()
+
+    init = "#!/bin/busybox sh\necho {}\nexec /bin/busybox poweroff -f\n".format(BENCH_READY).encode()
+    entries = [
+        ("bin", 0o40755, b"", (0, 0)),
+        ("dev", 0o40755, b"", (0, 0)),
+        ("dev/console", 0o20600, b"", (5, 1)),
+        ("bin/busybox", 0o100755, binary, (0, 0)),
+        ("init", 0o100755, init, (0, 0)),
+    ]
+
+    with gzip.open(BENCH_INITRAMFS + ".tmp", "wb", compresslevel=1) as initramfs_fd:
+        initramfs_fd.write(cpio_newc(entries))
+
+    os.replace(BENCH_INITRAMFS + ".tmp", BENCH_INITRAMFS)
+    return BENCH_INITRAMFS
+
+
+async def bench_boot(runtime, markers, timeout):
+    # the VM is started paused, the serial console is connected before it runs so that no output is lost,
+    # the times of the markers are relative to the cont command, the markers not seen before the ready one are left out
+    serial_reader, serial_writer = await asyncio.open_unix_connection("{}/serial-0.sock".format(runtime))
+    reader, writer = await qmp_connect("{}/qmp.sock".format(runtime))
+    times = {}
+
+    try:
+        await qmp_execute(reader, writer, "cont")
+        started = time.monotonic()
+        window = b""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+
+        while "ready" not in times:
+            chunk = await asyncio.wait_for(serial_reader.read(4096), max(0, deadline - loop.time()))
+
+            if not chunk:
+                raise ConnectionError("Serial connection closed")
+
+            now = time.monotonic() - started
+            times.setdefault("first byte", now)
+            window = (window + chunk)[-65536:]
+
+            for marker, matcher in markers.items():
+                if marker not in times and matcher.search(window):
+                    times[marker] = now
+    finally:
+        serial_writer.close()
+
+        try:
+            await qmp_execute(reader, writer, "quit")
+        except (OSError, ConnectionError):
+            pass
+
+        writer.close()
+
+    return times
+
+
+def percentile(values, p):
+    # nearest rank
+    values = sorted(values)
+    return values[max(0, min(len(values) - 1, -(-len(values) * p // 100) - 1))]
+
+
+def bench_command(argv):
+    parser = argparse.ArgumentParser(prog="{} bench".format(os.path.basename(sys.argv[0])), description="Measure the boot time of VM variants")
+    parser.add_argument("-n", "--runs", type=int, default=10, help="boots per variant (default: %(default)s)")
+    parser.add_argument("-r", "--ready", default=BENCH_READY, help="regex of the serial output of a booted VM (default: %(default)s)")
+    parser.add_argument("--handoff", default=r"Linux version", help="regex of the serial output of the kernel handoff (default: %(default)s)")
+    parser.add_argument("-t", "--timeout", type=float, default=120, help="seconds to wait for a boot (default: %(default)s)")
+    parser.add_argument("-k", "--kernel", help="kernel booted by the variants without -kernel or disk (default: the newest /boot/vmlinuz-*)")
+    parser.add_argument("--busybox", default=shutil.which("busybox"), help="static busybox of the initramfs (default: %(default)s)")
+    parser.add_argument("-o", "--output", help="write every boot as a JSON line to this file")
+    parser.add_argument("variants", help="INI file with one section per variant, like the fleet manifest")
+    opts = parser.parse_args(argv)
+
+    markers = {"handoff": re.compile(opts.handoff.encode()), "ready": re.compile(opts.ready.encode())}
+    variants = []
+    initramfs = None
+
+    for name, args in fleet_manifest(opts.variants, sys.argv[0]):
+        args = args + ["-S", "{monitor}"] + ([] if any("{serial" in arg for arg in args) else ["{serial}"])
+
+        # the variants that do not boot anything of their own boot the tiny kernel and initramfs
+        if not any(arg in ("-kernel", "-drive", "-hda") or "{hdd" in arg or "{cd" in arg for arg in args):
+            kernel = opts.kernel or max(
+                (os.path.join("/boot", entry) for entry in os.listdir("/boot") if entry.startswith("vmlinuz")), key=os.path.getmtime, default=None
+            )
+
+            if kernel is None:
+                raise ValueError("No kernel found for {}, pass one with --kernel".format(name))
+
+            if initramfs is None:
+                initramfs = bench_initramfs(opts.busybox)
+            args += ["-kernel", kernel, "-initrd", initramfs, "-append", "console=ttyS0 earlyprintk=serial,ttyS0 panic=-1"]
+
+        variants.append((name, qemu_expansion(args, cache=False)))
+
+    results = {}
+    output = open(opts.output, "w") if opts.output else None
+
+    try:
+        # the boots run one at a time, concurrent boots would measure each other
+        for name, expansion in variants:
+            args, plan = expansion["args"], expansion["plan"]
+            runtime = next(step[1] for step in plan if step[0] == "runtime")
+            results[name] = []
+
+            for run in range(opts.runs):
+                context = prepare(plan)
+                fds = prepare_fds(plan, context)
+                started = time.monotonic()
+                proc = launch_spawn(args, fds)
+
+                for fd in fds.values():
+                    os.close(fd)
+
+                daemonized = launch_wait(name, started, proc)
+                times = {marker: daemonized + elapsed for marker, elapsed in asyncio.run(bench_boot(runtime, markers, opts.timeout)).items()}
+                times["daemonized"] = daemonized
+                asyncio.run(lifecycle_wait({"runtime": runtime}, QUIT_TIMEOUT))
+                results[name].append(times)
+                LOG.info("%s run %d: %s", name, run + 1, ", ".join("{} {:.3f}s".format(marker, elapsed) for marker, elapsed in times.items()))
+
+                if output is not None:
+                    output.write(json.dumps({"variant": name, "run": run + 1, "times": times}) + "\n")
+    finally:
+        if output is not None:
+            output.close()
+
+    columns = ["daemonized", "first byte", "handoff", "ready"]
+    first = variants[0][0]
+    summary = {name: {column: [times[column] for times in runs if column in times] for column in columns} for name, runs in results.items()}
+    baseline = percentile(summary[first]["ready"], 50)
+    header = ["VARIANT"] + [column + " p50" for column in columns] + ["ready p90", "ready p99", "vs " + first]
+    row = "{:<24}" + " {:>15}" * (len(header) - 1)
+    print(row.format(*header))
+
+    for name, values in summary.items():
+        cells = ["{:.3f}s".format(percentile(values[column], 50)) if values[column] else "-" for column in columns]
+        cells += ["{:.3f}s".format(percentile(values["ready"], p)) for p in (90, 99)]
+        cells.append("{:+.1f}%".format((percentile(values["ready"], 50) / baseline - 1) * 100))
+        print(row.format(name, *cells))
+
+    return 0
+
+
+def gc_command(argv):
+    parser = argparse.ArgumentParser(
+        prog="{} gc".format(os.path.basename(sys.argv[0])), description="Remove the firewall rules of bridges and taps that no longer exist"
+    )
+    parser.add_argument("-n", "--dry-run", action="store_true", help="only log the rules that would be removed")
+    opts = parser.parse_args(argv)
+
+    ifaces = set(os.listdir("/sys/class/net"))
+    seen = set()
+    changes = []
+
+    for table, rule in firewall_state():
+        owners = [iface for iface in firewall_ifaces(rule) if FIREWALL_IFACE_MATCHER.fullmatch(iface)]
+
+        if not owners:
+            continue
+
+        key = firewall_key(table, rule)
+
+        if any(owner not in ifaces for owner in owners) or key in seen:
+            changes.append(("-D", table, rule))
+
+        seen.add(key)
+
+    LOG.info("Found %d stale firewall rules", len(changes))
+
+    for _, table, rule in changes:
+        LOG.info("Stale rule: -t %s -A %s", table, " ".join(map(firewall_quote, rule)))
+
+    if changes and not opts.dry_run:
+        firewall_apply(changes)
+
+    return 0
+
+
+PREPARE_STEPS = {
+    "hugepages": (0, prepare_hugepages),
+    "runtime": (1, prepare_runtime),
+    "network": (1, prepare_network),
+    "tap": (2, prepare_tap),
+    "pin": (1, prepare_pin),
+    "hdd": (1, prepare_hdd),
+    "snap": (2, prepare_snap),
+    "warm": (0, prepare_warm),
+}
+
+LAUNCH_STEPS = {
+    "balloon": balloon_stats,
+    "pin": pin_threads,
+    "warm": warm_resume,
+}
+
+COMMANDS = {
+    "balloon": balloon_command,
+    "bench": bench_command,
+    "--print": print_command,
+    "fleet": fleet_command,
+    "gc": gc_command,
+    "kill": kill_command,
+    "metrics": metrics_command,
+    "ps": ps_command,
+    "restart": restart_command,
+    "stop": stop_command,
+    "template": template_command,
+    "wait": wait_command,
+}
+
+
+if __name__ == "__main__":
+    LOG = getLogger(__name__, os.environ.get("LOGLEVEL", "INFO"))
+
+    try:
+        if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+            sys.exit(COMMANDS[sys.argv[1]](sys.argv[2:]))
+
         qemu_command(sys.argv)
     except Exception as e:
         LOG.error("%s", e)
@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+
+# Writes a file to the root directory of the FAT filesystem of the EFI system partition of a disk, image file or device,
+# without mounting it, like the vm-bootstrap.env read by the vm-bootstrap.service of the ubuntu_focal images.
+# Raw disks only, a qcow2 image has to be converted or exposed by qemu-nbd first.
+
+from argparse import ArgumentParser
+from datetime import datetime
+from string import ascii_uppercase, digits
+from struct import pack, pack_into, unpack_from
+from sys import stdin
+
+EFI_SYSTEM_PARTITION = bytes.fromhex("28732ac11ff8d211ba4b00a0c93ec93b")
+
+# devices like the FreeBSD zvols only take reads and writes of whole sectors
+ALIGNMENT = 4096
+
+ATTR_LONG_NAME = 0x0F
+ATTR_VOLUME_ID = 0x08
+ATTR_ARCHIVE = 0x20
+DELETED = 0xE5
+SHORT_NAME_CHARS = set(ascii_uppercase + digits + "!#$%&'()-@^_`{}~")
+
+
+class Disk:
+    def __init__(self, path):
+        self.file = open(path, "r+b", buffering=0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.file.close()
+
+    def read(self, offset, size):
+        start = offset - offset % ALIGNMENT
+        end = -(-(offset + size) // ALIGNMENT) * ALIGNMENT
+        self.file.seek(start)
+        data = self.file.read(end - start)
+
+        if len(data) < offset - start + size:
+            raise ValueError("Short read at offset {}".format(offset))
+
+        return data[offset - start : offset - start + size]
+
+    def write(self, offset, data):
+        start = offset - offset % ALIGNMENT
+        end = -(-(offset + len(data)) // ALIGNMENT) * ALIGNMENT
+        block = bytearray(self.read(start, end - start))
+        block[offset - start : offset - start + len(data)] = data
+        self.file.seek(start)
+        self.file.write(block)
+
+
+class Fat:
+    # FAT12, FAT16 or FAT32, told apart by the cluster count as the specification does
+    def __init__(self, disk, offset):
+        bpb = disk.read(offset, 512)
+
+        if bpb[510:512] != b"\x55\xaa":
+            raise ValueError("No FAT filesystem at offset {}".format(offset))
+
+        sector_size, cluster_sectors, reserved, self.fats, root_entries, total, _, fat_sectors = unpack_from("<HBHBHHBH", bpb, 11)
+        total = total or unpack_from("<I", bpb, 32)[0]
+        fat_sectors = fat_sectors or unpack_from("<I", bpb, 36)[0]
+        root_sectors = -(-root_entries * 32 // sector_size)
+
+        self.disk = disk
+        self.offset = offset
+        self.fat_offset = offset + reserved * sector_size
+        self.fat_size = fat_sectors * sector_size
+        self.root_offset = self.fat_offset + self.fats * self.fat_size
+        self.root_size = root_entries * 32
+        self.data_offset = self.root_offset + root_sectors * sector_size
+        self.cluster_size = cluster_sectors * sector_size
+        self.clusters = (total - reserved - self.fats * fat_sectors - root_sectors) // cluster_sectors
+        self.bits = 12 if self.clusters < 4085 else 16 if self.clusters < 65525 else 32
+        self.eoc = (1 << self.bits) - 1 if self.bits < 32 else 0x0FFFFFFF
+        self.root_cluster = unpack_from("<I", bpb, 44)[0] if self.bits == 32 else None
+        self.fsinfo = unpack_from("<H", bpb, 48)[0] * sector_size if self.bits == 32 else None
+        self.fat = bytearray(disk.read(self.fat_offset, self.fat_size))
+
+    def get(self, cluster):
+        if self.bits == 12:
+            value = unpack_from("<H", self.fat, cluster + cluster // 2)[0]
+            return value >> 4 if cluster & 1 else value & 0xFFF
+
+        if self.bits == 16:
+            return unpack_from("<H", self.fat, cluster * 2)[0]
+
+        return unpack_from("<I", self.fat, cluster * 4)[0] & 0x0FFFFFFF
+
+    def set(self, cluster, value):
+        if self.bits == 12:
+            current = unpack_from("<H", self.fat, cluster + cluster // 2)[0]
+            value = (current & 0x000F) | (value << 4) if cluster & 1 else (current & 0xF000) | value
+            pack_into("<H", self.fat, cluster + cluster // 2, value)
+        elif self.bits == 16:
+            pack_into("<H", self.fat, cluster * 2, value)
+        else:
+            pack_into("<I", self.fat, cluster * 4, (unpack_from("<I", self.fat, cluster * 4)[0] & 0xF0000000) | value)
+
+    def chain(self, cluster):
+        clusters = []
+
+        while 2 <= cluster < self.eoc - 7:
+            if len(clusters) > self.clusters:
+                raise ValueError("Cluster chain loop at {}".format(cluster))
+
+            clusters.append(cluster)
+            cluster = self.get(cluster)
+
+        return clusters
+
+    def allocate(self, count, previous=None):
+        free = []
+
+        for cluster in range(2, self.clusters + 2):
+            if len(free) == count:
+                break
+
+            if self.get(cluster) == 0:
+                free.append(cluster)
+
+        if len(free) < count:
+            raise ValueError("No space left for {} clusters".format(count))
+
+        for cluster, following in zip([previous] + free, free + [self.eoc]):
+            if cluster is not None:
+                self.set(cluster, following)
+
+        return free
+
+    def cluster_offset(self, cluster):
+        return self.data_offset + (cluster - 2) * self.cluster_size
+
+    def directory(self):
+        # the root directory as (offset, entry) slots
+        if self.root_cluster is None:
+            regions = [(self.root_offset, self.root_size)]
+        else:
+            regions = [(self.cluster_offset(cluster), self.cluster_size) for cluster in self.chain(self.root_cluster)]
+
+        slots = []
+
+        for offset, size in regions:
+            data = self.disk.read(offset, size)
+            slots.extend((offset + i, data[i : i + 32]) for i in range(0, size, 32))
+
+        return slots
+
+    def files(self, slots):
+        # {name: (first cluster, size, [slot offsets of the long name and short name entries])}, the names in upper case
+        files = {}
+        long_name = []
+        long_slots = []
+
+        for offset, entry in slots:
+            if entry[0] == 0:
+                break
+
+            if entry[0] == DELETED:
+                long_name, long_slots = [], []
+                continue
+
+            if entry[11] == ATTR_LONG_NAME:
+                if entry[0] & 0x40:
+                    long_name, long_slots = [], []
+
+                long_name.insert(0, (entry[1:11] + entry[14:26] + entry[28:32]).decode("utf-16-le", errors="replace"))
+                long_slots.append(offset)
+                continue
+
+            if not entry[11] & ATTR_VOLUME_ID:
+                name, ext = entry[:8].decode("latin-1").rstrip(), entry[8:11].decode("latin-1").rstrip()
+                short = name + ("." + ext if ext else "")
+                cluster = unpack_from("<H", entry, 26)[0] | (unpack_from("<H", entry, 20)[0] << 16 if self.bits == 32 else 0)
+                info = (cluster, unpack_from("<I", entry, 28)[0], long_slots + [offset])
+                files[short.upper()] = info
+
+                if long_name:
+                    files["".join(long_name).split("\0")[0].upper()] = info
+
+            long_name, long_slots = [], []
+
+        return files
+
+    def read_file(self, name):
+        cluster, size, _ = self.files(self.directory())[name.upper()]
+        return b"".join(self.disk.read(self.cluster_offset(c), self.cluster_size) for c in self.chain(cluster))[:size]
+
+    def write_file(self, name, data, now=None):
+        slots = self.directory()
+        files = self.files(slots)
+
+        # a replaced file is deleted first, its clusters and entries are reused
+        if name.upper() in files:
+            cluster, _, entries = files[name.upper()]
+
+            for freed in self.chain(cluster):
+                self.set(freed, 0)
+
+            for offset in entries:
+                self.disk.write(offset, bytes([DELETED]))
+
+            slots = self.directory()
+            files = self.files(slots)
+
+        clusters = self.allocate(-(-len(data) // self.cluster_size))
+
+        for index, cluster in enumerate(clusters):
+            chunk = data[index * self.cluster_size : (index + 1) * self.cluster_size]
+            self.disk.write(self.cluster_offset(cluster), chunk + bytes(self.cluster_size - len(chunk)))
+
+        short = short_name(name, files)
+        entries = long_name_entries(name, short) if short != name else []
+        now = now or datetime.now()
+        date = ((now.year - 1980) << 9) | (now.month << 5) | now.day
+        time = (now.hour << 11) | (now.minute << 5) | (now.second // 2)
+        first = clusters[0] if clusters else 0
+        base, _, ext = short.partition(".")
+        entries.append(pack("<11sBBBHHHHHHHI", "{:<8}{:<3}".format(base, ext).encode(), ATTR_ARCHIVE, 0, 0, time, date, date, first >> 16, time, date, first & 0xFFFF, len(data)))
+
+        free = self.free_slots(slots, len(entries))
+
+        # the data and the allocation first, a file is never listed before its clusters are
+        for copy in range(self.fats):
+            self.disk.write(self.fat_offset + copy * self.fat_size, self.fat)
+
+        for offset, entry in zip(free, entries):
+            self.disk.write(offset, entry)
+
+        # the free cluster count and hint of FAT32 become unknown, the fsck recomputes them
+        if self.fsinfo:
+            self.disk.write(self.offset + self.fsinfo + 488, pack("<II", 0xFFFFFFFF, 0xFFFFFFFF))
+
+    def free_slots(self, slots, count):
+        # a run of count free slots, the slots after the end of directory marker are all free
+        run = []
+        end = False
+
+        for offset, entry in slots:
+            end = end or entry[0] == 0
+            run = run + [offset] if end or entry[0] == DELETED else []
+
+            if len(run) == count:
+                return run
+
+        if self.root_cluster is None:
+            raise ValueError("The root directory is full")
+
+        # the FAT32 root directory grows by zeroed clusters
+        needed = -(-(count - len(run)) * 32 // self.cluster_size)
+        clusters = self.allocate(needed, self.chain(self.root_cluster)[-1])
+
+        for cluster in clusters:
+            self.disk.write(self.cluster_offset(cluster), bytes(self.cluster_size))
+            run.extend(self.cluster_offset(cluster) + i for i in range(0, self.cluster_size, 32))
+
+        return run[:count]
+
+
+def short_name(name, files):
+    # the 8.3 name as is when it is one, else a basis name with a numeric tail like VM-BOO~1.ENV
+    base, _, ext = name.upper().rpartition(".") if "." in name.strip(".") else (name.upper(), "", "")
+    clean_base = "".join(c for c in base if c in SHORT_NAME_CHARS) or "_"
+    clean_ext = "".join(c for c in ext if c in SHORT_NAME_CHARS)[:3]
+
+    if clean_base == base and clean_ext == ext and len(base) <= 8 and base + ("." + ext if ext else "") not in files:
+        return base + ("." + ext if ext else "")
+
+    for tail in range(1, 1000000):
+        short = "{}~{}".format(clean_base[: 7 - len(str(tail))], tail) + ("." + clean_ext if clean_ext else "")
+
+        if short not in files:
+            return short
+
+    raise ValueError("No short name left for {}".format(name))
+
+
+def long_name_entries(name, short):
+    base, _, ext = short.partition(".")
+    checksum = 0
+
+    for c in "{:<8}{:<3}".format(base, ext).encode():
+        checksum = (((checksum & 1) << 7) + (checksum >> 1) + c) & 0xFF
+
+    # 13 UCS-2 characters per entry, the name is terminated by a NUL when it does not fill the last entry and padded with 0xFFFF
+    chars = name.encode("utf-16-le")
+    chars += b"\0\0" if len(chars) % 26 else b""
+    chars += b"\xff" * (-len(chars) % 26)
+    entries = []
+
+    for index in range(len(chars) // 26):
+        part = chars[index * 26 : (index + 1) * 26]
+        order = index + 1 | (0x40 if index == len(chars) // 26 - 1 else 0)
+        entries.insert(0, pack("<B10sBBB12sH4s", order, part[:10], ATTR_LONG_NAME, 0, checksum, part[10:22], 0, part[22:26]))
+
+    return entries
+
+
+def efi_partition(disk, number=None):
+    # (offset, size) in bytes of the EFI system partition or of the partition number given, the GPT of 512 byte sectors first
+    for sector in (512, 4096):
+        header = disk.read(sector, 92)
+
+        if header[:8] != b"EFI PART":
+            continue
+
+        entries_lba, count, entry_size = unpack_from("<QII", header, 72)
+        table = disk.read(entries_lba * sector, count * entry_size)
+
+        for index in range(count):
+            entry = table[index * entry_size : (index + 1) * entry_size]
+            first, last = unpack_from("<QQ", entry, 32)
+
+            if entry[:16] != bytes(16) and (number == index + 1 if number else entry[:16] == EFI_SYSTEM_PARTITION):
+                return first * sector, (last - first + 1) * sector
+
+        raise ValueError("No {} in the GPT".format("partition {}".format(number) if number else "EFI system partition"))
+
+    raise ValueError("No GPT found")
+
+
+def write_file(path, name, data, partition=None):
+    with Disk(path) as disk:
+        offset, _ = efi_partition(disk, partition)
+        Fat(disk, offset).write_file(name, data)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Write a file to the EFI system partition of a raw disk image or device")
+    parser.add_argument("-p", "--partition", type=int, help="number of the FAT partition (default: the EFI system partition)")
+    parser.add_argument("image", help="raw disk image or device")
+    parser.add_argument("name", help="name of the file in the root directory, like vm-bootstrap.env")
+    parser.add_argument("source", nargs="?", help="file to write (default: stdin)")
+    args = parser.parse_args()
+
+    if args.source is None:
+        content = stdin.buffer.read()
+    else:
+        with open(args.source, "rb") as f:
+            content = f.read()
+
+    write_file(args.image, args.name, content, args.partition)
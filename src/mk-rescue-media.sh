@@ -3,7 +3,7 @@
 
 set -e
 
-for cmd in debootstrap chroot mksquashfs; do
+for cmd in debootstrap chroot mksquashfs sha256sum; do
     if ! which $cmd >/dev/null; then
         printf "command '%s' is missing\n" $cmd >&2
         exit 1
@@ -23,6 +23,51 @@ done
 
 unset fss fs
 
+# The media is built in layers, base.squashfs from debootstrap, live.squashfs with the live system on top of it and the
+# ISO, each kept in RESCUE_CACHE under a key hashed from the debootstrap arguments, the scripts run in the chroot and
+# the squashfs settings, chained to the key of the layer below. A layer whose key did not change is reused as it is,
+# changing the live script only rebuilds live.squashfs and the ISO. Remove the files of a layer to rebuild it, like
+# after an update of the packages.
+RESCUE_CACHE="$(readlink -f "${RESCUE_CACHE:-/var/cache/rescue-media}")"
+
+SUITE=focal
+MIRROR=http://archive.ubuntu.com/ubuntu
+COMPONENTS=main,restricted,multiverse,universe
+
+# SQUASHFS_COMP is zstd, faster to build and to boot, or xz, smaller, SQUASHFS_BLOCK the block size, up to 1M
+SQUASHFS_COMP="${SQUASHFS_COMP:-zstd}"
+SQUASHFS_BLOCK="${SQUASHFS_BLOCK:-1M}"
+SQUASHFS_PROCESSORS="${SQUASHFS_PROCESSORS:-$(nproc)}"
+
+case "$SQUASHFS_COMP" in
+    zstd) SQUASHFS_OPTS="-comp zstd -Xcompression-level 19 -b $SQUASHFS_BLOCK" ;;
+    xz) SQUASHFS_OPTS="-comp xz -Xbcj x86 -Xdict-size 100% -b $SQUASHFS_BLOCK" ;;
+    *)
+        printf "unsupported squashfs compression '%s'\n" "$SQUASHFS_COMP" >&2
+        exit 1
+        ;;
+esac
+
+layer_key() {
+    # the arguments and the scripts read from stdin
+    { printf '%s\n' "$@"; cat; } | sha256sum | cut -c1-16
+}
+
+layer_log() {
+    # layer, key, built or reused, file or dir, start in ns, appended to layers.log of the cache too
+    printf '%s %s %s: %s bytes in %sms\n' "$1" "$2" "$3" "$(du -sb "$4" | cut -f1)" "$((($(date +%s%N) - $5) / 1000000))" |
+        tee -a "$RESCUE_CACHE/layers.log" >&2
+}
+
+squashfs() {
+    # dir, layer, key, built aside and renamed so an interrupted build is never reused
+    STEP_START=$(date +%s%N)
+    # shellcheck disable=SC2086
+    mksquashfs "$1" "$RESCUE_CACHE/$2-$3.squashfs.tmp" -noappend -processors "$SQUASHFS_PROCESSORS" $SQUASHFS_OPTS
+    mv "$RESCUE_CACHE/$2-$3.squashfs.tmp" "$RESCUE_CACHE/$2-$3.squashfs"
+    layer_log "$2" "$3" built "$RESCUE_CACHE/$2-$3.squashfs" $STEP_START
+}
+
 set --
 trap 'for cleanup in "$@"; do eval "$cleanup"; done' INT TERM EXIT
 
@@ -31,28 +76,17 @@ if test -f rescue-media.iso; then
     exit 1
 fi
 
+mkdir -p "$RESCUE_CACHE"
+
 WORKDIR=$(mktemp -d); set -- "rm -rf $WORKDIR" "$@"
 
 CHROOT=$WORKDIR/chroot
 ISO=$WORKDIR/iso
+SCRIPTS=$WORKDIR/scripts
 
-mkdir -p $CHROOT $ISO
-
-mount -t tmpfs -o size=1024m tmpfs $ISO; set -- "umount $ISO" "$@"
-
-mkdir -p $WORKDIR/base
-
-mount -t tmpfs -o size=2048m tmpfs $WORKDIR/base; set -- "umount $WORKDIR/base" "$@"
-mount -o bind $WORKDIR/base $CHROOT; set -- "umount $CHROOT" "$@"
+mkdir -p $CHROOT $ISO $SCRIPTS
 
-debootstrap --arch=amd64 --components=main,restricted,multiverse,universe focal $CHROOT http://archive.ubuntu.com/ubuntu
-
-mount -t proc proc $CHROOT/proc; set -- "umount $CHROOT/proc" "$@"
-mount -t sysfs sys $CHROOT/sys; set -- "umount $CHROOT/sys" "$@"
-mount -o bind /dev $CHROOT/dev; set -- "umount $CHROOT/dev" "$@"
-mount -o bind /dev/pts $CHROOT/dev/pts; set -- "umount $CHROOT/dev/pts" "$@"
-
-LC_ALL=C LANGUAGE=C LANG=C chroot $CHROOT sh <<'SHELL'
+tee $SCRIPTS/locale.sh >/dev/null <<'SHELL'
 mkdir -p /var/lib/locales/supported.d
 rm -rf /usr/lib/locale/* /var/lib/locales/supported.d/*
 
@@ -86,7 +120,7 @@ TEXT
 ln -sfn /usr/share/zoneinfo/Europe/Lisbon /etc/localtime
 SHELL
 
-chroot $CHROOT sh <<'SHELL'
+tee $SCRIPTS/base.sh >/dev/null <<'SHELL'
 . /etc/os-release
 
 tee /etc/apt/sources.list >/dev/null <<TEXT
@@ -182,33 +216,7 @@ find /var/log -type f -name '*.log' -print0 | xargs -0I% truncate -s0 "%"
 find /var/lib/apt/lists -type f ! -name lock -print0 | xargs -0I% rm "%"
 SHELL
 
-eval "$1"; shift # /dev/pts
-eval "$1"; shift # /dev
-eval "$1"; shift # /sys
-eval "$1"; shift # /proc
-eval "$1"; shift # /chroot
-
-mkdir -p $ISO/live
-
-mksquashfs $WORKDIR/base $ISO/live/base.squashfs -noappend
-
-eval "$1"; shift # /base
-
-mount -t squashfs $ISO/live/base.squashfs $WORKDIR/base; set -- "umount $WORKDIR/base" "$@"
-
-mkdir -p $WORKDIR/live
-
-mount -t tmpfs -o size=1024m tmpfs $WORKDIR/live; set -- "umount $WORKDIR/live" "$@"
-
-mkdir -p $WORKDIR/live/upperdir $WORKDIR/live/workdir
-
-mount -t overlay -o lowerdir=$WORKDIR/base,upperdir=$WORKDIR/live/upperdir,workdir=$WORKDIR/live/workdir overlay $CHROOT; set -- "umount $CHROOT" "$@"
-mount -t proc proc $CHROOT/proc; set -- "umount $CHROOT/proc" "$@"
-mount -t sysfs sys $CHROOT/sys; set -- "umount $CHROOT/sys" "$@"
-mount -o bind /dev $CHROOT/dev; set -- "umount $CHROOT/dev" "$@"
-mount -o bind /dev/pts $CHROOT/dev/pts; set -- "umount $CHROOT/dev/pts" "$@"
-
-chroot $CHROOT sh <<'SHELL'
+tee $SCRIPTS/live.sh >/dev/null <<'SHELL'
 export DEBIAN_FRONTEND=noninteractive
 
 apt-get update
@@ -268,34 +276,7 @@ find /var/log -type f -name '*.log' -print0 | xargs -0I% truncate -s0 "%"
 find /var/lib/apt/lists -type f ! -name lock -print0 | xargs -0I% rm "%"
 SHELL
 
-eval "$1"; shift # /dev/pts
-eval "$1"; shift # /dev
-eval "$1"; shift # /sys
-eval "$1"; shift # /proc
-eval "$1"; shift # /chroot
-
-mksquashfs $WORKDIR/live/upperdir $ISO/live/live.squashfs -noappend
-
-eval "$1"; shift # /live
-
-mount -t squashfs $ISO/live/live.squashfs $WORKDIR/live; set -- "umount $WORKDIR/live" "$@"
-
-mkdir -p $WORKDIR/tmp
-
-mount -t tmpfs -o size=1024m tmpfs $WORKDIR/tmp; set -- "umount $WORKDIR/tmp" "$@"
-
-mkdir -p $WORKDIR/tmp/upperdir $WORKDIR/tmp/workdir
-
-mount -t overlay -o lowerdir=$WORKDIR/live:$WORKDIR/base,upperdir=$WORKDIR/tmp/upperdir,workdir=$WORKDIR/tmp/workdir overlay $CHROOT; set -- "umount $CHROOT" "$@"
-mount -t proc proc $CHROOT/proc; set -- "umount $CHROOT/proc" "$@"
-mount -t sysfs sys $CHROOT/sys; set -- "umount $CHROOT/sys" "$@"
-mount -o bind /dev $CHROOT/dev; set -- "umount $CHROOT/dev" "$@"
-mount -o bind /dev/pts $CHROOT/dev/pts; set -- "umount $CHROOT/dev/pts" "$@"
-
-mkdir -p $CHROOT/iso
-mount -o bind $ISO $CHROOT/iso; set -- "umount $CHROOT/iso" "$@"
-
-chroot $CHROOT sh <<'SHELL'
+tee $SCRIPTS/iso.sh >/dev/null <<'SHELL'
 mkdir -p /iso/boot/grub /iso/EFI/boot
 
 cp /boot/initrd.img /iso/live/initrd
@@ -364,4 +345,120 @@ xorriso \
     /iso
 SHELL
 
-cp $CHROOT/rescue-media.iso ./
+BASE_KEY=$(cat $SCRIPTS/locale.sh $SCRIPTS/base.sh | layer_key $SUITE $MIRROR $COMPONENTS "$SQUASHFS_OPTS")
+LIVE_KEY=$(cat $SCRIPTS/live.sh | layer_key $BASE_KEY "$SQUASHFS_OPTS")
+ISO_KEY=$(cat $SCRIPTS/iso.sh | layer_key $LIVE_KEY)
+
+if test -f "$RESCUE_CACHE/rescue-media-$ISO_KEY.iso"; then
+    STEP_START=$(date +%s%N)
+    cp "$RESCUE_CACHE/rescue-media-$ISO_KEY.iso" ./rescue-media.iso
+    layer_log iso $ISO_KEY reused ./rescue-media.iso $STEP_START
+    exit 0
+fi
+
+mount -t tmpfs -o size=1024m tmpfs $ISO; set -- "umount $ISO" "$@"
+
+mkdir -p $ISO/live $WORKDIR/base $WORKDIR/live
+
+if test -f "$RESCUE_CACHE/base-$BASE_KEY.squashfs"; then
+    STEP_START=$(date +%s%N)
+    cp "$RESCUE_CACHE/base-$BASE_KEY.squashfs" $ISO/live/base.squashfs
+    layer_log base $BASE_KEY reused $ISO/live/base.squashfs $STEP_START
+else
+    STEP_START=$(date +%s%N)
+
+    mount -t tmpfs -o size=2048m tmpfs $WORKDIR/base; set -- "umount $WORKDIR/base" "$@"
+    mount -o bind $WORKDIR/base $CHROOT; set -- "umount $CHROOT" "$@"
+
+    # PKG_CACHE keeps the packages of debootstrap for the next builds, the apt-get installs in the chroot are cached by
+    # pointing http_proxy at pkg_cache.py serve, the chroot runs apt-get clean so its archives are not bind mounted
+    if test -n "$PKG_CACHE"; then
+        PKG_CACHE="$(readlink -f "$PKG_CACHE")"
+        mkdir -p "$PKG_CACHE/archives"
+    fi
+
+    debootstrap ${PKG_CACHE:+--cache-dir="$PKG_CACHE/archives"} --arch=amd64 --components=$COMPONENTS $SUITE $CHROOT $MIRROR
+
+    mount -t proc proc $CHROOT/proc; set -- "umount $CHROOT/proc" "$@"
+    mount -t sysfs sys $CHROOT/sys; set -- "umount $CHROOT/sys" "$@"
+    mount -o bind /dev $CHROOT/dev; set -- "umount $CHROOT/dev" "$@"
+    mount -o bind /dev/pts $CHROOT/dev/pts; set -- "umount $CHROOT/dev/pts" "$@"
+
+    LC_ALL=C LANGUAGE=C LANG=C chroot $CHROOT sh <$SCRIPTS/locale.sh
+    chroot $CHROOT sh <$SCRIPTS/base.sh
+
+    eval "$1"; shift # /dev/pts
+    eval "$1"; shift # /dev
+    eval "$1"; shift # /sys
+    eval "$1"; shift # /proc
+    eval "$1"; shift # /chroot
+
+    layer_log base $BASE_KEY chroot $WORKDIR/base $STEP_START
+    squashfs $WORKDIR/base base $BASE_KEY
+
+    eval "$1"; shift # /base
+
+    cp "$RESCUE_CACHE/base-$BASE_KEY.squashfs" $ISO/live/base.squashfs
+fi
+
+mount -t squashfs $ISO/live/base.squashfs $WORKDIR/base; set -- "umount $WORKDIR/base" "$@"
+
+if test -f "$RESCUE_CACHE/live-$LIVE_KEY.squashfs"; then
+    STEP_START=$(date +%s%N)
+    cp "$RESCUE_CACHE/live-$LIVE_KEY.squashfs" $ISO/live/live.squashfs
+    layer_log live $LIVE_KEY reused $ISO/live/live.squashfs $STEP_START
+else
+    STEP_START=$(date +%s%N)
+
+    mount -t tmpfs -o size=1024m tmpfs $WORKDIR/live; set -- "umount $WORKDIR/live" "$@"
+
+    mkdir -p $WORKDIR/live/upperdir $WORKDIR/live/workdir
+
+    mount -t overlay -o lowerdir=$WORKDIR/base,upperdir=$WORKDIR/live/upperdir,workdir=$WORKDIR/live/workdir overlay $CHROOT; set -- "umount $CHROOT" "$@"
+    mount -t proc proc $CHROOT/proc; set -- "umount $CHROOT/proc" "$@"
+    mount -t sysfs sys $CHROOT/sys; set -- "umount $CHROOT/sys" "$@"
+    mount -o bind /dev $CHROOT/dev; set -- "umount $CHROOT/dev" "$@"
+    mount -o bind /dev/pts $CHROOT/dev/pts; set -- "umount $CHROOT/dev/pts" "$@"
+
+    chroot $CHROOT sh <$SCRIPTS/live.sh
+
+    eval "$1"; shift # /dev/pts
+    eval "$1"; shift # /dev
+    eval "$1"; shift # /sys
+    eval "$1"; shift # /proc
+    eval "$1"; shift # /chroot
+
+    layer_log live $LIVE_KEY chroot $WORKDIR/live/upperdir $STEP_START
+    squashfs $WORKDIR/live/upperdir live $LIVE_KEY
+
+    eval "$1"; shift # /live
+
+    cp "$RESCUE_CACHE/live-$LIVE_KEY.squashfs" $ISO/live/live.squashfs
+fi
+
+mount -t squashfs $ISO/live/live.squashfs $WORKDIR/live; set -- "umount $WORKDIR/live" "$@"
+
+STEP_START=$(date +%s%N)
+
+mkdir -p $WORKDIR/tmp
+
+mount -t tmpfs -o size=1024m tmpfs $WORKDIR/tmp; set -- "umount $WORKDIR/tmp" "$@"
+
+mkdir -p $WORKDIR/tmp/upperdir $WORKDIR/tmp/workdir
+
+mount -t overlay -o lowerdir=$WORKDIR/live:$WORKDIR/base,upperdir=$WORKDIR/tmp/upperdir,workdir=$WORKDIR/tmp/workdir overlay $CHROOT; set -- "umount $CHROOT" "$@"
+mount -t proc proc $CHROOT/proc; set -- "umount $CHROOT/proc" "$@"
+mount -t sysfs sys $CHROOT/sys; set -- "umount $CHROOT/sys" "$@"
+mount -o bind /dev $CHROOT/dev; set -- "umount $CHROOT/dev" "$@"
+mount -o bind /dev/pts $CHROOT/dev/pts; set -- "umount $CHROOT/dev/pts" "$@"
+
+mkdir -p $CHROOT/iso
+mount -o bind $ISO $CHROOT/iso; set -- "umount $CHROOT/iso" "$@"
+
+chroot $CHROOT sh <$SCRIPTS/iso.sh
+
+cp $CHROOT/rescue-media.iso "$RESCUE_CACHE/rescue-media-$ISO_KEY.iso.tmp"
+mv "$RESCUE_CACHE/rescue-media-$ISO_KEY.iso.tmp" "$RESCUE_CACHE/rescue-media-$ISO_KEY.iso"
+layer_log iso $ISO_KEY built "$RESCUE_CACHE/rescue-media-$ISO_KEY.iso" $STEP_START
+
+cp "$RESCUE_CACHE/rescue-media-$ISO_KEY.iso" ./rescue-media.iso
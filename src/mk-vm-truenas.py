@@ -1,20 +1,31 @@
 #!/usr/bin/env python3
 
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser, ExtendedInterpolation
-from json import dumps, load
+from contextlib import contextmanager, nullcontext
+from hashlib import sha256
+from http.client import HTTPConnection, HTTPException
+from json import dumps, loads
 from logging import INFO, WARNING, basicConfig, getLogger
-from os import environ, execl, makedirs
-from os.path import dirname, realpath
+from os import environ, execl, stat
+from os.path import basename, dirname, realpath, splitext
 from pathlib import Path
+from queue import Empty, LifoQueue
 from random import randint
+from select import select
 from shutil import which
 from subprocess import DEVNULL, CalledProcessError, run  # nosec
 from sys import exit as sys_exit
 from sys import stderr
 from tempfile import NamedTemporaryFile
 from textwrap import dedent
+from threading import BoundedSemaphore, Lock
+from time import monotonic, sleep, time
 from urllib.error import HTTPError
-from urllib.request import Request, urlopen
+
+from disk_copy import copy
+from efi_inject import write_file
 
 
 def config(default):
@@ -29,8 +40,9 @@ def config(default):
     return parser
 
 
-CONFIG = config(
-    """
+def default_config():
+    # formatted again for every VM, each one gets its own random MAC
+    return """
     [VM]
     ;name = ubuntu
     ip = 10.0.0.
@@ -56,6 +68,8 @@ CONFIG = config(
     # Timeout in seconds
     shutdown_timeout = 90
     hdd_template = ${{App:cwd}}/hdd-template.qcow2
+    # Options for hdd_mode: clone (of a golden zvol converted once per template) | copy (convert the template for every VM)
+    hdd_mode = clone
     dataset = ${{TrueNAS:base_dataset}}/${{name}}-hdd
     ssh_key = {ssh_key}
 
@@ -63,12 +77,14 @@ CONFIG = config(
     host = 127.0.0.1
     key = 1-DEHN3UxEomg9jN1hOlrnjEBWeX3iHSZLNFUTmpdOEopAENUU6ch9HCEXoYsJbEAr
     base_dataset = nvme-r0-pool/vms
+    golden_dataset = ${{base_dataset}}/golden
 
     [App]
     debug = no
     cwd = {cwd}
-    root = ${{cwd}}/root
     qemu_img_path = ${{cwd}}/qemu-img
+    # JSON lines of the bytes expected to be written and skipped by every template conversion
+    copy_stats = ${{cwd}}/copy-stats.jsonl
     """.format(
         cwd=dirname(realpath(__file__)),
         mac="02:00:00:{:02X}:{:02X}:{:02X}".format(randint(0, 255), randint(0, 255), randint(0, 255)),  # nosec
@@ -83,68 +99,176 @@ CONFIG = config(
             ]
         ),
     )
-)
-
-VM_NAME = CONFIG.get("VM", "name")
-IP = CONFIG.get("VM", "ip")
-HOSTNAME = CONFIG.get("VM", "hostname")
-MEMORY = CONFIG.getint("VM", "memory")
-HDD_SIZE = CONFIG.getint("VM", "hdd_size") * 1073741824  # multiple of 16k = 16384
-CORES = CONFIG.getint("VM", "cores")
-VCPUS = CONFIG.getint("VM", "vcpus")
-THREADS = CONFIG.getint("VM", "threads")
-NIC = CONFIG.get("VM", "nic")
-MAC = CONFIG.get("VM", "mac")
-NETMASK = CONFIG.getint("VM", "netmask")
-GATEWAY = CONFIG.get("VM", "gateway")
-DOMAIN = CONFIG.get("VM", "domain")
-DNS = CONFIG.get("VM", "dns")
-SALT_MINION_ID = CONFIG.get("VM", "salt_minion_id")
-SALT_MASTER_IP = CONFIG.get("VM", "salt_master_ip")
-AUTOSTART = CONFIG.getboolean("VM", "autostart")
-BOOTLOADER = CONFIG.get("VM", "bootloader")
-SHUTDOWN_TIMEOUT = CONFIG.getint("VM", "shutdown_timeout")
-HDD_TEMPLATE = CONFIG.get("VM", "hdd_template")
-DATASET = CONFIG.get("VM", "dataset")
-SSH_KEY = CONFIG.get("VM", "ssh_key")
-HOST = CONFIG.get("TrueNAS", "host")
-KEY = CONFIG.get("TrueNAS", "key")
-DEBUG = CONFIG.getboolean("App", "debug")
-CWD = CONFIG.get("App", "cwd")
-ROOT = CONFIG.get("App", "root")
-QEMU_IMG_PATH = CONFIG.get("App", "qemu_img_path")
+
+
+def manifest(path):
+    # the [VM <name>] sections are the VMs, [VM] holds what they have in common, [TrueNAS] and [App] are shared,
+    # every VM gets the default config with the sections of the manifest on top
+    sections = ConfigParser(interpolation=None)
+
+    if not sections.read(path):
+        exit_error("Cannot read manifest {}".format(path))
+
+    configs = []
+
+    for section in sections.sections():
+        if not section.startswith("VM "):
+            continue
+
+        parser = ConfigParser(interpolation=ExtendedInterpolation())
+        parser.read_string(dedent(default_config()).strip())
+
+        for shared in ("TrueNAS", "App", "VM"):
+            if sections.has_section(shared):
+                parser[shared].update(sections.items(shared, raw=True))
+
+        parser["VM"].update(sections.items(section, raw=True))
+        parser["VM"]["name"] = section[3:].strip()
+        configs.append(parser)
+
+    return configs
+
+
+def vm_spec(parser):
+    return {
+        "name": parser.get("VM", "name"),
+        "ip": parser.get("VM", "ip"),
+        "hostname": parser.get("VM", "hostname"),
+        "memory": parser.getint("VM", "memory"),
+        "hdd_size": parser.getint("VM", "hdd_size") * 1073741824,  # multiple of 16k = 16384
+        "cores": parser.getint("VM", "cores"),
+        "vcpus": parser.getint("VM", "vcpus"),
+        "threads": parser.getint("VM", "threads"),
+        "nic": parser.get("VM", "nic"),
+        "mac": parser.get("VM", "mac"),
+        "netmask": parser.getint("VM", "netmask"),
+        "gateway": parser.get("VM", "gateway"),
+        "domain": parser.get("VM", "domain"),
+        "dns": parser.get("VM", "dns"),
+        "salt_minion_id": parser.get("VM", "salt_minion_id"),
+        "salt_master_ip": parser.get("VM", "salt_master_ip"),
+        "autostart": parser.getboolean("VM", "autostart"),
+        "bootloader": parser.get("VM", "bootloader"),
+        "shutdown_timeout": parser.getint("VM", "shutdown_timeout"),
+        "hdd_template": parser.get("VM", "hdd_template"),
+        "hdd_mode": parser.get("VM", "hdd_mode"),
+        "dataset": parser.get("VM", "dataset"),
+        "ssh_key": parser.get("VM", "ssh_key"),
+        "host": parser.get("TrueNAS", "host"),
+        "key": parser.get("TrueNAS", "key"),
+        "golden_dataset": parser.get("TrueNAS", "golden_dataset"),
+        "debug": parser.getboolean("App", "debug"),
+        "cwd": parser.get("App", "cwd"),
+        "qemu_img_path": parser.get("App", "qemu_img_path"),
+        "copy_stats": parser.get("App", "copy_stats"),
+    }
+
 
 LOGGER = getLogger(__name__)
-basicConfig(level=INFO if DEBUG else WARNING, format="%(asctime)s | %(levelname)s | %(message)s")
 
 
-def request(method, path, body=None):
-    url = "http://{}/api/v2.0{}".format(HOST, path)
-    data = None
-    headers = {"Authorization": "Bearer {}".format(KEY), "Accept": "application/json"}
+class Client:
+    # a keep-alive connection per concurrent caller, bounded retries with exponential backoff
+    RETRY_STATUSES = (429, 502, 503, 504)
 
-    if method == "POST":
-        data = dumps(body).encode("utf-8")
-        headers["Content-Type"] = "application/json; charset=utf-8"
-        headers["Content-Length"] = len(data)
+    def __init__(self, host, key, retries=3, backoff=0.5, timeout=60):
+        self.host = host
+        self.key = key
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.pool = LifoQueue()
 
-    LOGGER.info("%s %s", method, url)
-    LOGGER.info("%s", headers)
-    LOGGER.info("%s", data)
+    def connection(self):
+        # an idle keep-alive connection the middleware closed meanwhile reads as EOF, it is dropped before anything is sent on it
+        while True:
+            try:
+                conn = self.pool.get_nowait()
+            except Empty:
+                return HTTPConnection(self.host, timeout=self.timeout)
 
-    req = Request(url, data=data, headers=headers, method=method)
+            if conn.sock is not None and not select([conn.sock], [], [], 0)[0]:
+                return conn
 
-    try:
-        rsp = urlopen(req)  # nosec
-    except HTTPError as err:
-        LOGGER.warning("%s %s", err.code, err.reason)
-        raise
+            conn.close()
+
+    def request(self, method, path, body=None):
+        url = "http://{}/api/v2.0{}".format(self.host, path)
+        data = None
+        headers = {"Authorization": "Bearer {}".format(self.key), "Accept": "application/json"}
+
+        if method in ("POST", "PUT", "DELETE"):
+            data = dumps(body).encode("utf-8")
+            headers["Content-Type"] = "application/json; charset=utf-8"
+
+        LOGGER.info("%s %s %s", method, url, data)
+
+        for attempt in range(self.retries + 1):
+            conn = self.connection()
+            start = monotonic()
+
+            sent = False
+
+            try:
+                conn.request(method, "/api/v2.0{}".format(path), body=data, headers=headers)
+                sent = True
+                rsp = conn.getresponse()
+                payload = rsp.read()
+            except (OSError, HTTPException) as err:
+                conn.close()
+
+                # a request that changes something is only sent again when it did not go out whole, like on a refused
+                # connection, once sent the middleware may have handled it before the connection broke
+                if attempt == self.retries or (method != "GET" and sent):
+                    raise
+
+                LOGGER.warning("%s %s failed: %s, retrying", method, url, err)
+                sleep(self.backoff * 2**attempt)
+                continue
+
+            self.pool.put(conn)
+            LOGGER.info("%s %s %s %s in %.3fs", method, url, rsp.status, rsp.reason, monotonic() - start)
+
+            if rsp.status in self.RETRY_STATUSES and attempt < self.retries and (method == "GET" or rsp.status == 429):
+                sleep(self.backoff * 2**attempt)
+                continue
+
+            if rsp.status >= 400:
+                LOGGER.warning("%s %s %s", rsp.status, rsp.reason, payload.decode(errors="replace"))
+                raise HTTPError(url, rsp.status, rsp.reason, rsp.headers, None)
+
+            obj = loads(payload) if payload else None
+            LOGGER.info("%s", obj)
+            return rsp.status, obj
+
+    def job(self, method, path, body=None, interval=1):
+        # the long running calls return the id of a middleware job, which is polled until it ends
+        _, result = self.request(method, path, body)
+
+        if type(result) is not int:
+            return result
+
+        progress = None
+
+        while True:
+            _, jobs = self.request("GET", "/core/get_jobs?id={}".format(result))
+            job = jobs[0]
+
+            if job.get("progress") != progress:
+                progress = job.get("progress")
+                LOGGER.info("Job %d %s: %s%% %s", result, job["method"], (progress or {}).get("percent"), (progress or {}).get("description") or "")
+
+            if job["state"] == "SUCCESS":
+                return job["result"]
 
-    with rsp as f:
-        obj = load(f)
-        LOGGER.info("%s %s", rsp.status, rsp.reason)
-        LOGGER.info("%s", obj)
-        return rsp.status, obj
+            if job["state"] in ("FAILED", "ABORTED"):
+                raise RuntimeError("Job {} {} {}: {}".format(result, job["method"], job["state"].lower(), job.get("error")))
+
+            sleep(interval)
+
+
+GOLDEN_LOCK = Lock()
+GOLDEN_LOCKS = {}
 
 
 def exit_error(message):
@@ -152,117 +276,331 @@ def exit_error(message):
     sys_exit(1)
 
 
-def qemu_img(args, **kwargs):
-    default_env = {**environ}
-    default_env["LD_LIBRARY_PATH"] = QEMU_IMG_PATH + (":" + default_env["LD_LIBRARY_PATH"] if "LD_LIBRARY_PATH" in default_env else "")
-    env = kwargs.pop("env", default_env)
-    return run(["{}/qemu-img".format(QEMU_IMG_PATH)] + args, env=env, **kwargs)
-
-
-try:
-    qemu_img(["--version"], stdout=DEVNULL, stderr=DEVNULL, check=True)
-except (OSError, CalledProcessError):
-    exit_error(
-        dedent(
-            """
-            Command qemu-img is not functional.
-            Create a jail with the latest TrueNAS version, and execute the following commands:
-                pkg install qemu
-                mkdir qemu-img
-                cp `which qemu-img` ./qemu-img/
-                ldd -av ./qemu-img/qemu-img | awk 'NF == 4 {{print $3}}' | sort -u | xargs -I% cp "%" ./qemu-img/
-                tar cvzf qemu-img.tgz qemu-img
-
-            Now, copy the qemu-img.tgz and extract it to {cwd}. You are free to destroy the jail.
-            """.format(
-                cwd=CWD
-            )
-        ).strip()
-    )
+def qemu_img_env(path):
+    env = {**environ}
+    env["LD_LIBRARY_PATH"] = path + (":" + env["LD_LIBRARY_PATH"] if "LD_LIBRARY_PATH" in env else "")
+    return env
+
 
-# request("GET", "/vm")
-# request("GET", "/vm/device")
-
-_, VM = request(
-    "POST",
-    "/vm",
-    {
-        "name": VM_NAME,
-        "description": "",
-        "vcpus": VCPUS,
-        "cores": CORES,
-        "threads": THREADS,
-        "memory": MEMORY,
-        "autostart": AUTOSTART,
-        "time": "LOCAL",
-        "grubconfig": None,
-        "bootloader": BOOTLOADER,
-        "shutdown_timeout": SHUTDOWN_TIMEOUT,
-        "devices": [
-            {"dtype": "NIC", "attributes": {"type": "VIRTIO", "mac": MAC, "nic_attach": NIC}},
-            {"dtype": "DISK", "attributes": {"create_zvol": True, "type": "VIRTIO", "zvol_name": DATASET, "zvol_volsize": HDD_SIZE}},
-        ],
-    },
-)
-
-
-ZVOL = next(d for d in VM["devices"] if d["dtype"] == "DISK")["attributes"]["path"]
-
-run(["zfs", "set", "volmode=geom", DATASET], check=True)
-
-qemu_img(["convert", "-O", "raw", HDD_TEMPLATE, ZVOL], check=True)
-
-if DEBUG:
-    run(["gpart", "show", ZVOL])
-
-PARTITION = "{}p1".format(ZVOL)
-
-makedirs(ROOT, exist_ok=True)
-
-run(["mount_msdosfs", PARTITION, ROOT], check=True)
-
-Path("{}/vm-bootstrap.env".format(ROOT)).write_text(
-    dedent(
-        """
-        IP={ip}
-        NETMASK={netmask}
-        GATEWAY={gateway}
-        DOMAIN={domain}
-        DNS={dns}
-        HOSTNAME={hostname}
-        SSH_KEY="{ssh_key}"
-        SALT_MASTER_IP={salt_master_ip}
-        SALT_MINION_ID={salt_minion_id}
-        """
+def qemu_img(path, args, **kwargs):
+    env = kwargs.pop("env", qemu_img_env(path))
+    return run(["{}/qemu-img".format(path)] + args, env=env, **kwargs)
+
+
+def copy_template(template, target, zeroed, qemu_img_path, stats):
+    # zeroed when the zvol was just created, only the extents of the template with data are written then
+    def progress(percent, rate, eta):
+        if int(percent) % 10 == 0:
+            LOGGER.info("Converting %s to %s: %d%% %.1f MB/s ETA %.0fs", template, target, percent, rate, eta)
+
+    result = copy(
+        template,
+        target,
+        zeroed=zeroed,
+        qemu_img=("{}/qemu-img".format(qemu_img_path),),
+        env=qemu_img_env(qemu_img_path),
+        progress=progress,
+        stats=stats,
     )
-    .format(
-        ip=IP,
-        netmask=NETMASK,
-        gateway=GATEWAY,
-        domain=DOMAIN,
-        dns=DNS,
-        hostname=HOSTNAME,
-        ssh_key=SSH_KEY,
-        salt_master_ip=SALT_MASTER_IP,
-        salt_minion_id=SALT_MINION_ID,
+    LOGGER.warning(
+        "Converted %s to %s, %d of %d bytes to write, %d skipped, in %.1fs at %s MB/s",
+        template,
+        target,
+        result["expected_written"],
+        result["virtual_size"],
+        result["expected_skipped"],
+        result["seconds"],
+        result["mb_s"],
     )
-    .lstrip()
-)
 
-run(["umount", ROOT], check=True)
 
-run(["zfs", "inherit", "volmode", DATASET], check=True)
+def check_qemu_img(path, cwd):
+    try:
+        qemu_img(path, ["--version"], stdout=DEVNULL, stderr=DEVNULL, check=True)
+    except (OSError, CalledProcessError):
+        exit_error(
+            dedent(
+                """
+                Command qemu-img is not functional.
+                Create a jail with the latest TrueNAS version, and execute the following commands:
+                    pkg install qemu
+                    mkdir qemu-img
+                    cp `which qemu-img` ./qemu-img/
+                    ldd -av ./qemu-img/qemu-img | awk 'NF == 4 {{print $3}}' | sort -u | xargs -I% cp "%" ./qemu-img/
+                    tar cvzf qemu-img.tgz qemu-img
+
+                Now, copy the qemu-img.tgz and extract it to {cwd}. You are free to destroy the jail.
+                """.format(
+                    cwd=cwd
+                )
+            ).strip()
+        )
+
+
+def zfs_get(dataset, prop):
+    result = run(["zfs", "get", "-H", "-p", "-o", "value", prop, dataset], capture_output=True, text=True)
+    return result.stdout.strip() if result.returncode == 0 else None
+
+
+def template_hash(template):
+    # hashing a template takes a while, the hash is kept next to it along with the size and mtime it belongs to
+    info = stat(template)
+    cache = Path("{}.sha256".format(template))
+    key = "{} {}".format(info.st_size, info.st_mtime_ns)
+
+    if cache.exists():
+        cached_key, _, digest = cache.read_text().strip().rpartition(" ")
+
+        if cached_key == key:
+            return digest
+
+    digest = sha256()
+
+    with open(template, "rb") as f:
+        for chunk in iter(lambda: f.read(1048576), b""):
+            digest.update(chunk)
+
+    cache.write_text("{} {}\n".format(key, digest.hexdigest()))
+    return digest.hexdigest()
+
+
+def golden_snapshot(template, datasets, qemu_img_path, stats):
+    # the golden zvol holds the template converted to raw, a snapshot per template content is the origin of the VM disks,
+    # the older snapshots stay until their last clone is gone
+    golden = "{}/{}".format(datasets, splitext(basename(template))[0])
+
+    # the VMs of a batch sharing a template wait for the one converting it
+    with GOLDEN_LOCK:
+        lock = GOLDEN_LOCKS.setdefault(golden, Lock())
+
+    with lock:
+        return golden_convert(template, golden, qemu_img_path, stats)
+
+
+def golden_convert(template, golden, qemu_img_path, stats):
+    digest = template_hash(template)
+    snapshot = "{}@{}".format(golden, digest[:12])
+
+    if zfs_get(snapshot, "name") is not None:
+        LOGGER.info("Using golden snapshot %s", snapshot)
+        return snapshot
+
+    # a volsize has to be a multiple of the 16k volblocksize
+    info = loads(qemu_img(qemu_img_path, ["info", "--output=json", template], capture_output=True, check=True).stdout)
+    size = -(-info["virtual-size"] // 16384) * 16384
+
+    created = zfs_get(golden, "name") is None
+
+    # the volsize follows the template exactly, the clones of a smaller one must not get the data past its end
+    if not created and run(["zfs", "set", "volmode=geom", "volsize={}".format(size), golden]).returncode != 0:
+        golden_retire(golden)
+        created = True
+
+    if created:
+        run(["zfs", "create", "-p", "-s", "-V", str(size), "-o", "volmode=geom", golden], check=True)
+
+    copy_template(template, "/dev/zvol/{}".format(golden), created, qemu_img_path, stats)
+    run(["zfs", "inherit", "volmode", golden], check=True)
+    run(["zfs", "set", "vm-tools:template-sha256={}".format(digest), golden], check=True)
+    run(["zfs", "snapshot", snapshot], check=True)
+
+    for old in run(["zfs", "list", "-H", "-o", "name", "-t", "snapshot", golden], capture_output=True, text=True, check=True).stdout.split():
+        if old != snapshot and run(["zfs", "destroy", old], stderr=DEVNULL).returncode == 0:
+            LOGGER.info("Destroyed golden snapshot %s", old)
+
+    return snapshot
+
+
+def golden_retire(golden):
+    # a golden zvol that cannot be resized is renamed out of the way, its snapshots stay the origins of their clones
+    retired = "{}-{}".format(golden, int(time()))
+    LOGGER.warning("Cannot resize golden zvol %s, renaming it to %s", golden, retired)
+    run(["zfs", "rename", golden, retired], check=True)
+
+    if run(["zfs", "destroy", "-r", retired], stderr=DEVNULL).returncode == 0:
+        LOGGER.info("Destroyed golden zvol %s", retired)
+
+
+@contextmanager
+def timed(timings, phase, limit):
+    # the time spent waiting for a slot of the limit is kept apart, the summary shows which limit held a batch up
+    start = monotonic()
+
+    with limit:
+        acquired = monotonic()
+        timings["wait"] = timings.get("wait", 0) + acquired - start
+        yield
+
+    timings[phase] = timings.get(phase, 0) + monotonic() - acquired
+
+
+def create_vm(spec, client, api=None, disk=None):
+    # spec as returned by vm_spec, api and disk are the limits of the concurrent middleware calls and disk heavy steps
+    # shared by the VMs provisioned in parallel, returns the id, the console device and the time of every phase
+    api = api or nullcontext()
+    disk = disk or nullcontext()
+    timings = {}
+    vm, cloned = None, False
+
+    if spec["hdd_mode"] == "clone":
+        disk_device = {"dtype": "DISK", "attributes": {"type": "VIRTIO", "path": "/dev/zvol/{}".format(spec["dataset"])}}
+    elif spec["hdd_mode"] == "copy":
+        disk_device = {
+            "dtype": "DISK",
+            "attributes": {"create_zvol": True, "type": "VIRTIO", "zvol_name": spec["dataset"], "zvol_volsize": spec["hdd_size"]},
+        }
+    else:
+        raise ValueError("Invalid hdd_mode: {}, use clone or copy".format(spec["hdd_mode"]))
+
+    try:
+        if spec["hdd_mode"] == "clone":
+            with timed(timings, "disk", disk):
+                # the disk shares the blocks of the golden zvol until the VM writes to them
+                snapshot = golden_snapshot(spec["hdd_template"], spec["golden_dataset"], spec["qemu_img_path"], spec["copy_stats"])
+                run(["zfs", "clone", snapshot, spec["dataset"]], check=True)
+                cloned = True
+
+                if spec["hdd_size"] > int(zfs_get(spec["dataset"], "volsize")):
+                    run(["zfs", "set", "volsize={}".format(spec["hdd_size"]), spec["dataset"]], check=True)
+
+        with timed(timings, "api", api):
+            _, vm = client.request(
+                "POST",
+                "/vm",
+                {
+                    "name": spec["name"],
+                    "description": "",
+                    "vcpus": spec["vcpus"],
+                    "cores": spec["cores"],
+                    "threads": spec["threads"],
+                    "memory": spec["memory"],
+                    "autostart": spec["autostart"],
+                    "time": "LOCAL",
+                    "grubconfig": None,
+                    "bootloader": spec["bootloader"],
+                    "shutdown_timeout": spec["shutdown_timeout"],
+                    "devices": [
+                        {"dtype": "NIC", "attributes": {"type": "VIRTIO", "mac": spec["mac"], "nic_attach": spec["nic"]}},
+                        disk_device,
+                    ],
+                },
+            )
+
+        LOGGER.info("Created VM %s with id %s", spec["name"], vm["id"])
+        zvol = next(d for d in vm["devices"] if d["dtype"] == "DISK")["attributes"]["path"]
+
+        with timed(timings, "disk", disk):
+            if spec["hdd_mode"] == "copy":
+                # the zvol the middleware just created reads as zeroes
+                copy_template(spec["hdd_template"], zvol, True, spec["qemu_img_path"], spec["copy_stats"])
+
+            # written straight into the FAT of the EFI partition, no volmode=geom, gpart retaste or mount_msdosfs needed
+            write_file(
+                zvol,
+                "vm-bootstrap.env",
+                dedent(
+                    """
+                    IP={ip}
+                    NETMASK={netmask}
+                    GATEWAY={gateway}
+                    DOMAIN={domain}
+                    DNS={dns}
+                    HOSTNAME={hostname}
+                    SSH_KEY="{ssh_key}"
+                    SALT_MASTER_IP={salt_master_ip}
+                    SALT_MINION_ID={salt_minion_id}
+                    """
+                )
+                .format(**spec)
+                .lstrip()
+                .encode(),
+            )
+
+        with timed(timings, "start", api):
+            client.job("POST", "/vm/id/{}/start".format(vm["id"]), {"overcommit": True})
+            _, console = client.request("POST", "/vm/get_console", vm["id"])
+    except BaseException:
+        # the VM and the clone of a VM that did not make it are removed, a batch does not leave them behind
+        if vm is not None:
+            LOGGER.warning("Deleting VM %s with id %s", spec["name"], vm["id"])
+
+            try:
+                client.request("DELETE", "/vm/id/{}".format(vm["id"]), {"zvols": spec["hdd_mode"] == "copy", "force": True})
+            except (OSError, HTTPException) as err:
+                LOGGER.error("Failed to delete VM %s with id %s, it has to be removed by hand: %s", spec["name"], vm["id"], err)
+
+        if cloned and run(["zfs", "destroy", spec["dataset"]]).returncode != 0:
+            LOGGER.error("Failed to destroy clone %s, it has to be removed by hand", spec["dataset"])
+
+        raise
+
+    return {"id": vm["id"], "console": console, "timings": timings}
+
+
+def summary(results):
+    # one line per VM in the order of the manifest, the times in seconds
+    phases = ("disk", "api", "start", "wait")
+    width = max(len(name) for name in results)
+    print("{:<{}}  {:<6} {:>7} {}".format("VM", width, "STATUS", "TOTAL", " ".join("{:>7}".format(p.upper()) for p in phases)))
+
+    for name, (result, elapsed) in results.items():
+        if isinstance(result, Exception):
+            print("{:<{}}  {:<6} {:>7.1f} {}".format(name, width, "failed", elapsed, result))
+            continue
+
+        times = " ".join("{:>7.1f}".format(result["timings"].get(p, 0)) for p in phases)
+        print("{:<{}}  {:<6} {:>7.1f} {}  cu -l {} -s 9600".format(name, width, "ok", elapsed, times, result["console"]))
+
+
+def provision(spec, client, api, disk):
+    start = monotonic()
+
+    try:
+        result = create_vm(spec, client, api, disk)
+    except Exception as err:  # the other VMs of the batch go on, the error ends up in the summary
+        LOGGER.warning("Creating VM %s failed: %s", spec["name"], err)
+        result = err
+
+    return result, monotonic() - start
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Create TrueNAS VMs, a single one configured in nano or the [VM <name>] sections of a manifest")
+    parser.add_argument("manifest", nargs="?", help="INI file with a [VM <name>] section per VM, on top of [VM], [TrueNAS] and [App]")
+    parser.add_argument("-j", "--jobs", type=int, default=4, help="VMs provisioned at the same time (default: 4)")
+    parser.add_argument("--api", type=int, default=4, help="concurrent middleware API calls (default: 4)")
+    parser.add_argument("--disk", type=int, default=1, help="concurrent disk heavy steps, like converting templates (default: 1)")
+    args = parser.parse_args()
+
+    specs = [vm_spec(c) for c in (manifest(args.manifest) if args.manifest else [config(default_config())])]
+
+    if not specs:
+        exit_error("No [VM <name>] sections in {}".format(args.manifest))
+
+    for spec in specs:
+        if spec["hdd_mode"] not in ("clone", "copy"):
+            exit_error("Invalid hdd_mode of VM {}: {}, use clone or copy".format(spec["name"], spec["hdd_mode"]))
+
+    basicConfig(level=INFO if specs[0]["debug"] else WARNING, format="%(asctime)s | %(levelname)s | %(message)s")
+    check_qemu_img(specs[0]["qemu_img_path"], specs[0]["cwd"])
+    client = Client(specs[0]["host"], specs[0]["key"])
+    api, disk = BoundedSemaphore(args.api), BoundedSemaphore(args.disk)
 
-_, STATUS = request("POST", "/vm/id/{}/start".format(VM["id"]), {"overcommit": True})
+    if args.manifest:
+        with ThreadPoolExecutor(args.jobs) as executor:
+            futures = {spec["name"]: executor.submit(provision, spec, client, api, disk) for spec in specs}
 
-_, CONSOLE = request("POST", "/vm/get_console", VM["id"])
+        results = {name: future.result() for name, future in futures.items()}
+        summary(results)
+        sys_exit(1 if any(isinstance(result, Exception) for result, _ in results.values()) else 0)
 
-if DEBUG:
-    print("To connect to the VM console: cu -l {} -s 9600, to exit press: ~~ ^d".format(CONSOLE))
-else:
-    print("Connecting to the VM console console, to exit press: ~~ ^d")
-    execl(which("cu"), "cu", "-l", CONSOLE, "-s", "9600")
+    console = create_vm(specs[0], client)["console"]
 
+    if specs[0]["debug"]:
+        print("To connect to the VM console: cu -l {} -s 9600, to exit press: ~~ ^d".format(console))
+    else:
+        print("Connecting to the VM console console, to exit press: ~~ ^d")
+        execl(which("cu"), "cu", "-l", console, "-s", "9600")
 
 # pkg install fusefs-lkl
 # kldload fuse.ko
@@ -0,0 +1,83 @@
+# Helpers of the image tools connecting qcow2 images to nbd devices and mounting their partitions.
+
+from contextlib import contextmanager
+from logging import getLogger
+from os import listdir
+from os.path import basename, exists
+from subprocess import run  # nosec
+from threading import Lock
+from time import monotonic, sleep
+
+LOGGER = getLogger(__name__)
+
+# the threads of a process must not pick the same free device
+NBD_LOCK = Lock()
+
+
+def retry(args):
+    for delay in (0, 1, 2, 3, 5):
+        sleep(delay)
+
+        if run(args).returncode == 0:
+            return
+
+    raise RuntimeError("Command {} aborted after {} failed retries".format(" ".join(args), 5))
+
+
+def wait_for(path, timeout=10, gone=False):
+    start = monotonic()
+
+    while exists(path) == gone:
+        if monotonic() - start > timeout:
+            raise RuntimeError("{} did not {}".format(path, "go away" if gone else "show up"))
+
+        sleep(0.1)
+
+
+def nbd_daemon(device):
+    # the pid of sysfs is the one of the client thread of the qemu-nbd serving the device, its process is the thread group
+    with open("/sys/block/{}/pid".format(basename(device))) as f:
+        tid = f.read().strip()
+
+    with open("/proc/{}/status".format(tid)) as f:
+        return next(line.split()[1] for line in f if line.startswith("Tgid:"))
+
+
+@contextmanager
+def nbd(image, *options):
+    # an nbd device not in use has a size of 0, options are extra qemu-nbd options like --cache unsafe
+    with NBD_LOCK:
+        if not exists("/sys/class/block/nbd0"):
+            run(["modprobe", "nbd", "max_part=8"], check=True)
+
+        for name in sorted((n for n in listdir("/sys/class/block") if n.startswith("nbd") and "p" not in n), key=lambda n: int(n[3:])):
+            with open("/sys/class/block/{}/size".format(name)) as f:
+                if f.read().strip() == "0":
+                    break
+        else:
+            raise RuntimeError("No free nbd device")
+
+        device = "/dev/{}".format(name)
+        LOGGER.info("Connecting %s to %s", image, device)
+        run(["qemu-nbd", "--connect", device, "--format", "qcow2"] + list(options) + [image], check=True)
+        daemon = nbd_daemon(device)
+
+    try:
+        yield device
+    finally:
+        # --disconnect returns before the daemon has written out the cached metadata and released the lock of the image
+        LOGGER.info("Disconnecting %s from %s", image, device)
+        retry(["qemu-nbd", "--disconnect", device])
+        wait_for("/proc/{}".format(daemon), 60, gone=True)
+
+
+@contextmanager
+def mounted(source, target, *args):
+    LOGGER.info("Mounting %s on %s", source, target)
+    run(["mount"] + list(args) + [source, target], check=True)
+
+    try:
+        yield target
+    finally:
+        LOGGER.info("Unmounting %s from %s", source, target)
+        retry(["umount", target])
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+
+# Package cache shared by the image builds. The .deb files are kept once, under their sha256 in objects/, and linked
+# to the names they are used by: archives/, the cache dir of debootstrap and the /var/cache/apt/archives bind mounted
+# into the chroots, and mirror/<host>/<path>, the files served by the caching HTTP proxy. Pointing http_proxy at the
+# proxy, like http_proxy=http://127.0.0.1:3142, serves the cached packages at disk speed and records every miss,
+# with --offline nothing is fetched at all. It also works as a plain mirror, http://127.0.0.1:3142/<host>/<path>.
+
+from argparse import ArgumentParser
+from hashlib import sha256
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import dumps
+from logging import INFO, basicConfig, getLogger
+from os import close, environ, link, listdir, makedirs, rename, stat, unlink
+from os.path import dirname, exists, join, normpath
+from shutil import copyfileobj
+from tempfile import mkstemp
+from threading import Lock
+from time import time
+from urllib.error import HTTPError
+from urllib.parse import urlsplit
+from urllib.request import ProxyHandler, Request, build_opener
+
+CACHE = environ.get("PKG_CACHE", "/var/cache/pkg-cache")
+
+# files that never change once published, everything else, like the dists/ indexes, is fetched again while online
+IMMUTABLE = ("/pool/", "/by-hash/")
+
+LOGGER = getLogger(__name__)
+
+
+def file_hash(path):
+    digest = sha256()
+
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1048576), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def link_to(obj, path):
+    # linked under a name of its own, then renamed over path, builds linking the same file at once or a link left
+    # behind by a crash do not get in the way
+    fd, tmp = mkstemp(dir=dirname(path), prefix=".link-")
+    close(fd)
+    unlink(tmp)
+    link(obj, tmp)
+    rename(tmp, path)
+
+    # rename does nothing when path already is a link to obj
+    if exists(tmp):
+        unlink(tmp)
+
+
+def store(cache, path, tmp):
+    # tmp becomes the object of its content, unless there is one already, and path a link to it
+    obj = join(cache, "objects", file_hash(tmp))
+    makedirs(dirname(obj), exist_ok=True)
+
+    if exists(obj):
+        unlink(tmp)
+    else:
+        rename(tmp, obj)
+
+    makedirs(dirname(path), exist_ok=True)
+    link_to(obj, path)
+    return obj
+
+
+def import_archives(cache):
+    # the packages debootstrap and apt left in archives/ are linked to their objects, duplicates share one,
+    # returns the number of files and bytes imported and of the bytes saved by sharing
+    files = imported = saved = 0
+    archives = join(cache, "archives")
+    makedirs(archives, exist_ok=True)
+
+    for entry in sorted(e for e in listdir(archives) if e.endswith(".deb")):
+        path = join(archives, entry)
+        info = stat(path)
+
+        if info.st_nlink > 1:
+            continue
+
+        obj = join(cache, "objects", file_hash(path))
+        makedirs(dirname(obj), exist_ok=True)
+        files += 1
+
+        if exists(obj):
+            link_to(obj, path)
+            saved += info.st_size
+        else:
+            link(path, obj)
+            imported += info.st_size
+
+    return files, imported, saved
+
+
+class Proxy(BaseHTTPRequestHandler):
+    # caching forward proxy for http_proxy, or a mirror of http://<host>/<path> when asked for /<host>/<path>
+    protocol_version = "HTTP/1.1"
+    cache = CACHE
+    offline = False
+    opener = build_opener(ProxyHandler({}))
+    lock = Lock()
+
+    def log_message(self, format, *args):
+        LOGGER.info("%s %s", self.address_string(), format % args)
+
+    def miss(self, url, status, size=0):
+        with self.lock, open(join(self.cache, "misses.jsonl"), "a") as f:
+            f.write(dumps({"time": int(time()), "url": url, "status": status, "bytes": size}) + "\n")
+
+    def send_file(self, path):
+        with open(path, "rb") as f:
+            self.send_response(200)
+            self.send_header("Content-Length", str(stat(path).st_size))
+            self.end_headers()
+            copyfileobj(f, self.wfile)
+
+    def do_GET(self):
+        if self.path.startswith("/"):
+            host, _, path = self.path[1:].partition("/")
+            url = "http://{}/{}".format(host, path)
+        else:
+            url = self.path
+            parts = urlsplit(url)
+            host, path = parts.netloc, parts.path
+
+        path = normpath("/" + path)
+
+        if not host or ".." in host or "/" in host:
+            self.send_error(400)
+            return
+
+        cached = join(self.cache, "mirror", host, path.lstrip("/"))
+        immutable = any(part in path for part in IMMUTABLE)
+
+        if exists(cached) and (immutable or self.offline):
+            self.send_file(cached)
+            return
+
+        if self.offline:
+            self.miss(url, 404)
+            self.send_error(404, "Not in the cache")
+            return
+
+        try:
+            response = self.opener.open(Request(url, headers={"User-Agent": self.headers.get("User-Agent", "pkg-cache")}), timeout=60)
+        except (HTTPError, OSError) as err:
+            status = err.code if isinstance(err, HTTPError) else 502
+            self.miss(url, status)
+
+            # an index that cannot be refreshed is served as it was the last time
+            if exists(cached):
+                self.send_file(cached)
+            else:
+                self.send_error(status)
+
+            return
+
+        makedirs(dirname(cached), exist_ok=True)
+        fd, tmp = mkstemp(dir=dirname(cached), prefix=".tmp-")
+        size = 0
+        client = True
+
+        with response, open(fd, "wb") as f:
+            self.send_response(200)
+
+            if response.headers.get("Content-Length"):
+                self.send_header("Content-Length", response.headers["Content-Length"])
+            else:
+                self.send_header("Connection", "close")
+                self.close_connection = True
+
+            self.end_headers()
+
+            # the download goes on when apt gives up on it, the next build finds it in the cache
+            for chunk in iter(lambda: response.read(65536), b""):
+                f.write(chunk)
+                size += len(chunk)
+
+                if client:
+                    try:
+                        self.wfile.write(chunk)
+                    except OSError:
+                        client = False
+
+        if immutable:
+            store(self.cache, cached, tmp)
+        else:
+            rename(tmp, cached)
+
+        self.miss(url, 200, size)
+
+
+def serve(cache, address, offline=False):
+    host, _, port = address.rpartition(":")
+    makedirs(cache, exist_ok=True)
+    handler = type("Handler", (Proxy,), {"cache": cache, "offline": offline})
+    server = ThreadingHTTPServer((host or "127.0.0.1", int(port)), handler)
+    LOGGER.info("Serving %s on http://%s:%s%s", cache, host or "127.0.0.1", port, ", offline" if offline else "")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Package cache shared by the image builds")
+    parser.add_argument("-c", "--cache", default=CACHE, help="cache dir (default: $PKG_CACHE or {})".format(CACHE))
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve_parser = commands.add_parser("serve", help="caching HTTP proxy and mirror of the packages")
+    serve_parser.add_argument("-l", "--listen", default="127.0.0.1:3142", help="address to listen on (default: 127.0.0.1:3142)")
+    serve_parser.add_argument("--offline", action="store_true", help="serve from the cache only, record what is missing")
+    commands.add_parser("import", help="link the packages left in archives/ to their objects")
+    args = parser.parse_args()
+
+    basicConfig(level=INFO, format="%(asctime)s | %(levelname)s | %(message)s")
+
+    if args.command == "serve":
+        serve(args.cache, args.listen, args.offline)
+    else:
+        files, imported, saved = import_archives(args.cache)
+        LOGGER.info("Imported %d packages, %.1f MiB, %.1f MiB saved by duplicates", files, imported / 1048576, saved / 1048576)
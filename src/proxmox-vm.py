@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+
+# Replaces proxmox-vm.sh, importing a batch of VMs at once. The VMIDs in use in the cluster are read once, a free one is
+# reserved under a lock held until qm create has claimed it. While the VM config is created, the disk is prepared
+# in a local qcow2 overlay of the image, resized, its filesystem grown and the salt minion configured, then imported.
+
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from fcntl import LOCK_EX, LOCK_UN, flock
+from json import loads
+from logging import INFO, basicConfig, getLogger
+from os import environ, makedirs, remove
+from os.path import abspath, exists, join
+from re import search, sub
+from shutil import rmtree, which
+from subprocess import CalledProcessError, run  # nosec
+from sys import exit as sys_exit
+from tempfile import mkdtemp
+from threading import BoundedSemaphore, Lock
+from time import monotonic
+
+from nbd_mount import mounted, nbd
+
+SALT_MASTER = environ.get("SALT_MASTER", "10.0.0.100")
+SALT_MASTER_FINGERPRINT = environ.get(
+    "SALT_MASTER_FINGERPRINT", "7a:db:dc:9d:f6:6a:e5:02:23:77:72:3f:33:7e:f9:60:45:ab:e7:11:84:4b:88:fc:01:6f:ae:8d:5a:e3:02:89"
+)
+
+# VMIDs are reserved by the processes of this host under this lock, qm create fails for one taken on another node
+VMID_LOCK = "/var/lock/proxmox-vm.lock"
+VMID_RANGE = range(100, 10001)
+
+TOOLS = ("e2fsck", "parted", "partprobe", "pvesh", "pvesm", "qemu-img", "qemu-nbd", "qm", "resize2fs")
+
+LOGGER = getLogger(__name__)
+
+
+class VmIds:
+    # the VMIDs of the cluster, read once, the next free one is handed out under the lock
+    def __init__(self):
+        resources = run(["pvesh", "get", "/cluster/resources", "--type", "vm", "--output-format", "json"], capture_output=True, check=True)
+        self.used = {resource["vmid"] for resource in loads(resources.stdout)}
+        self.lock = Lock()
+
+    @contextmanager
+    def reserve(self):
+        # yields a free VMID, it stays in the used set even when qm create fails, the next try gets another one
+        with self.lock, open(VMID_LOCK, "w") as lock:
+            flock(lock, LOCK_EX)
+
+            try:
+                vm_id = next(i for i in VMID_RANGE if i not in self.used)
+            except StopIteration:
+                raise RuntimeError("No free VMID in {}-{}".format(VMID_RANGE.start, VMID_RANGE.stop - 1))
+
+            self.used.add(vm_id)
+
+            try:
+                yield vm_id
+            finally:
+                flock(lock, LOCK_UN)
+
+
+def disk_size(size, current):
+    # [+]SIZE[KMGT] of qm resize, in bytes
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    value = size.lstrip("+")
+    value = int(float(value[:-1]) * units[value[-1].upper()]) if value[-1:].upper() in units else int(value)
+    return current + value if size.startswith("+") else value
+
+
+def default_bridge():
+    route = run(["ip", "route", "get", "1.1.1.1"], capture_output=True, text=True, check=True).stdout
+    return search(r"dev (\S+)", route).group(1)
+
+
+def configure_minion(root, minion_id):
+    LOGGER.info("Configuring salt master ip %s, fingerprint %s and minion ID %s", SALT_MASTER, SALT_MASTER_FINGERPRINT, minion_id)
+
+    with open(join(root, "etc/hosts")) as f:
+        hosts = f.read().splitlines(True)
+
+    for i, line in enumerate(hosts):
+        if "127.0.1.1" in line:
+            hosts.insert(i + 1, "{:<15} salt\n".format(SALT_MASTER))
+            break
+
+    with open(join(root, "etc/hosts"), "w") as f:
+        f.write("".join(hosts))
+
+    with open(join(root, "etc/salt/minion")) as f:
+        minion = sub(r"#?(master_finger:).*", r"\1 '{}'".format(SALT_MASTER_FINGERPRINT), f.read())
+
+    with open(join(root, "etc/salt/minion"), "w") as f:
+        f.write(minion)
+
+    with open(join(root, "etc/salt/minion_id"), "w") as f:
+        f.write("{}\n".format(minion_id))
+
+    for key in ("minion.pem", "minion.pub"):
+        if exists(join(root, "etc/salt/pki/minion", key)):
+            remove(join(root, "etc/salt/pki/minion", key))
+
+
+def prepare_disk(qcow2_file, size, minion_id, partition, workdir):
+    # the image stays untouched, the VM gets an overlay of it, resized and with its root filesystem grown and configured
+    overlay = join(workdir, "disk.qcow2")
+    info = loads(run(["qemu-img", "info", "--output=json", qcow2_file], capture_output=True, check=True).stdout)
+    current = info["virtual-size"]
+    new = current if size == "0" else disk_size(size, current)
+    run(["qemu-img", "create", "-q", "-f", "qcow2", "-b", abspath(qcow2_file), "-F", info["format"], overlay, str(max(new, current))], check=True)
+
+    with ExitStack() as stack:
+        device = stack.enter_context(nbd(overlay))
+        part = "{}p{}".format(device, partition)
+        run(["partprobe", device], check=True)
+
+        if new > current:
+            LOGGER.info("Resizing %s to %s", part, size)
+            run(["parted", "-sa", "optimal", device, "resizepart", str(partition), "100%", "print"], check=True)
+            run(["partprobe", device], check=True)
+            run(["e2fsck", "-fp", part], check=True)
+            run(["resize2fs", part], check=True)
+
+        root = join(workdir, "root")
+        makedirs(root)
+        stack.enter_context(mounted(part, root))
+        configure_minion(root, minion_id)
+
+    return overlay
+
+
+def create_config(vm_id, minion_id, bridge):
+    mac = "02:" + ":".join("{:010d}".format(vm_id)[i : i + 2] for i in range(0, 10, 2))
+    LOGGER.info("Creating VM %d for minion %s with MAC address %s", vm_id, minion_id, mac)
+    options = {
+        "agent": "1",
+        "balloon": "512",
+        "memory": "1024",
+        "boot": "c",
+        "bootdisk": "virtio0",
+        "cpu": "host,flags=+aes",
+        "hotplug": "0",
+        "machine": "q35",
+        "name": minion_id,
+        "net0": "virtio={},bridge={}".format(mac, bridge),
+        "ostype": "l26",
+        "scsihw": "virtio-scsi-single",
+        "serial0": "socket",
+        "sockets": "1",
+        "cores": "2",
+        "tablet": "0",
+        "vga": "none",
+    }
+    args = ["qm", "create", str(vm_id)]
+
+    for option, value in options.items():
+        args += ["--{}".format(option), value]
+
+    run(args, capture_output=True, text=True, check=True)
+
+
+def destroy_vm(vm_id):
+    # a VM whose disk could not be prepared or imported, with the disks it may have got
+    LOGGER.warning("Destroying VM %d", vm_id)
+
+    if run(["qm", "destroy", str(vm_id), "--purge", "--destroy-unreferenced-disks", "1"]).returncode != 0:
+        LOGGER.error("Failed to destroy VM %d, it has to be removed by hand", vm_id)
+
+
+def create_vm(vm_ids, bridge, qcow2_file, storage, size, minion_id, partition, import_limit, workdir):
+    # returns the VMID and the seconds of every step, the config is created while the disk is prepared
+    timings = {}
+    workdir = mkdtemp(prefix="proxmox-vm-", dir=workdir)
+    created = None
+
+    def timed(step, function, *args):
+        start = monotonic()
+        result = function(*args)
+        timings[step] = monotonic() - start
+        return result
+
+    try:
+        with ThreadPoolExecutor(1) as executor:
+            disk = executor.submit(timed, "disk", prepare_disk, qcow2_file, size, minion_id, partition, workdir)
+
+            while True:
+                with vm_ids.reserve() as vm_id:
+                    try:
+                        timed("config", create_config, vm_id, minion_id, bridge)
+                        created = vm_id
+                        break
+                    except CalledProcessError as err:
+                        # taken on another node since the VMIDs were read
+                        if "already exists" not in (err.stderr or ""):
+                            raise
+
+                        LOGGER.warning("VMID %d taken meanwhile, trying the next one", vm_id)
+
+            overlay = disk.result()
+
+        start = monotonic()
+
+        with import_limit:
+            LOGGER.info("Importing disk %s of VM %d to %s", qcow2_file, vm_id, storage)
+            output = run(["qm", "importdisk", str(vm_id), overlay, storage], capture_output=True, text=True, check=True).stdout
+
+        volume = search(r"'unused\d+:([^']+)'", output)
+        volume = volume.group(1) if volume else "{}:vm-{}-disk-0".format(storage, vm_id)
+        run(["qm", "set", str(vm_id), "--virtio0", volume], check=True)
+        timings["import"] = monotonic() - start
+    except BaseException:
+        if created is not None:
+            destroy_vm(created)
+
+        raise
+    finally:
+        rmtree(workdir)
+
+    return vm_id, timings
+
+
+def batch(lines):
+    # QCOW2_FILE STORAGE [+]SIZE[KMGT] MINION_ID per line, like the arguments of a single VM
+    vms = []
+
+    for number, line in enumerate(lines, 1):
+        fields = line.split("#")[0].split()
+
+        if not fields:
+            continue
+
+        if len(fields) != 4:
+            raise ValueError("Line {}: expected QCOW2_FILE STORAGE SIZE MINION_ID".format(number))
+
+        vms.append(fields)
+
+    return vms
+
+
+def check_vm(qcow2_file, storage):
+    if not exists(qcow2_file):
+        raise ValueError("Invalid QCOW2_FILE {}".format(qcow2_file))
+
+    if run(["pvesm", "status", "-content", "images", "-storage", storage], capture_output=True).returncode:
+        raise ValueError("Invalid STORAGE {}".format(storage))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Create Proxmox VMs from QCOW2 images, a single one or a batch, configured as salt minions")
+    parser.add_argument("-b", "--batch", help="file with a QCOW2_FILE STORAGE [+]SIZE[KMGT] MINION_ID line per VM")
+    parser.add_argument("-j", "--jobs", type=int, default=4, help="VMs created at the same time (default: 4)")
+    parser.add_argument("--imports", type=int, default=1, help="concurrent disk imports per storage (default: 1)")
+    parser.add_argument("-p", "--partition", type=int, default=1, help="number of the root partition of the images (default: 1)")
+    parser.add_argument("-w", "--workdir", help="dir of the disk overlays prepared before the import (default: $TMPDIR)")
+    parser.add_argument("vm", nargs="*", metavar="QCOW2_FILE STORAGE [+]SIZE[KMGT] MINION_ID")
+    args = parser.parse_args()
+
+    basicConfig(level=INFO, format="%(asctime)s | %(levelname)s | %(message)s")
+
+    for tool in TOOLS:
+        if not which(tool):
+            LOGGER.error("Command %s not found", tool)
+            sys_exit(1)
+
+    try:
+        if args.batch:
+            with open(args.batch) as f:
+                vms = batch(f)
+        elif len(args.vm) == 4:
+            vms = [args.vm]
+        else:
+            parser.print_usage()
+            sys_exit(0)
+
+        for qcow2_file, storage, _, _ in vms:
+            check_vm(qcow2_file, storage)
+    except (OSError, ValueError) as err:
+        LOGGER.error("%s", err)
+        sys_exit(1)
+
+    vm_ids = VmIds()
+    bridge = default_bridge()
+    imports = {storage: BoundedSemaphore(args.imports) for _, storage, _, _ in vms}
+
+    with ThreadPoolExecutor(args.jobs) as executor:
+        futures = [
+            (
+                minion_id,
+                executor.submit(create_vm, vm_ids, bridge, qcow2_file, storage, size, minion_id, args.partition, imports[storage], args.workdir),
+            )
+            for qcow2_file, storage, size, minion_id in vms
+        ]
+
+    failed = 0
+
+    for minion_id, future in futures:
+        try:
+            vm_id, timings = future.result()
+            print("{:<24} {:>6} {}".format(minion_id, vm_id, " ".join("{} {:.1f}s".format(step, value) for step, value in timings.items())))
+        except Exception as err:
+            # like an invalid size, the other VMs of the batch are still reported
+            print("{:<24} failed: {}".format(minion_id, err))
+            failed += 1
+
+    sys_exit(1 if failed else 0)
@@ -49,12 +49,13 @@ check_tool blkid
 check_tool chroot
 check_tool dd
 check_tool debootstrap
+check_tool fstrim
 check_tool kpartx
 check_tool mkfs.ext4
 check_tool mktemp
 check_tool parted
+check_tool python3
 check_tool qemu-img
-check_tool virt-sparsify
 
 if test $# -ne 2 -o ! -d "$1"; then
     echo "usage: $(basename $0) SCRIPTS_DIR QCOW2_FILE"
@@ -94,7 +95,8 @@ VHDD_FILE=$WORKDIR/raw.img
 
 if test -f "$VHDD_FILE_OUTPUT"; then
     info "Copying $VHDD_FILE_OUTPUT to $VHDD_FILE"
-    qemu-img convert -f qcow2 -O raw "$VHDD_FILE_OUTPUT" $VHDD_FILE
+    # only the allocated extents are written to the sparse file, COPY_STATS records how many bytes the allocation map expects that to be
+    "$(dirname "$0")/disk_copy.py" -f qcow2 ${COPY_STATS:+-s "$COPY_STATS"} "$VHDD_FILE_OUTPUT" $VHDD_FILE
 else
     info "Creating vhdd $VHDD_FILE"
     dd if=/dev/zero of=$VHDD_FILE bs=1M count=2048
@@ -156,9 +158,15 @@ else
     : ${MIRROR=https://deb.debian.org/debian}
 fi
 
+# PKG_CACHE keeps the packages of debootstrap and apt for the next builds, see pkg_cache.py
+if test -n "$PKG_CACHE"; then
+    PKG_CACHE="$(readlink -f "$PKG_CACHE")"
+    mkdir -p "$PKG_CACHE/archives"
+fi
+
 if test "$(. $ROOTFS/etc/os-release 2>/dev/null; echo $VERSION_CODENAME)" != "$SUITE"; then
     info "Bootstrapping $SUITE-$ARCH to $ROOTFS from $MIRROR"
-    debootstrap --arch=$ARCH --components=$COMPONENTS $SUITE $ROOTFS $MIRROR
+    debootstrap ${PKG_CACHE:+--cache-dir="$PKG_CACHE/archives"} --arch=$ARCH --components=$COMPONENTS $SUITE $ROOTFS $MIRROR
 fi
 
 mkdir -p $ROOTFS/boot/efi
@@ -183,6 +191,12 @@ info "Bind mounting /dev/pts on $ROOTFS/dev/pts"
 mount -o bind /dev/pts $ROOTFS/dev/pts
 cleanup_push "info 'Unmounting /dev/pts from $ROOTFS/dev/pts'; retry 'umount $ROOTFS/dev/pts'"
 
+if test -n "$PKG_CACHE"; then
+    info "Bind mounting $PKG_CACHE/archives on $ROOTFS/var/cache/apt/archives"
+    mount -o bind "$PKG_CACHE/archives" $ROOTFS/var/cache/apt/archives
+    cleanup_push "info 'Unmounting $PKG_CACHE/archives from $ROOTFS/var/cache/apt/archives'; retry 'umount $ROOTFS/var/cache/apt/archives'"
+fi
+
 VM_BOOTSTRAP=$ROOTFS/boot/efi/vm-bootstrap.sh
 >$VM_BOOTSTRAP
 
@@ -215,6 +229,18 @@ for SCRIPT_DIR in $(ls -v1 "$SCRIPTS_DIR"); do
     fi
 done
 
+if test -n "$PKG_CACHE"; then
+    eval "$(cleanup_peek)"; cleanup_pop # /var/cache/apt/archives
+    "$(dirname "$0")/pkg_cache.py" -c "$PKG_CACHE" import
+fi
+
+# the blocks freed by the stages become holes of $VHDD_FILE, left out of the export
+STEP_START=$(date +%s%N)
+info "Trimming $ROOTFS/boot/efi and $ROOTFS"
+fstrim -v $ROOTFS/boot/efi
+fstrim -v $ROOTFS
+info "Trimmed in $((($(date +%s%N) - STEP_START) / 1000000))ms"
+
 eval "$(cleanup_peek)"; cleanup_pop # /dev/pts
 eval "$(cleanup_peek)"; cleanup_pop # /dev
 eval "$(cleanup_peek)"; cleanup_pop # /sys
@@ -224,4 +250,4 @@ eval "$(cleanup_peek)"; cleanup_pop # /rootfs
 eval "$(cleanup_peek)"; cleanup_pop # kpartx
 
 info "Exporting $VHDD_FILE to $VHDD_FILE_OUTPUT"
-virt-sparsify --format raw --convert qcow2 --compress $VHDD_FILE "$VHDD_FILE_OUTPUT"
+"$(dirname "$0")/disk_copy.py" --export -f raw ${COPY_STATS:+-s "$COPY_STATS"} $VHDD_FILE "$VHDD_FILE_OUTPUT"
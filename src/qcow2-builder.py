@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+
+# Layer cached port of qcow2-bootstrapper.sh. The disk after debootstrap, and after every stage of the scripts dir,
+# is a qcow2 overlay in the cache named after the hash of the stage and of everything before it,
+# so a build resumes from the deepest layer found and only runs the stages that changed or follow one that did.
+
+from argparse import ArgumentParser
+from contextlib import ExitStack
+from fcntl import LOCK_EX, flock
+from glob import glob
+from hashlib import sha256
+from json import dumps, loads
+from logging import INFO, basicConfig, getLogger
+from os import X_OK, access, environ, listdir, makedirs, rename, rmdir, stat, unlink, utime, walk
+from os.path import basename, exists, getmtime, isdir, join, realpath, relpath
+from re import split
+from shutil import copy, which
+from subprocess import DEVNULL, CalledProcessError, run  # nosec
+from sys import exit as sys_exit
+from tempfile import mkdtemp
+from time import monotonic, time
+
+from disk_copy import export
+from nbd_mount import mounted, nbd, wait_for
+from pkg_cache import import_archives
+
+# part of the hash of the base layer, to be bumped when the disk layout or the way it is bootstrapped changes
+BASE_VERSION = "1"
+DISK_SIZE = 2048 * 1048576
+PARTITIONS = ["mklabel", "gpt", "mkpart", "primary", "fat32", "0%", "512M", "mkpart", "primary", "ext4", "512M", "100%", "set", "1", "boot", "on"]
+
+TOOLS = ("blkid", "chroot", "debootstrap", "fstrim", "mkfs.ext4", "mkfs.fat", "parted", "partprobe", "qemu-img", "qemu-nbd")
+
+LOGGER = getLogger(__name__)
+
+
+def natural_key(name):
+    # the order of ls -v
+    return [int(part) if part.isdigit() else part for part in split(r"(\d+)", name)]
+
+
+def stage_hash(parent, path):
+    # the names, executable bits and contents of the files of the stage, on top of the hash of the layer before it
+    digest = sha256(parent.encode())
+    digest.update(basename(path).encode())
+
+    for root, dirs, files in walk(path):
+        dirs.sort()
+
+        for name in sorted(files):
+            file = join(root, name)
+            digest.update("\0{}\0{}\0".format(relpath(file, path), access(file, X_OK)).encode())
+
+            with open(file, "rb") as f:
+                digest.update(f.read())
+
+    return digest.hexdigest()
+
+
+def plan(scripts_dir, suite, mirror, arch, components):
+    # [(hash, stage dir or None for the base layer)], each hash covers all the layers before it
+    base = sha256(dumps([BASE_VERSION, DISK_SIZE, PARTITIONS, suite, mirror, arch, components]).encode()).hexdigest()
+    layers = [(base, None)]
+
+    for name in sorted(listdir(scripts_dir), key=natural_key):
+        if isdir(join(scripts_dir, name)):
+            layers.append((stage_hash(layers[-1][0], join(scripts_dir, name)), join(scripts_dir, name)))
+
+    return layers
+
+
+def blkid(partition):
+    return run(["blkid", "-s", "UUID", "-o", "value", partition], capture_output=True, text=True, check=True).stdout.strip()
+
+
+def partitions(device):
+    efi, root = "{}p1".format(device), "{}p2".format(device)
+    wait_for(efi)
+    wait_for(root)
+    return efi, root
+
+
+def trim(*mountpoints):
+    # the blocks the stage freed are discarded, qemu-nbd turns them into zero clusters of the layer
+    for mountpoint in mountpoints:
+        run(["fstrim", mountpoint], check=True)
+
+
+def build_base(device, rootfs, env, pkg_cache=None):
+    run(["parted", "-s", "-a", "opt", device, "--"] + PARTITIONS + ["print"], check=True)
+    run(["partprobe", device], stderr=DEVNULL)
+    efi, root = partitions(device)
+    run(["mkfs.fat", "-F32", "-v", "-n", "EFI", efi], check=True)
+    run(["mkfs.ext4", "-L", "OS", root], check=True)
+
+    with mounted(root, rootfs):
+        LOGGER.info("Bootstrapping %s-%s to %s from %s", env["SUITE"], env["ARCH"], rootfs, env["MIRROR"])
+        debootstrap = ["debootstrap", "--arch={}".format(env["ARCH"]), "--components={}".format(env["COMPONENTS"])]
+        debootstrap += ["--cache-dir={}".format(join(pkg_cache, "archives"))] if pkg_cache else []
+        run(debootstrap + [env["SUITE"], rootfs, env["MIRROR"]], check=True)
+        makedirs(join(rootfs, "boot/efi"), exist_ok=True)
+
+        with mounted(efi, join(rootfs, "boot/efi")):
+            open(join(rootfs, "boot/efi/vm-bootstrap.sh"), "w").close()
+            trim(rootfs, join(rootfs, "boot/efi"))
+
+
+def build_stage(device, rootfs, stage, env, pkg_cache=None):
+    efi, root = partitions(device)
+
+    with ExitStack() as stack:
+        stack.enter_context(mounted(root, rootfs))
+        stack.enter_context(mounted(efi, join(rootfs, "boot/efi")))
+        stack.enter_context(mounted("proc", join(rootfs, "proc"), "-t", "proc"))
+        stack.enter_context(mounted("sys", join(rootfs, "sys"), "-t", "sysfs"))
+        stack.enter_context(mounted("/dev", join(rootfs, "dev"), "-o", "bind"))
+        stack.enter_context(mounted("/dev/pts", join(rootfs, "dev/pts"), "-o", "bind"))
+
+        # the packages apt downloads stay on the host, out of the layer
+        if pkg_cache:
+            makedirs(join(rootfs, "var/cache/apt/archives"), exist_ok=True)
+            stack.enter_context(mounted(join(pkg_cache, "archives"), join(rootfs, "var/cache/apt/archives"), "-o", "bind"))
+
+        setup = join(stage, "setup.sh")
+
+        if exists(setup) and access(setup, X_OK):
+            copy(setup, join(rootfs, "setup"))
+            stack.callback(unlink, join(rootfs, "setup"))
+            LOGGER.info("Executing %s on %s", setup, rootfs)
+            env = dict(env, EFI_PART_UUID=blkid(efi), ROOT_PART_UUID=blkid(root), VHDD_LOOP=device, EFI_PART=efi, ROOT_PART=root)
+            run(["chroot", rootfs, "/setup"], env=env, check=True)
+
+        bootstrap = join(stage, "bootstrap.sh")
+
+        if exists(bootstrap) and access(bootstrap, X_OK):
+            LOGGER.info("Appending %s to vm-bootstrap.sh", bootstrap)
+
+            with open(bootstrap, "rb") as src, open(join(rootfs, "boot/efi/vm-bootstrap.sh"), "ab") as dst:
+                dst.write(src.read())
+
+        trim(rootfs, join(rootfs, "boot/efi"))
+
+
+def build_layer(cache, digest, parent, stage, env, pkg_cache=None):
+    # built under a temporary name, a layer is in the cache once it is complete
+    layer = join(cache, "{}.qcow2".format(digest))
+    tmp = "{}.tmp".format(layer)
+    backing = ["-b", "{}.qcow2".format(parent), "-F", "qcow2"] if parent else []
+    run(["qemu-img", "create", "-q", "-f", "qcow2"] + backing + [tmp] + ([] if parent else [str(DISK_SIZE)]), check=True)
+    rootfs = mkdtemp(prefix="qcow2-builder-")
+    start = monotonic()
+
+    try:
+        with nbd(tmp, "--cache", "unsafe", "--discard", "unmap") as device:
+            if stage is None:
+                build_base(device, rootfs, env, pkg_cache)
+            else:
+                build_stage(device, rootfs, stage, env, pkg_cache)
+    except BaseException:
+        unlink(tmp)
+        raise
+    finally:
+        rmdir(rootfs)
+
+    rename(tmp, layer)
+
+    with open(join(cache, "{}.json".format(digest)), "w") as f:
+        meta = {"parent": parent, "stage": basename(stage) if stage else "base", "created": int(time()), "seconds": round(monotonic() - start, 1)}
+        f.write(dumps(meta))
+
+    LOGGER.info("Built layer %s of %s in %.1fs", digest[:12], basename(stage) if stage else "base", monotonic() - start)
+
+
+def cached_layers(cache):
+    # {hash: (parent, last used, bytes allocated)}
+    layers = {}
+
+    for meta in glob(join(cache, "*.json")):
+        digest = basename(meta)[:-5]
+        layer = join(cache, "{}.qcow2".format(digest))
+
+        if exists(layer):
+            with open(meta) as f:
+                layers[digest] = (loads(f.read())["parent"], getmtime(meta), stat(layer).st_blocks * 512)
+
+    return layers
+
+
+def evict(cache, keep, max_size=None, max_age=None):
+    # the least recently used layers go first, along with the layers built on top of them, the layers of the build never
+    layers = cached_layers(cache)
+    total = sum(size for _, _, size in layers.values())
+
+    def remove(digest):
+        nonlocal total
+
+        for child in [c for c, (parent, _, _) in layers.items() if parent == digest]:
+            remove(child)
+
+        total -= layers.pop(digest)[2]
+        LOGGER.info("Evicting layer %s", digest)
+        unlink(join(cache, "{}.qcow2".format(digest)))
+        unlink(join(cache, "{}.json".format(digest)))
+
+    for digest, (_, used, _) in sorted(layers.items(), key=lambda item: item[1][1]):
+        if digest in layers and digest not in keep:
+            if (max_age is not None and time() - used > max_age * 86400) or (max_size is not None and total > max_size):
+                remove(digest)
+
+    return total
+
+
+def build(scripts_dir, output, cache, env, max_size=None, max_age=None, pkg_cache=None, stats=None):
+    makedirs(cache, exist_ok=True)
+
+    if pkg_cache:
+        pkg_cache = realpath(pkg_cache)
+        makedirs(join(pkg_cache, "archives"), exist_ok=True)
+
+    with open(join(cache, "lock"), "w") as lock:
+        flock(lock, LOCK_EX)
+
+        # left behind by an interrupted build
+        for tmp in glob(join(cache, "*.tmp")):
+            unlink(tmp)
+
+        layers = plan(scripts_dir, env["SUITE"], env["MIRROR"], env["ARCH"], env["COMPONENTS"])
+        resume = max((i for i, (digest, _) in enumerate(layers) if exists(join(cache, "{}.qcow2".format(digest)))), default=-1)
+
+        if resume >= 0:
+            LOGGER.info("Resuming from layer %s of %s", layers[resume][0][:12], basename(layers[resume][1] or "base"))
+
+        for i, (digest, stage) in enumerate(layers):
+            if i > resume:
+                build_layer(cache, digest, layers[i - 1][0] if i else None, stage, env, pkg_cache)
+
+            utime(join(cache, "{}.json".format(digest)))
+
+        top = join(cache, "{}.qcow2".format(layers[-1][0]))
+        LOGGER.info("Exporting %s to %s", top, output)
+        result = export(top, output, "qcow2", stats=stats)
+        LOGGER.info(
+            "Exported %d of %d bytes allocated, %d compressed, %s:1, in %.1fs",
+            result["allocated"],
+            result["virtual_size"],
+            result["size"],
+            result["ratio"],
+            sum(result["seconds"].values()),
+        )
+
+        total = evict(cache, {digest for digest, _ in layers}, max_size, max_age)
+        LOGGER.info("Cache %s holds %.1f MiB", cache, total / 1048576)
+
+    if pkg_cache:
+        files, imported, saved = import_archives(pkg_cache)
+        LOGGER.info("Imported %d packages to %s, %.1f MiB, %.1f MiB saved by duplicates", files, pkg_cache, imported / 1048576, saved / 1048576)
+
+
+def size(value):
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    return int(float(value[:-1]) * units[value[-1].upper()]) if value[-1:].upper() in units else int(value)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Build a qcow2 image from the stages of a scripts dir, reusing the layers of earlier builds")
+    parser.add_argument("-c", "--cache", default=environ.get("QCOW2_BUILDER_CACHE", "/var/cache/qcow2-builder"), help="layer cache dir")
+    parser.add_argument("--max-size", type=size, help="evict the least recently used layers above this size, like 20G")
+    parser.add_argument("--max-age", type=float, help="evict the layers not used for this many days")
+    parser.add_argument(
+        "--pkg-cache",
+        default=environ.get("PKG_CACHE"),
+        help="package cache dir for debootstrap and the apt of the stages (default: $PKG_CACHE), see pkg_cache.py for the proxy",
+    )
+    parser.add_argument("-s", "--stats", help="JSON lines file the sizes and times of the export are appended to")
+    parser.add_argument("scripts_dir")
+    parser.add_argument("qcow2_file")
+    args = parser.parse_args()
+
+    basicConfig(level=INFO, format="%(asctime)s | %(levelname)s | %(message)s")
+
+    for tool in TOOLS:
+        if not which(tool):
+            LOGGER.error("Command %s not found", tool)
+            sys_exit(1)
+
+    # the same environment as qcow2-bootstrapper.sh, the stages read SUITE, MIRROR and ARCH
+    if environ.get("DISTRO_UBUNTU", "1") == "1":
+        defaults = {"SUITE": "focal", "COMPONENTS": "main,restricted,multiverse,universe", "MIRROR": "http://archive.ubuntu.com/ubuntu"}
+    else:
+        defaults = {"SUITE": "buster", "COMPONENTS": "main,contrib,non-free", "MIRROR": "https://deb.debian.org/debian"}
+
+    env = dict(environ)
+    env.setdefault("ARCH", "amd64")
+
+    for key, value in defaults.items():
+        env.setdefault(key, value)
+
+    try:
+        build(args.scripts_dir, args.qcow2_file, args.cache, env, args.max_size, args.max_age, args.pkg_cache, args.stats)
+    except (CalledProcessError, RuntimeError) as err:
+        LOGGER.error("%s", err)
+        sys_exit(1)
@@ -7,7 +7,7 @@ exec ./easy-qemu-system-x86_64.py \
     {defaults} \
     {cpu,2} \
     {hdd,{snap,salt-master.qcow2}} \
-    {net,192.168.5.1/24} \
+    {net,{br,192.168.5.1/24}} \
     {serial} \
     {monitor} \
     {video,virtio}
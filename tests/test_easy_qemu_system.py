@@ -0,0 +1,65 @@
+import importlib.util
+import logging
+import os
+import re
+import tempfile
+import unittest
+from pathlib import Path
+
+SRC = Path(__file__).resolve().parent.parent / "src"
+spec = importlib.util.spec_from_file_location("easy_qemu_system", SRC / "easy-qemu-system-x86_64.py")
+easy_qemu_system = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(easy_qemu_system)
+easy_qemu_system.LOG = logging.getLogger("easy_qemu_system")
+
+
+class PrepareTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def plan(self, *args):
+        # the plan of the expanded arguments, with the runtime dir moved from /var/run to the temporary dir
+        args, env = easy_qemu_system.qemu_expand(["qemu-system-x86_64", "-name", "web1"] + list(args))
+        runtime = os.path.join(self.tmpdir.name, os.path.basename(env["runtime"]))
+        return [tuple(runtime if part == env["runtime"] else part for part in step) for step in easy_qemu_system.prepare_plan(env)], runtime
+
+    def test_balloon(self):
+        plan, runtime = self.plan("{cpu,2}", "{balloon,10}")
+        self.assertIn(("balloon", runtime, 10), plan)
+
+        context = easy_qemu_system.prepare(plan)
+
+        self.assertTrue(os.path.isdir(runtime))
+        self.assertEqual(context, {"fds": {}, "rules": [], "pins": {}})
+
+
+class MemTest(unittest.TestCase):
+    def expand(self, *args):
+        return easy_qemu_system.qemu_expand(["qemu-system-x86_64", "-name", "web1"] + list(args))[0][3:]
+
+    def test_numa(self):
+        args = self.expand("{cpu,4}", "{mem,1000M,numa=3}")
+        self.assertEqual(args[args.index("-m") + 1], "1000M")
+        backends = [arg for arg in args if arg.startswith("memory-backend-memfd,")]
+        sizes = [int(re.search(r",size=(\d+)", backend).group(1)) for backend in backends]
+        self.assertEqual(sizes, [333 * 1048576, 333 * 1048576, 334 * 1048576])
+        self.assertEqual([arg.rpartition(",")[2] for arg in args if arg.startswith("node,")], ["cpus=0-0", "cpus=1-1", "cpus=2-3"])
+
+    def test_single_node(self):
+        args = self.expand("{mem,1G}", "{cpu,4}")
+        self.assertIn("node,nodeid=0,memdev=mem0", args)
+
+    def test_numa_more_than_vcpus(self):
+        with self.assertRaisesRegex(ValueError, "numa node count: 3"):
+            self.expand("{cpu,2}", "{mem,1000M,numa=3}")
+
+    def test_numa_before_cpu(self):
+        with self.assertRaisesRegex(ValueError, "has to follow {cpu}"):
+            self.expand("{mem,1000M,numa=2}", "{cpu,4}")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,130 @@
+import os
+import struct
+import sys
+import tempfile
+import unittest
+import uuid
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+import efi_inject  # noqa: E402
+
+SECTOR = 512
+
+
+def mkfs(bits, total_sectors, root_entries=512):
+    # a freshly formatted FAT of one sector clusters, like mkfs.fat -F bits -s 1 would write
+    reserved = 32 if bits == 32 else 1
+    root_entries = 0 if bits == 32 else root_entries
+    fat_sectors = -(-((total_sectors + 2) * bits // 8 + 1) // SECTOR)
+    small = total_sectors < 65536 and bits != 32
+    image = bytearray(total_sectors * SECTOR)
+    struct.pack_into("<3s8s", image, 0, b"\xeb\x3c\x90", b"MSWIN4.1")
+    struct.pack_into(
+        "<HBHBHHBH", image, 11, SECTOR, 1, reserved, 2, root_entries, total_sectors if small else 0, 0xF8, 0 if bits == 32 else fat_sectors
+    )
+    struct.pack_into("<I", image, 32, 0 if small else total_sectors)
+
+    if bits == 32:
+        # root directory in cluster 2, FSInfo in sector 1
+        struct.pack_into("<IHHIHH", image, 36, fat_sectors, 0, 0, 2, 1, 6)
+        struct.pack_into("<4s", image, SECTOR, b"RRaA")
+        struct.pack_into("<4s", image, SECTOR + 484, b"rrAa")
+        struct.pack_into("<2s", image, 2 * SECTOR - 2, b"\x55\xaa")
+
+    struct.pack_into("<2s", image, 510, b"\x55\xaa")
+
+    for fat in range(2):
+        offset = (reserved + fat * fat_sectors) * SECTOR
+
+        if bits == 12:
+            image[offset : offset + 3] = b"\xf8\xff\xff"
+        elif bits == 16:
+            image[offset : offset + 4] = b"\xf8\xff\xff\xff"
+        else:
+            image[offset : offset + 12] = struct.pack("<III", 0x0FFFFFF8, 0x0FFFFFFF, 0x0FFFFFFF)
+
+    return image
+
+
+def gpt(partition, first=2048):
+    # a disk with the partition as its only GPT entry, an EFI system partition
+    disk = bytearray(first * SECTOR) + partition + bytearray(34 * SECTOR)
+    entry = efi_inject.EFI_SYSTEM_PARTITION + uuid.uuid4().bytes + struct.pack("<QQ", first, first + len(partition) // SECTOR - 1)
+    disk[2 * SECTOR : 2 * SECTOR + len(entry)] = entry
+    struct.pack_into("<8s", disk, SECTOR, b"EFI PART")
+    struct.pack_into("<QII", disk, SECTOR + 72, 2, 128, 128)
+    return disk
+
+
+class RoundTripTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def image(self, bits, total_sectors):
+        path = os.path.join(self.tmpdir.name, "fat{}.img".format(bits))
+
+        with open(path, "wb") as f:
+            f.write(gpt(mkfs(bits, total_sectors)))
+
+        return path
+
+    def open_fat(self, path):
+        disk = efi_inject.Disk(path)
+        self.addCleanup(disk.file.close)
+        return efi_inject.Fat(disk, efi_inject.efi_partition(disk)[0])
+
+    def round_trip(self, bits, total_sectors):
+        path = self.image(bits, total_sectors)
+        self.assertEqual(self.open_fat(path).bits, bits)
+
+        env = b"IP=10.0.0.5\nHOSTNAME=web1\n" * 100
+        big = os.urandom(300000)
+        efi_inject.write_file(path, "vm-bootstrap.env", env)
+        efi_inject.write_file(path, "VM.SH", b"echo hi\n")
+        efi_inject.write_file(path, "Some Long File Name With Spaces.bin", big)
+        # replaced by a shorter content, its clusters are given back
+        efi_inject.write_file(path, "vm-bootstrap.env", env[:50])
+
+        for index in range(40):
+            efi_inject.write_file(path, "file-number-{}.txt".format(index), b"x" * index)
+
+        fat = self.open_fat(path)
+        files = fat.files(fat.directory())
+        self.assertEqual(fat.read_file("vm-bootstrap.env"), env[:50])
+        self.assertEqual(fat.read_file("VM-BOOTSTRAP.ENV"), env[:50])
+        self.assertEqual(fat.read_file("vm.sh"), b"echo hi\n")
+        self.assertEqual(fat.read_file("Some Long File Name With Spaces.bin"), big)
+        self.assertEqual(fat.read_file("file-number-39.txt"), b"x" * 39)
+        self.assertIn("VM.SH", files)
+
+        used = sum(1 for cluster in range(2, fat.clusters + 2) if fat.get(cluster))
+        expected = sum(-(-size // fat.cluster_size) for size in (50, 8, len(big)) + tuple(range(40)))
+        self.assertEqual(used, expected + (len(fat.chain(fat.root_cluster)) if fat.root_cluster else 0))
+        self.assertEqual(fat.disk.read(fat.fat_offset, fat.fat_size), fat.disk.read(fat.fat_offset + fat.fat_size, fat.fat_size))
+
+    def test_fat12(self):
+        self.round_trip(12, 4000)
+
+    def test_fat16(self):
+        self.round_trip(16, 40000)
+
+    def test_fat32(self):
+        self.round_trip(32, 140000)
+
+    def test_no_gpt(self):
+        path = os.path.join(self.tmpdir.name, "empty.img")
+
+        with open(path, "wb") as f:
+            f.truncate(1048576)
+
+        with self.assertRaisesRegex(ValueError, "No GPT"):
+            efi_inject.write_file(path, "vm-bootstrap.env", b"")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,151 @@
+import importlib.util
+import json
+import sys
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from time import sleep
+from urllib.error import HTTPError
+
+SRC = Path(__file__).resolve().parent.parent / "src"
+sys.path.insert(0, str(SRC))
+spec = importlib.util.spec_from_file_location("mk_vm_truenas", SRC / "mk-vm-truenas.py")
+mk_vm_truenas = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(mk_vm_truenas)
+
+
+class FakeMiddleware(BaseHTTPRequestHandler):
+    # the /api/v2.0 of the TrueNAS middleware, replies[(method, path)] is a list of (status, body) served in order,
+    # the last one again once the others are used up, the connection is closed after the replies to the requests of closing
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, method):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        self.server.requests.append((method, self.path, body, self.headers["Authorization"], self.client_address))
+        replies = self.server.replies.get((method, self.path), [(404, {"error": "not found"})])
+        status, payload = replies.pop(0) if len(replies) > 1 else replies[0]
+
+        # a status of None drops the connection without a reply, like a middleware restarting after handling the request
+        if status is None:
+            self.close_connection = True
+            return
+
+        # the connection is closed once idle, like by the keep-alive timeout of the middleware
+        self.close_connection = (method, self.path) in self.server.closing
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.reply("GET")
+
+    def do_POST(self):
+        self.reply("POST")
+
+    def do_DELETE(self):
+        self.reply("DELETE")
+
+
+class ClientTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeMiddleware)
+        self.server.requests = []
+        self.server.replies = {}
+        self.server.closing = set()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.client = mk_vm_truenas.Client("127.0.0.1:{}".format(self.server.server_port), "secret", backoff=0.01)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_keep_alive(self):
+        self.server.replies[("GET", "/api/v2.0/vm")] = [(200, [{"id": 1}])]
+
+        for _ in range(3):
+            self.assertEqual(self.client.request("GET", "/vm"), (200, [{"id": 1}]))
+
+        self.assertEqual(len({request[4] for request in self.server.requests}), 1)
+        self.assertEqual({request[3] for request in self.server.requests}, {"Bearer secret"})
+
+    def test_get_retried(self):
+        self.server.replies[("GET", "/api/v2.0/pool")] = [(503, {}), (502, {}), (200, [{"name": "tank"}])]
+        self.assertEqual(self.client.request("GET", "/pool"), (200, [{"name": "tank"}]))
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_post_not_retried(self):
+        self.server.replies[("POST", "/api/v2.0/vm")] = [(503, {}), (200, {"id": 1})]
+
+        with self.assertRaises(HTTPError) as raised:
+            self.client.request("POST", "/vm", {"name": "web1"})
+
+        self.assertEqual(raised.exception.code, 503)
+        self.assertEqual(self.server.requests, [("POST", "/api/v2.0/vm", {"name": "web1"}, "Bearer secret", self.server.requests[0][4])])
+
+    def test_post_not_retried_once_sent(self):
+        self.server.replies[("POST", "/api/v2.0/vm")] = [(None, None), (200, {"id": 1})]
+
+        with self.assertRaises(ConnectionError):
+            self.client.request("POST", "/vm", {"name": "web1"})
+
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_post_on_closed_keep_alive(self):
+        self.server.replies[("GET", "/api/v2.0/vm")] = [(200, [])]
+        self.server.replies[("POST", "/api/v2.0/vm")] = [(200, {"id": 1})]
+        self.server.closing.add(("GET", "/api/v2.0/vm"))
+        self.client.request("GET", "/vm")
+        # the middleware closes the pooled connection meanwhile, the POST goes out on a new one at the first attempt
+        sleep(0.1)
+
+        with self.assertNoLogs(mk_vm_truenas.LOGGER, "WARNING"):
+            self.assertEqual(self.client.request("POST", "/vm", {"name": "web1"}), (200, {"id": 1}))
+
+        self.assertEqual([request[0] for request in self.server.requests], ["GET", "POST"])
+        self.assertNotEqual(self.server.requests[0][4], self.server.requests[1][4])
+
+    def test_post_retried_when_throttled(self):
+        self.server.replies[("POST", "/api/v2.0/vm")] = [(429, {}), (200, {"id": 1})]
+        self.assertEqual(self.client.request("POST", "/vm", {"name": "web1"}), (200, {"id": 1}))
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_retries_bounded(self):
+        self.server.replies[("GET", "/api/v2.0/pool")] = [(503, {})]
+
+        with self.assertRaises(HTTPError):
+            self.client.request("GET", "/pool")
+
+        self.assertEqual(len(self.server.requests), self.client.retries + 1)
+
+    def test_job(self):
+        self.server.replies[("POST", "/api/v2.0/vm/id/1/start")] = [(200, 7)]
+        self.server.replies[("GET", "/api/v2.0/core/get_jobs?id=7")] = [
+            (200, [{"id": 7, "method": "vm.start", "state": "RUNNING", "progress": {"percent": 50}}]),
+            (200, [{"id": 7, "method": "vm.start", "state": "SUCCESS", "progress": {"percent": 100}, "result": True}]),
+        ]
+        self.assertIs(self.client.job("POST", "/vm/id/1/start", {"overcommit": True}, interval=0.01), True)
+
+    def test_job_failed(self):
+        self.server.replies[("POST", "/api/v2.0/vm/id/1/start")] = [(200, 7)]
+        self.server.replies[("GET", "/api/v2.0/core/get_jobs?id=7")] = [
+            (200, [{"id": 7, "method": "vm.start", "state": "FAILED", "error": "no memory"}]),
+        ]
+
+        with self.assertRaisesRegex(RuntimeError, "no memory"):
+            self.client.job("POST", "/vm/id/1/start", {"overcommit": True}, interval=0.01)
+
+    def test_delete_body(self):
+        self.server.replies[("DELETE", "/api/v2.0/vm/id/1")] = [(200, True)]
+        self.assertEqual(self.client.request("DELETE", "/vm/id/1", {"zvols": False, "force": True}), (200, True))
+        self.assertEqual(self.server.requests[0][2], {"zvols": False, "force": True})
+
+
+if __name__ == "__main__":
+    unittest.main()
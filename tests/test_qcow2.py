@@ -0,0 +1,62 @@
+import importlib.util
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+from pathlib import Path
+
+SRC = Path(__file__).resolve().parent.parent / "src"
+spec = importlib.util.spec_from_file_location("easy_qemu_system", SRC / "easy-qemu-system-x86_64.py")
+easy_qemu_system = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(easy_qemu_system)
+
+
+@unittest.skipIf(shutil.which("qemu-img") is None, "qemu-img is not installed")
+class Qcow2Test(unittest.TestCase):
+    # the images written by qcow2_create are checked and read back by qemu-img
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def create(self, name, size=None, **options):
+        path = os.path.join(self.tmpdir.name, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        easy_qemu_system.qcow2_create(path, size, **options)
+        subprocess.run(["qemu-img", "check", path], check=True, stdout=subprocess.DEVNULL)
+        info = subprocess.run(["qemu-img", "info", "--output=json", path], check=True, stdout=subprocess.PIPE)
+        return json.loads(info.stdout)
+
+    def test_base(self):
+        info = self.create("base.qcow2", 10 * 1073741824)
+        self.assertEqual(info["format"], "qcow2")
+        self.assertEqual(info["virtual-size"], 10 * 1073741824)
+        self.assertEqual(info["cluster-size"], 65536)
+        self.assertEqual(info["format-specific"]["data"]["compat"], "1.1")
+        self.assertEqual(info["format-specific"]["data"]["compression-type"], "zlib")
+        self.assertNotIn("backing-filename", info)
+
+    def test_overlay(self):
+        self.create("base.qcow2", 3 * 1073741824 + 512)
+        info = self.create("vm/snap.qcow2", backing_file="../base.qcow2", backing_fmt="qcow2")
+        self.assertEqual(info["virtual-size"], 3 * 1073741824 + 512)
+        self.assertEqual(info["backing-filename"], "../base.qcow2")
+        self.assertEqual(info["backing-filename-format"], "qcow2")
+
+    def test_extended_l2(self):
+        info = self.create("extl2.qcow2", 100 * 1073741824, cluster_size=131072, extended_l2=True)
+        self.assertEqual(info["virtual-size"], 100 * 1073741824)
+        self.assertEqual(info["cluster-size"], 131072)
+        self.assertIs(info["format-specific"]["data"]["extended-l2"], True)
+
+    def test_zstd(self):
+        info = self.create("zstd.qcow2", 1073741824, compression_type="zstd")
+        self.assertEqual(info["virtual-size"], 1073741824)
+        self.assertEqual(info["format-specific"]["data"]["compression-type"], "zstd")
+
+
+if __name__ == "__main__":
+    unittest.main()